@@ -1,10 +1,24 @@
 # -*- coding: utf-8 -*-
 from .mail_bot import MailBot
-from .main import resourceDir, dataDir, tempDir, triggerWords, keyUploadServerPort, logLevel, smtpServerHost, loadConfiguration, configFile, silentPeriodSec, main
+from .main import resourceDir, dataDir, tempDir, memoryTempDir, tempDirQuotaMb, triggerWords, keyUploadServerPort, logLevel, smtpServerHost, loadConfiguration, configFile, silentPeriodSec, keyringPoolSize, keyringPoolWarmUp, cryptoBackend, correspondentKeyringCacheSize, correspondentKeyringCacheIdleSec, botIdentityCachePersisted, cryptoWorkerCount, cryptoOperationTimeoutSec, maxKeySizeKb, maildirWatcher, maildirPollMinIntervalSec, maildirPollMaxIntervalSec, dispatcherWorkerCount, maildirMaxPending, instanceName, quarantineBaseDelaySec, quarantineMaxDelaySec, quarantineMaxAttempts, mailListener, mailListenerHost, mailListenerPort, mailListenerMaxPending, runtime, asyncMaxInFlight, rateLimitSenderBurst, rateLimitSenderPerHour, rateLimitGlobalBurst, rateLimitGlobalPerHour, rateLimitAction, rateLimitPersisted, dedupTtlSec, dedupMaxEntries, coalescingWindowSec, dbJournalMode, dbSynchronous, dbCacheSizeKb, dbCompressKeys, dbCorrespondentCacheSize, main
 from .pgp import Pgp
+from .keyring_pool import KeyringPool, BotKeyring
+from .bot_identity import BotIdentity
+from .crypto_executor import CryptoExecutor, CryptoOperation
+from .crypto_backend import createCryptoBackend, PipeGpg, CryptoResult, CryptoBackend, GnupgCryptoBackend, InProcessCryptoBackend
+from .dispatcher import Dispatcher
+from .triage import Triage
+from .rate_limiter import RateLimiter, TokenBucket
+from .quarantine import QuarantineRecord
+from .claiming_maildir import ClaimingMaildir, ClaimedMessage
+from .maildir_watcher import createMaildirWatcher, MaildirWatcher, InotifyMaildirWatcher, PollingMaildirWatcher
 from .incoming_message import IncomingMessage
 from .outgoing_message import OutgoingMessage
 from .util import extractWords, removeFile, removeMimeVersion, setMimeAttachmentFileName, isPathPrefix, getMessageRecipientsEmailAddresses, getMessageSenderEmailAddress
 from .db import Db
-from .exception import EmailSecChalException, MsgException, PgpException
+from .workspace import Workspace
+from .exception import EmailSecChalException, MsgException, PgpException, UnsupportedOperationException
+from . import openpgp
 from .key_upload_server import startKeyUploadServer,KeyUploadRequestHandler
+from .mail_listener import createMailListener, MailListener, MailListenerRequestHandler
+from .async_mail_bot import AsyncMailBot, AsyncSmtpClient
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import asyncio
+import itertools
+import logging
+import mailbox
+import threading
+
+
+
+# Just enough of an SMTP client on asyncio streams to hand the replies over to the SMTP server.
+class AsyncSmtpClient:
+
+    host = None
+    port = 25
+    reader = None
+    writer = None
+
+
+    def __init__(self, host_, port_=None):
+        self.host, _, port = host_.partition(":")
+        self.port = port_ if port_ is not None else int(port or 25)
+
+    async def readReply(self, expectedCode):
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise email_sec_chal.EmailSecChalException("The SMTP server at %s:%d closed the connection" % (self.host, self.port))
+            lines.append(str(line, "utf-8", "replace").rstrip("\r\n"))
+            if line[3:4] != b"-":
+                break
+        code = int(lines[-1][:3])
+        if code != expectedCode:
+            raise email_sec_chal.EmailSecChalException("Unexpected SMTP reply from %s:%d: %s" % (self.host, self.port, " / ".join(lines)))
+        return lines
+
+    async def command(self, line, expectedCode):
+        self.writer.write(bytes(line + "\r\n", "utf-8"))
+        await self.writer.drain()
+        return await self.readReply(expectedCode)
+
+    async def sendmail(self, fromAddress, toAddress, msg):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            await self.readReply(220)
+            await self.command("EHLO %s" % email_sec_chal.instanceName, 250)
+            await self.command("MAIL FROM:<%s>" % fromAddress, 250)
+            await self.command("RCPT TO:<%s>" % toAddress, 250)
+            await self.command("DATA", 354)
+            data = bytes(msg, "utf-8").replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+            if not data.endswith(b"\r\n"):
+                data += b"\r\n"
+            data = b"\r\n".join((b"." + line if line.startswith(b".") else line) for line in data.split(b"\r\n"))
+            self.writer.write(data + b".\r\n")
+            await self.writer.drain()
+            await self.readReply(250)
+            await self.command("QUIT", 221)
+        finally:
+            self.writer.close()
+            await self.writer.wait_closed()
+        logging.debug("EmailSecChal: async_mail_bot: Successfully sent message to %s through %s:%d" % (toAddress, self.host, self.port))
+
+
+
+# A MailBot on an asyncio event loop. The claimed messages are all in flight at the same time, the gpg work is
+# awaited on the crypto executor and the replies are sent with AsyncSmtpClient, so no thread waits for any of it.
+# Messages from the same correspondent are still processed one at a time in order.
+class AsyncMailBot(email_sec_chal.MailBot):
+
+    loop = None
+    semaphore = None
+    lastTasks = None
+    pendingCount = 0
+    pendingDropped = None       # Set whenever a message stops waiting for its turn.
+    finishingTasks = None
+
+
+    def run(self):
+        asyncio.run(self.runAsync())
+
+    async def runAsync(self):
+        self.initRuntime()
+        if email_sec_chal.mailListener == "none":
+            await self.runMaildirAsync()
+        else:
+            await self.runListenerAsync()
+
+    # Must be called on the event loop.
+    def initRuntime(self):
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(email_sec_chal.asyncMaxInFlight)
+        self.lastTasks = {}
+        self.pendingCount = 0
+        self.pendingDropped = asyncio.Event()
+        self.finishingTasks = set()
+        self.threadLocal = threading.local()
+        self.triage = email_sec_chal.Triage()
+        self.rateLimiter = email_sec_chal.RateLimiter()
+        email_sec_chal.Db.staticInit()
+        email_sec_chal.Pgp.staticInit()
+        email_sec_chal.CryptoExecutor.staticInit()
+
+    async def runMaildirAsync(self):
+        self.mbox = self.getMailbox()
+        self.mbox.recover()
+        self.watcher = self.createWatcher()
+
+        logging.info("EmailSecChal: async_mail_bot: Successfully started with at most %d messages in flight" % email_sec_chal.asyncMaxInFlight)
+
+        try:
+            while True:
+                msgCount = await self.processMailboxAsync()
+                self.watcher.processed(msgCount)
+                if self.claimLimited:
+                    await self.waitForPendingCountAsync(email_sec_chal.maildirMaxPending)
+                else:
+                    await self.loop.run_in_executor(None, self.watcher.wait, self.mbox.nextRetryTime)
+        finally:
+            await self.joinAsync()
+            self.watcher.close()
+
+    # The listener keeps its threads, its sessions hand the messages over to the event loop.
+    async def runListenerAsync(self):
+        self.deliveredCounter = itertools.count()
+        self.listener = email_sec_chal.createMailListener(self)
+
+        logging.info("EmailSecChal: async_mail_bot: Successfully started with at most %d messages in flight" % email_sec_chal.asyncMaxInFlight)
+
+        try:
+            await self.loop.run_in_executor(None, self.listener.serve_forever)
+        finally:
+            self.listener.server_close()
+
+    # Like MailBot.processMailbox(), the messages are finished by finishMessageAsync() as they are done. The Maildir and
+    # the DB are only touched on the default executor, so that the event loop never blocks on the disk.
+    async def processMailboxAsync(self):
+        claimedMessages = await self.loop.run_in_executor(None, self.claimMessages, email_sec_chal.maildirMaxPending - self.pendingCount)
+
+        for claimedMessage in claimedMessages:
+            try:
+                admitted, retryTime = await self.loop.run_in_executor(None, self.admitMessage, claimedMessage)
+                if admitted:
+                    task = self.submitMessageAsync(claimedMessage)
+            except Exception as e:
+                logging.exception("EmailSecChal: async_mail_bot: Failed admitting message %s" % claimedMessage.key)
+                await self.loop.run_in_executor(None, self.quarantine, claimedMessage, "%s: %s" % (type(e).__name__, e))
+                continue
+            if not admitted:
+                if retryTime is None:
+                    await self.loop.run_in_executor(None, self.mbox.complete, claimedMessage)
+                else:
+                    await self.loop.run_in_executor(None, self.mbox.defer, claimedMessage, "rate limited", retryTime)
+                continue
+            finishingTask = asyncio.ensure_future(self.finishMessageAsync(claimedMessage, task))
+            self.finishingTasks.add(finishingTask)
+            finishingTask.add_done_callback(self.finishingTasks.discard)
+        return len(claimedMessages)
+
+    async def finishMessageAsync(self, claimedMessage, task):
+        await asyncio.wait([task])
+        await self.loop.run_in_executor(None, self.finishMessage, claimedMessage, task)
+
+    # Waits until fewer than maxCount messages wait for their turn.
+    async def waitForPendingCountAsync(self, maxCount):
+        while self.pendingCount >= maxCount:
+            self.pendingDropped.clear()
+            await self.pendingDropped.wait()
+
+    # Waits until all the claimed messages are finished.
+    async def joinAsync(self):
+        while self.finishingTasks:
+            await asyncio.wait(list(self.finishingTasks))
+
+    def submitMessageAsync(self, claimedMessage):
+        senderEmailAddress = email_sec_chal.util.getMessageSenderEmailAddress(claimedMessage.headers)
+        previousTask = self.lastTasks.get(senderEmailAddress)
+        self.pendingCount += 1
+        task = asyncio.ensure_future(self.runAfter(previousTask, claimedMessage))
+        self.lastTasks[senderEmailAddress] = task
+        task.add_done_callback(lambda doneTask: self.forgetTask(senderEmailAddress, doneTask))
+        return task
+
+    def forgetTask(self, senderEmailAddress, task):
+        if self.lastTasks.get(senderEmailAddress) is task:
+            del self.lastTasks[senderEmailAddress]
+
+    async def runAfter(self, previousTask, claimedMessage):
+        try:
+            if previousTask is not None:
+                await asyncio.wait([previousTask])
+            await self.semaphore.acquire()
+        finally:
+            self.pendingCount -= 1
+            self.pendingDropped.set()
+        try:
+            return await self.processMessageAsync(claimedMessage)
+        finally:
+            self.semaphore.release()
+
+    def getPendingCount(self):
+        return self.pendingCount
+
+    # Called by the mail listener from its session threads.
+    def deliverMessage(self, data):
+        return asyncio.run_coroutine_threadsafe(self.deliverMessageAsync(data), self.loop).result()
+
+    async def deliverMessageAsync(self, data):
+        claimedMessage = email_sec_chal.ClaimedMessage("delivered-%d" % next(self.deliveredCounter), mailbox.MaildirMessage(data))
+        admitted, retryTime = await self.loop.run_in_executor(None, self.admitMessage, claimedMessage)
+        if not admitted:
+            return None if retryTime is None else "rate limited"
+        error = await self.submitMessageAsync(claimedMessage)
+        if error is None:
+            await self.loop.run_in_executor(None, self.messageProcessed, claimedMessage)
+        else:
+            self.forgetMessage(claimedMessage)
+        return error
+
+    # Returns None on success and the error otherwise.
+    async def processMessageAsync(self, claimedMessage):
+        try:
+            reply = await email_sec_chal.CryptoExecutor.runAsync(self.prepareReply, claimedMessage)
+            if reply is not None:
+                asImpostor, emailAddress, msgId, msg, reservation = reply
+                try:
+                    await self.createSmtpClient().sendmail(email_sec_chal.Pgp.botEmailAddress, emailAddress, msg)
+                except Exception:
+                    await self.loop.run_in_executor(None, lambda: self.getDb().cancelReply(emailAddress, reservation))
+                    raise
+                self.replied(asImpostor, emailAddress, msgId)
+        except Exception as e:
+            logging.exception("EmailSecChal: async_mail_bot: Failed processing message %s" % claimedMessage.key)
+            return "%s: %s" % (type(e).__name__, e)
+        return None
+
+    # Runs on a crypto worker, everything up to the signed and encrypted reply is timed as one crypto operation.
+    def prepareReply(self, claimedMessage):
+        with email_sec_chal.IncomingMessage.create(claimedMessage.getMessage()) as incomingMsg:
+            asImpostor, reservation = self.decideReply(incomingMsg)
+            if asImpostor is None:
+                return None
+            try:
+                with self.createReplyMessage(incomingMsg) as replyMsg:
+                    msg = replyMsg.construct(asImpostor)
+            except Exception:
+                self.getDb().cancelReply(incomingMsg.emailAddress, reservation)
+                raise
+            return asImpostor, incomingMsg.emailAddress, incomingMsg.id, msg.as_string(), reservation
+
+    def createSmtpClient(self):
+        return AsyncSmtpClient(email_sec_chal.smtpServerHost)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import json
+import logging
+import os
+
+
+
+class BotIdentity:
+
+    initialized = False
+    identities = {}
+    cacheFilePath = None
+    botNames = ["official", "impostor"]
+
+    botName = None
+    keysFilePath = None
+    keysFileTime = None
+    keysFileSize = None
+    publicKey = None
+    fingerprints = []
+    uids = []
+    keyIds = []
+
+
+    @staticmethod
+    def staticInit():
+        if BotIdentity.initialized:
+            return
+
+        if not os.access(email_sec_chal.dataDir, os.F_OK):
+            os.makedirs(email_sec_chal.dataDir)
+        BotIdentity.cacheFilePath = os.path.join(email_sec_chal.dataDir, "bot_identities.json")
+        cachedIdentities = BotIdentity.loadCache() if email_sec_chal.botIdentityCachePersisted else {}
+        changed = False
+        BotIdentity.identities = {}
+        for botName in BotIdentity.botNames:
+            keysFilePath = os.path.join(email_sec_chal.resourceDir, botName + "Bot.asc")
+            keysFileStat = os.stat(keysFilePath)
+            identity = cachedIdentities.get(botName)
+            if identity is None or identity.keysFilePath != keysFilePath or identity.keysFileTime != keysFileStat.st_mtime or identity.keysFileSize != keysFileStat.st_size:
+                identity = BotIdentity.compute(botName, keysFilePath, keysFileStat)
+                changed = True
+            else:
+                logging.debug("EmailSecChal: bot_identity: Using the cached identity of the %s bot" % botName)
+            BotIdentity.identities[botName] = identity
+        if changed and email_sec_chal.botIdentityCachePersisted:
+            BotIdentity.saveCache()
+
+        logging.debug("EmailSecChal: bot_identity: Static initialization successful")
+        BotIdentity.initialized = True
+
+    @staticmethod
+    def get(botName):
+        BotIdentity.staticInit()
+        return BotIdentity.identities[botName]
+
+    @staticmethod
+    def compute(botName, keysFilePath, keysFileStat):
+        with open(keysFilePath, "r") as keysFile:
+            keys = keysFile.read()
+
+        identity = BotIdentity(botName, keysFilePath, keysFileStat.st_mtime, keysFileStat.st_size)
+        gnupgHomeDir = email_sec_chal.Workspace.create("scratch_")
+        try:
+            backend = email_sec_chal.createCryptoBackend(gnupgHomeDir)
+            identity.fingerprints = backend.importKeys(keys)
+            secretKeys = backend.listKeys(secret = True)
+            if not secretKeys:
+                raise email_sec_chal.PgpException("No secret key found in %s." % keysFilePath)
+            identity.uids = secretKeys[0]["uids"]
+            keyIds = set()
+            for key in secretKeys:
+                keyIds.add(key["keyid"].upper())
+                for subkey in key["subkeys"]:
+                    keyIds.add(subkey[0].upper())
+            identity.keyIds = sorted(keyIds)
+            for fingerprint in identity.fingerprints:
+                identity.publicKey = backend.exportPublicKey(fingerprint)
+                if identity.publicKey:
+                    break
+            if not identity.publicKey:
+                raise email_sec_chal.PgpException("The public key of the %s bot could not be exported." % botName)
+        finally:
+            email_sec_chal.Workspace.remove(gnupgHomeDir)
+
+        logging.info("EmailSecChal: bot_identity: Loaded the identity of the %s bot from %s" % (botName, keysFilePath))
+        return identity
+
+    @staticmethod
+    def loadCache():
+        try:
+            with open(BotIdentity.cacheFilePath, "r") as cacheFile:
+                cachedData = json.load(cacheFile)
+            return {botName: BotIdentity.fromDict(identityData) for botName, identityData in cachedData.items()}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, TypeError, OSError):
+            logging.warning("EmailSecChal: bot_identity: Ignoring the invalid bot identity cache %s" % BotIdentity.cacheFilePath, exc_info=True)
+            return {}
+
+    @staticmethod
+    def saveCache():
+        tmpFilePath = BotIdentity.cacheFilePath + ".tmp"
+        try:
+            with open(tmpFilePath, "w") as cacheFile:
+                json.dump({botName: identity.toDict() for botName, identity in BotIdentity.identities.items()}, cacheFile)
+            os.replace(tmpFilePath, BotIdentity.cacheFilePath)
+            logging.debug("EmailSecChal: bot_identity: Saved the bot identities in %s" % BotIdentity.cacheFilePath)
+        except OSError:
+            logging.warning("EmailSecChal: bot_identity: Cannot save the bot identities in %s" % BotIdentity.cacheFilePath, exc_info=True)
+
+    @staticmethod
+    def fromDict(identityData):
+        identity = BotIdentity(identityData["botName"], identityData["keysFilePath"], identityData["keysFileTime"], identityData["keysFileSize"])
+        identity.publicKey = identityData["publicKey"]
+        identity.fingerprints = identityData["fingerprints"]
+        identity.uids = identityData["uids"]
+        identity.keyIds = identityData["keyIds"]
+        return identity
+
+    def __init__(self, botName_, keysFilePath_, keysFileTime_, keysFileSize_):
+        self.botName = botName_
+        self.keysFilePath = keysFilePath_
+        self.keysFileTime = keysFileTime_
+        self.keysFileSize = keysFileSize_
+
+    def toDict(self):
+        return {
+            "botName": self.botName,
+            "keysFilePath": self.keysFilePath,
+            "keysFileTime": self.keysFileTime,
+            "keysFileSize": self.keysFileSize,
+            "publicKey": self.publicKey,
+            "fingerprints": self.fingerprints,
+            "uids": self.uids,
+            "keyIds": self.keyIds
+        }
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import email.parser
+import hashlib
+import logging
+import mailbox
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+
+class ClaimedMessage:
+
+    key = None
+    headers = None
+    message = None
+    subpath = None      # Where the message was in the Maildir, e.g. new/1234.M5P6.host.
+    claimedPath = None
+    factory = None
+    record = None       # The QuarantineRecord of a message claimed back from the quarantine.
+    dedupKey = None
+
+
+    def __init__(self, key_, message_, subpath_=None, claimedPath_=None, factory_=mailbox.MaildirMessage, record_=None):
+        self.key = key_
+        self.message = message_
+        self.headers = message_
+        self.subpath = subpath_
+        self.claimedPath = claimedPath_
+        self.factory = factory_
+        self.record = record_
+
+    # Only the headers are parsed until the whole message is needed.
+    def readHeaders(self):
+        with open(self.claimedPath, "rb") as f:
+            self.headers = email.parser.BytesHeaderParser().parse(f)
+        return self.headers
+
+    # The Message-ID plus a digest of the body, None if there is no Message-ID.
+    def getDedupKey(self):
+        if self.dedupKey is None:
+            msgId = self.headers["Message-ID"]
+            if not msgId:
+                return None
+            if self.claimedPath is not None:
+                with open(self.claimedPath, "rb") as f:
+                    data = f.read()
+            else:
+                data = self.message.as_bytes()
+            data = data.replace(b"\r\n", b"\n")
+            body = data.split(b"\n\n", 1)[-1]
+            self.dedupKey = hashlib.sha256(bytes(str(msgId).strip(), "utf-8", "replace") + b"\0" + hashlib.sha256(body).digest()).hexdigest()
+        return self.dedupKey
+
+    def getMessage(self):
+        if self.message is None:
+            with open(self.claimedPath, "rb") as f:
+                self.message = self.factory(f)
+        return self.message
+
+
+
+# A Maildir whose messages are claimed by renaming them into a processing directory owned by one bot instance.
+# The rename is atomic, so several instances can share the Maildir, and whatever is left in the processing
+# directory after a crash is moved back by recover(). An instance holds a lock on its processing directory from recover()
+# on, so that a second live process with the same instance name does not take over the messages in flight.
+# Messages that fail processing are moved into a quarantine directory next to a sidecar record and are only claimed
+# again by claimQuarantined() once their retry time has come. The records of the messages that will not be retried are
+# moved from records/ to failed/, so that only pending retries are read.
+class ClaimingMaildir(mailbox.Maildir):
+
+    processingDir = None
+    quarantineDir = None
+    recordsMtime = None         # Of the records directory when it was last read.
+    nextRetryTime = None        # The earliest retry time of the records last read, None if there were none.
+    mtimeGranularitySec = 2     # A directory changed more recently may change again without its mtime changing.
+    lockFile = None
+
+
+    def __init__(self, dirname, processingDir_, factory=mailbox.MaildirMessage, quarantineDir_=None):
+        mailbox.Maildir.__init__(self, dirname, factory = factory)
+        self.processingDir = processingDir_
+        self.quarantineDir = quarantineDir_ if quarantineDir_ is not None else os.path.join(dirname, "quarantine")
+        for subdir in ("new", "cur"):
+            os.makedirs(os.path.join(self.processingDir, subdir), exist_ok=True)
+            os.makedirs(os.path.join(self.quarantineDir, subdir), exist_ok=True)
+        os.makedirs(os.path.join(self.quarantineDir, "records"), exist_ok=True)
+        os.makedirs(os.path.join(self.quarantineDir, "failed"), exist_ok=True)
+
+    def getRecordPath(self, key):
+        return os.path.join(self.quarantineDir, "records", key + ".json")
+
+    def getFailedRecordPath(self, key):
+        return os.path.join(self.quarantineDir, "failed", key + ".json")
+
+    def claim(self, key):
+        try:
+            subpath = self._lookup(key)
+        except KeyError:
+            return None
+        claimedPath = os.path.join(self.processingDir, subpath)
+        try:
+            os.rename(os.path.join(self._path, subpath), claimedPath)
+        except FileNotFoundError:
+            logging.debug("EmailSecChal: claiming_maildir: Message %s was claimed by someone else" % key)
+            return None
+        self._toc.pop(key, None)
+
+        claimedMessage = ClaimedMessage(key, None, subpath, claimedPath, self._factory or mailbox.MaildirMessage)
+        claimedMessage.readHeaders()
+        logging.debug("EmailSecChal: claiming_maildir: Claimed message %s" % key)
+        return claimedMessage
+
+    def complete(self, claimedMessage):
+        os.remove(claimedMessage.claimedPath)
+        if claimedMessage.record is not None:
+            os.remove(self.getRecordPath(claimedMessage.key))
+        logging.debug("EmailSecChal: claiming_maildir: Removed the processed message %s" % claimedMessage.key)
+
+    def requeue(self, claimedMessage):
+        os.rename(claimedMessage.claimedPath, os.path.join(self._path, claimedMessage.subpath))
+        logging.debug("EmailSecChal: claiming_maildir: Returned message %s to the Maildir" % claimedMessage.key)
+
+    def quarantine(self, claimedMessage, error, now=None):
+        record = claimedMessage.record or email_sec_chal.QuarantineRecord(claimedMessage.key, claimedMessage.subpath)
+        record.recordFailure(error, now if now is not None else time.time())
+        self.moveToQuarantine(claimedMessage, record)
+        logging.debug("EmailSecChal: claiming_maildir: Quarantined message %s" % claimedMessage.key)
+        return record
+
+    def defer(self, claimedMessage, reason, retryTime):
+        record = claimedMessage.record or email_sec_chal.QuarantineRecord(claimedMessage.key, claimedMessage.subpath)
+        record.defer(reason, retryTime)
+        self.moveToQuarantine(claimedMessage, record)
+        logging.debug("EmailSecChal: claiming_maildir: Deferred message %s" % claimedMessage.key)
+        return record
+
+    def moveToQuarantine(self, claimedMessage, record):
+        if record.nextRetryTime is None:
+            record.save(self.getFailedRecordPath(claimedMessage.key))
+            self.removeRecord(claimedMessage.key)
+            logging.info("EmailSecChal: claiming_maildir: Message %s will not be retried" % claimedMessage.key)
+        else:
+            record.save(self.getRecordPath(claimedMessage.key))
+            if self.nextRetryTime is None or record.nextRetryTime < self.nextRetryTime:
+                self.nextRetryTime = record.nextRetryTime
+        os.rename(claimedMessage.claimedPath, os.path.join(self.quarantineDir, record.subpath))
+        claimedMessage.record = record
+
+    def removeRecord(self, key):
+        try:
+            os.remove(self.getRecordPath(key))
+        except FileNotFoundError:
+            pass
+
+    def getRecords(self, recordsDirName):
+        records = []
+        for name in os.listdir(os.path.join(self.quarantineDir, recordsDirName)):
+            if name.endswith(".json"):
+                try:
+                    records.append(email_sec_chal.QuarantineRecord.load(os.path.join(self.quarantineDir, recordsDirName, name)))
+                except FileNotFoundError:
+                    pass
+        return records
+
+    # The records of all the quarantined messages, those that will not be retried included.
+    def getQuarantineRecords(self):
+        return self.getRecords("records") + self.getRecords("failed")
+
+    # Reads the records only if one may be due: every record written, by this instance or another, changes the mtime of
+    # the records directory.
+    def claimQuarantined(self, now=None):
+        now = now if now is not None else time.time()
+        recordsMtime = os.stat(os.path.join(self.quarantineDir, "records")).st_mtime
+        if recordsMtime == self.recordsMtime and time.time() - recordsMtime > ClaimingMaildir.mtimeGranularitySec and \
+                (self.nextRetryTime is None or now < self.nextRetryTime):
+            return []
+        self.recordsMtime = recordsMtime
+        self.nextRetryTime = None
+        claimedMessages = []
+        for record in self.getRecords("records"):
+            if record.nextRetryTime is None:
+                # Written before the records of the messages that will not be retried were kept apart.
+                record.save(self.getFailedRecordPath(record.key))
+                self.removeRecord(record.key)
+                continue
+            if not record.isDue(now):
+                self.nextRetryTime = record.nextRetryTime if self.nextRetryTime is None else min(self.nextRetryTime, record.nextRetryTime)
+                continue
+            claimedPath = os.path.join(self.processingDir, record.subpath)
+            try:
+                os.rename(os.path.join(self.quarantineDir, record.subpath), claimedPath)
+            except FileNotFoundError:
+                logging.debug("EmailSecChal: claiming_maildir: Quarantined message %s was claimed by someone else" % record.key)
+                continue
+            claimedMessage = ClaimedMessage(record.key, None, record.subpath, claimedPath, self._factory or mailbox.MaildirMessage, record)
+            claimedMessage.readHeaders()
+            logging.debug("EmailSecChal: claiming_maildir: Claimed quarantined message %s for attempt %d" % (record.key, record.attempts + 1))
+            claimedMessages.append(claimedMessage)
+        return claimedMessages
+
+    def lockProcessingDir(self):
+        if self.lockFile is not None or fcntl is None:
+            return
+        lockFile = open(self.processingDir + ".lock", "a")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lockFile.close()
+            raise email_sec_chal.EmailSecChalException("The processing directory %s is used by another live process, each bot process needs its own instance name" % self.processingDir)
+        self.lockFile = lockFile
+
+    def close(self):
+        mailbox.Maildir.close(self)
+        if self.lockFile is not None:
+            self.lockFile.close()
+            self.lockFile = None
+
+    def recover(self):
+        self.lockProcessingDir()
+        recoveredCount = 0
+        for subdir in ("new", "cur"):
+            for name in os.listdir(os.path.join(self.processingDir, subdir)):
+                subpath = os.path.join(subdir, name)
+                key = name.split(self.colon)[0]
+                claimedPath = os.path.join(self.processingDir, subpath)
+                if os.access(self.getRecordPath(key), os.F_OK):
+                    # A retry of a quarantined message, it goes back to the quarantine and keeps its schedule.
+                    os.rename(claimedPath, os.path.join(self.quarantineDir, subpath))
+                else:
+                    self.requeue(ClaimedMessage(key, None, subpath, claimedPath))
+                recoveredCount += 1
+        if recoveredCount > 0:
+            logging.warning("EmailSecChal: claiming_maildir: Returned %d messages left over from a previous run to the Maildir" % recoveredCount)
+        return recoveredCount
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import contextlib
+import errno
+import gnupg
+import logging
+import os
+import subprocess
+import threading
+import warnings
+
+try:
+    import pgpy
+except ImportError:
+    pgpy = None
+
+
+
+def createCryptoBackend(gnupgHomeDir):
+    if email_sec_chal.cryptoBackend == "gnupg":
+        return GnupgCryptoBackend(gnupgHomeDir)
+    if email_sec_chal.cryptoBackend == "in_process":
+        if pgpy is None:
+            raise email_sec_chal.PgpException("The in-process crypto backend requires PGPy, which is not installed.")
+        return InProcessCryptoBackend(gnupgHomeDir)
+    raise email_sec_chal.PgpException("Unknown crypto backend: %s" % email_sec_chal.cryptoBackend)
+
+
+
+# The gpg objects are shared by the threads using a keyring, so the descriptors to pass are kept per thread, for the
+# call that needs them only.
+class PipeGpg(gnupg.GPG):
+
+    threadLocal = threading.local()
+
+
+    # Left to python-gnupg unless descriptors are to be inherited by the gpg process, which python-gnupg cannot do.
+    # Descriptors are only passed on POSIX, where python-gnupg does not need anything else for the process.
+    def _open_subprocess(self, *args, **kwargs):
+        passFds = getattr(PipeGpg.threadLocal, "passFds", ())
+        if passFds:
+            cmd = self.make_args(*args, **kwargs)
+            if self.verbose:
+                print(subprocess.list2cmdline(cmd))
+            process = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env, pass_fds=passFds)
+        else:
+            process = super()._open_subprocess(*args, **kwargs)
+        logging.debug("EmailSecChal: crypto_backend: Started gpg process %d" % process.pid)
+        email_sec_chal.CryptoExecutor.registerProcess(process)
+        return process
+
+    @staticmethod
+    def writeToPipe(writeFd, data):
+        try:
+            with os.fdopen(writeFd, "wb") as pipe:
+                pipe.write(data)
+        except OSError as e:
+            if e.errno != errno.EPIPE:      # gpg may exit without reading everything.
+                raise
+
+    def verifyDetached(self, data, signature):
+        if isinstance(signature, str):
+            signature = signature.encode("ascii", "ignore")
+        readFd, writeFd = os.pipe()
+        writer = threading.Thread(target=PipeGpg.writeToPipe, args=(writeFd, signature))
+        writer.start()
+        PipeGpg.threadLocal.passFds = (readFd,)
+        try:
+            return self.verify_data("-&%d" % readFd, data, extra_args=["--enable-special-filenames", "--"])
+        finally:
+            PipeGpg.threadLocal.passFds = ()
+            os.close(readFd)
+            writer.join()
+
+
+
+class CryptoResult:
+
+    ok = False
+    valid = False
+    data = b""
+    stderr = ""
+
+
+    def __init__(self, ok_=False, valid_=False, data_=b"", stderr_=""):
+        self.ok = ok_
+        self.valid = valid_
+        self.data = data_
+        self.stderr = stderr_
+
+    def __bool__(self):
+        return self.ok
+
+
+
+# The OpenPGP operations on one keyring, all of which a backend implements. Results of decrypt() and verifyDetached()
+# are true on success and have the valid, data and stderr attributes; keys are listed as dictionaries shaped like those
+# of python-gnupg.
+class CryptoBackend:
+
+    gnupgHomeDir = None
+
+
+    def importKeys(self, keyData):
+        raise NotImplementedError()
+
+    def scanKeys(self, keyData):
+        raise NotImplementedError()
+
+    def listKeys(self, secret=False):
+        raise NotImplementedError()
+
+    def deleteKeys(self, fingerprints):
+        raise NotImplementedError()
+
+    def exportPublicKey(self, fingerprint):
+        raise NotImplementedError()
+
+    def decrypt(self, data):
+        raise NotImplementedError()
+
+    def verifyDetached(self, data, signature):
+        raise NotImplementedError()
+
+    def signAndEncrypt(self, data, recipientFingerprints, signerFingerprint):
+        raise NotImplementedError()
+
+
+
+class GnupgCryptoBackend(CryptoBackend):
+
+    gpg = None
+
+
+    def __init__(self, gnupgHomeDir_):
+        self.gnupgHomeDir = gnupgHomeDir_
+        self.gpg = email_sec_chal.Pgp.createGpg(self.gnupgHomeDir)
+
+    def importKeys(self, keyData):
+        return self.gpg.import_keys(keyData).fingerprints
+
+    def scanKeys(self, keyData):
+        return self.gpg.scan_keys_mem(keyData)
+
+    def listKeys(self, secret=False):
+        return self.gpg.list_keys(secret = secret)
+
+    def deleteKeys(self, fingerprints):
+        deleteResult = self.gpg.delete_keys(fingerprints)
+        if not deleteResult:
+            logging.warning("EmailSecChal: crypto_backend: Cannot delete keys %s from %s: %s" % (", ".join(fingerprints), self.gnupgHomeDir, deleteResult.stderr))
+        return bool(deleteResult)
+
+    def exportPublicKey(self, fingerprint):
+        return self.gpg.export_keys(fingerprint)
+
+    def decrypt(self, data):
+        return self.gpg.decrypt(data)
+
+    def verifyDetached(self, data, signature):
+        return self.gpg.verifyDetached(data, signature)
+
+    def signAndEncrypt(self, data, recipientFingerprints, signerFingerprint):
+        encryptedData = self.gpg.encrypt(data, recipientFingerprints, sign=signerFingerprint, always_trust=True)
+        if not encryptedData:
+            raise email_sec_chal.PgpException("Cannot sign and encrypt: %s" % encryptedData.stderr)
+        return str(encryptedData)
+
+
+
+# Keeps the keys in memory and runs the operations with PGPy. Whatever PGPy does not implement (e.g. ElGamal) raises
+# UnsupportedOperationException and is delegated to a gnupg keyring in the same home directory, populated on first use.
+# Keys PGPy cannot parse go straight to that keyring, and the operations that need them are delegated too.
+class InProcessCryptoBackend(CryptoBackend):
+
+    publicKeys = None
+    secretKeys = None
+    keyData = None
+    fallbackFingerprints = None
+    fallbackBackend = None
+
+
+    def __init__(self, gnupgHomeDir_):
+        self.gnupgHomeDir = gnupgHomeDir_
+        self.publicKeys = {}
+        self.secretKeys = {}
+        self.keyData = {}
+        self.fallbackFingerprints = set()
+
+    def getFallbackBackend(self):
+        if self.fallbackBackend is None:
+            self.fallbackBackend = GnupgCryptoBackend(self.gnupgHomeDir)
+            for keyBlocks in self.keyData.values():
+                self.fallbackBackend.importKeys("\n".join(keyBlocks))
+            logging.debug("EmailSecChal: crypto_backend: Created a gnupg fallback keyring in %s" % self.gnupgHomeDir)
+        return self.fallbackBackend
+
+    # The keys PGPy can parse, with their armored blocks, and the armored blocks of the others.
+    @staticmethod
+    def parseKeys(keyData):
+        if isinstance(keyData, bytes):
+            keyData = keyData.decode("ascii", "ignore")
+        keys = []
+        unparsedKeyBlocks = []
+        for match in email_sec_chal.openpgp.armorRe.finditer(keyData):
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    key, _ = pgpy.PGPKey.from_blob(match.group(0))
+            except Exception:
+                logging.debug("EmailSecChal: crypto_backend: Cannot parse key data in process", exc_info=True)
+                unparsedKeyBlocks.append(match.group(0))
+                continue
+            keys.append((key, match.group(0)))
+        return keys, unparsedKeyBlocks
+
+    @staticmethod
+    def keyToDict(key):
+        return {
+            "fingerprint": str(key.fingerprint).replace(" ", ""),
+            "keyid": key.fingerprint.keyid,
+            "uids": [uid.userid for uid in key.userids],
+            "subkeys": [[subkeyId, None, str(subkey.fingerprint).replace(" ", "")] for subkeyId, subkey in key.subkeys.items()]
+        }
+
+    def importKeys(self, keyData):
+        fingerprints = []
+        keys, unparsedKeyBlocks = InProcessCryptoBackend.parseKeys(keyData)
+        for key, keyBlock in keys:
+            fingerprint = str(key.fingerprint).replace(" ", "")
+            if key.is_public:
+                self.publicKeys[fingerprint] = key
+            else:
+                self.secretKeys[fingerprint] = key
+                self.publicKeys.setdefault(fingerprint, key.pubkey)
+            self.keyData.setdefault(fingerprint, []).append(keyBlock)
+            fingerprints.append(fingerprint)
+        if self.fallbackBackend is not None:
+            self.fallbackBackend.importKeys("\n".join(keyBlock for _, keyBlock in keys))
+        for keyBlock in unparsedKeyBlocks:
+            fallbackFingerprints = self.getFallbackBackend().importKeys(keyBlock)
+            self.fallbackFingerprints.update(fallbackFingerprints)
+            fingerprints.extend(fallbackFingerprints)
+        return fingerprints
+
+    def scanKeys(self, keyData):
+        keys, unparsedKeyBlocks = InProcessCryptoBackend.parseKeys(keyData)
+        scannedKeys = [InProcessCryptoBackend.keyToDict(key) for key, _ in keys]
+        for keyBlock in unparsedKeyBlocks:
+            scannedKeys.extend(self.getFallbackBackend().scanKeys(keyBlock))
+        return scannedKeys
+
+    def listKeys(self, secret=False):
+        keys = self.secretKeys if secret else self.publicKeys
+        listedKeys = [InProcessCryptoBackend.keyToDict(key) for key in keys.values()]
+        if self.fallbackFingerprints:
+            listedKeys.extend(key for key in self.fallbackBackend.listKeys(secret) if key["fingerprint"] in self.fallbackFingerprints)
+        return listedKeys
+
+    def deleteKeys(self, fingerprints):
+        for fingerprint in fingerprints:
+            if fingerprint in self.secretKeys:
+                return False
+            self.publicKeys.pop(fingerprint, None)
+            self.keyData.pop(fingerprint, None)
+            self.fallbackFingerprints.discard(fingerprint)
+        if self.fallbackBackend is not None:
+            return self.fallbackBackend.deleteKeys(fingerprints)
+        return True
+
+    def exportPublicKey(self, fingerprint):
+        return self.getFallbackBackend().exportPublicKey(fingerprint)     # Keeps the exact gpg output format.
+
+    def findKey(self, keys, keyId):
+        for key in keys.values():
+            if key.fingerprint.keyid == keyId or keyId in key.subkeys:
+                return key
+        return None
+
+    # A key missing in process may be one that only the fallback keyring has.
+    def getKey(self, keys, fingerprint):
+        if fingerprint in keys:
+            return keys[fingerprint]
+        raise email_sec_chal.UnsupportedOperationException("No key %s in process" % fingerprint)
+
+    def verifySignatures(self, subject, signerKeyIds, signature=None):
+        if not signerKeyIds:
+            return False
+        for signerKeyId in signerKeyIds:
+            key = self.findKey(self.publicKeys, signerKeyId)
+            if key is None and self.fallbackFingerprints:
+                raise email_sec_chal.UnsupportedOperationException("No key %s in process" % signerKeyId)
+            if key is None or not key.verify(subject, signature):
+                return False
+        return True
+
+    # PGPy raises NotImplementedError for the algorithms it does not implement.
+    @staticmethod
+    @contextlib.contextmanager
+    def pgpyOperation():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            try:
+                yield
+            except NotImplementedError as e:
+                raise email_sec_chal.UnsupportedOperationException("Not implemented by PGPy: %s" % e)
+
+    @staticmethod
+    def messageToBytes(message):
+        data = message.message
+        if isinstance(data, str):
+            textMode = message.type == "literal" and message._message.format == "t"     # PGPy decodes text mode literal data as Latin-1.
+            return data.encode("latin-1" if textMode else "utf-8")
+        return bytes(data)
+
+    def verifyCleartext(self, data):
+        cleartext = email_sec_chal.openpgp.getCleartext(data)
+        signature = pgpy.PGPSignature.from_blob(email_sec_chal.openpgp.dearmor(data))     # The armor after the cleartext.
+        signedText = "\n".join(line.rstrip(" \t\r") for line in cleartext.split("\n"))     # Trailing whitespace is not signed.
+        valid = self.verifySignatures(signedText, [signature.signer], signature)
+        return CryptoResult(False, valid, cleartext.encode())
+
+    def decrypt(self, data):
+        try:
+            with InProcessCryptoBackend.pgpyOperation():
+                if email_sec_chal.openpgp.getCleartext(data) is not None:
+                    return self.verifyCleartext(data)     # PGPy cannot parse cleartext signed messages with non-ASCII text.
+                message = pgpy.PGPMessage.from_blob(email_sec_chal.openpgp.toBinary(data))
+                if message.is_encrypted:
+                    secretKey = None
+                    for keyId in message.encrypters:
+                        secretKey = self.findKey(self.secretKeys, keyId)
+                        if secretKey is not None:
+                            break
+                    if secretKey is None and self.fallbackFingerprints:
+                        raise email_sec_chal.UnsupportedOperationException("No secret key in process for any of the recipients")
+                    if secretKey is None:
+                        return CryptoResult(stderr_="No secret key for any of the recipients: %s" % ", ".join(message.encrypters))
+                    message = secretKey.decrypt(message)
+                    ok = True
+                else:
+                    ok = False      # As with gpg, only the signature is processed.
+                valid = self.verifySignatures(message, message.signers)
+                return CryptoResult(ok, valid, InProcessCryptoBackend.messageToBytes(message))
+        except email_sec_chal.UnsupportedOperationException:
+            logging.debug("EmailSecChal: crypto_backend: Decryption not supported in process, delegating to gnupg", exc_info=True)
+            return self.getFallbackBackend().decrypt(data)
+        except Exception as e:
+            logging.debug("EmailSecChal: crypto_backend: Cannot decrypt in process", exc_info=True)
+            return CryptoResult(stderr_=str(e))
+
+    def verifyDetached(self, data, signature):
+        try:
+            with InProcessCryptoBackend.pgpyOperation():
+                pgpSignature = pgpy.PGPSignature.from_blob(email_sec_chal.openpgp.toBinary(signature))
+                valid = self.verifySignatures(data, [pgpSignature.signer], pgpSignature)
+                return CryptoResult(valid, valid)
+        except email_sec_chal.UnsupportedOperationException:
+            logging.debug("EmailSecChal: crypto_backend: Verification not supported in process, delegating to gnupg", exc_info=True)
+            return self.getFallbackBackend().verifyDetached(data, signature)
+        except Exception as e:
+            logging.debug("EmailSecChal: crypto_backend: Cannot verify in process", exc_info=True)
+            return CryptoResult(stderr_=str(e))
+
+    def signAndEncrypt(self, data, recipientFingerprints, signerFingerprint):
+        try:
+            with InProcessCryptoBackend.pgpyOperation():
+                message = pgpy.PGPMessage.new(data, format="b")
+                message |= self.getKey(self.secretKeys, signerFingerprint).sign(message)
+
+                cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
+                sessionKey = cipher.gen_key()
+                for fingerprint in dict.fromkeys(recipientFingerprints):
+                    message = self.getKey(self.publicKeys, fingerprint).encrypt(message, cipher=cipher, sessionkey=sessionKey)
+                del sessionKey
+                return str(message)
+        except email_sec_chal.UnsupportedOperationException:
+            logging.debug("EmailSecChal: crypto_backend: Encryption not supported in process, delegating to gnupg", exc_info=True)
+            return self.getFallbackBackend().signAndEncrypt(data, recipientFingerprints, signerFingerprint)
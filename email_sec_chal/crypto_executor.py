@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+
+
+class CryptoOperation:
+
+    name = None
+    processes = None
+    killed = False
+    lock = None
+    started = None      # Also set if the operation is cancelled before it starts.
+    startTime = None
+    onStarted = None
+
+
+    def __init__(self, name_, onStarted_=None):
+        self.name = name_
+        self.processes = []
+        self.killed = False
+        self.lock = threading.Lock()
+        self.started = threading.Event()
+        self.onStarted = onStarted_
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.started.set()
+        if self.onStarted is not None:
+            self.onStarted()
+
+    def addProcess(self, process):
+        with self.lock:
+            self.processes.append(process)
+            killed = self.killed
+        if killed:
+            self.killProcess(process)     # Started after the timeout, it would hang as well.
+
+    def kill(self):
+        with self.lock:
+            self.killed = True
+            processes = list(self.processes)
+        if not any(process.poll() is None for process in processes):
+            # Nothing to kill, e.g. with the in-process backend; the worker stays busy until the operation returns, and
+            # Pgp keeps the keyrings of the operation until then.
+            logging.warning("EmailSecChal: crypto_executor: The timed out operation %s has no gpg process to kill and keeps running" % self.name)
+        for process in processes:
+            self.killProcess(process)
+
+    def killProcess(self, process):
+        if process.poll() is None:
+            logging.warning("EmailSecChal: crypto_executor: Killing gpg process %d of the timed out operation %s" % (process.pid, self.name))
+            process.kill()
+
+
+
+class CryptoExecutor:
+
+    initialized = False
+    executor = None
+    workerCount = 0
+    threadLocal = threading.local()
+
+
+    @staticmethod
+    def staticInit():
+        if CryptoExecutor.initialized:
+            return
+
+        CryptoExecutor.workerCount = email_sec_chal.cryptoWorkerCount if email_sec_chal.cryptoWorkerCount > 0 else (os.cpu_count() or 1)
+        CryptoExecutor.executor = concurrent.futures.ThreadPoolExecutor(max_workers = CryptoExecutor.workerCount, thread_name_prefix = "crypto")
+
+        logging.info("EmailSecChal: crypto_executor: Started %d crypto workers" % CryptoExecutor.workerCount)
+        CryptoExecutor.initialized = True
+
+    @staticmethod
+    def shutdown():
+        if CryptoExecutor.executor is not None:
+            CryptoExecutor.executor.shutdown(wait = False)
+            CryptoExecutor.executor = None
+        CryptoExecutor.initialized = False
+
+    # Called by PipeGpg for every gpg process it starts, so that a timed out operation can kill its processes.
+    @staticmethod
+    def registerProcess(process):
+        operation = getattr(CryptoExecutor.threadLocal, "operation", None)
+        if operation is not None:
+            operation.addProcess(process)
+
+    @staticmethod
+    def runOperation(operation, function, args):
+        operation.start()
+        CryptoExecutor.threadLocal.operation = operation
+        try:
+            return function(*args)
+        finally:
+            CryptoExecutor.threadLocal.operation = None
+
+    @staticmethod
+    def submit(function, *args):
+        return CryptoExecutor.submitOperation(CryptoOperation(getattr(function, "__qualname__", repr(function))), function, args)
+
+    @staticmethod
+    def submitOperation(operation, function, args):
+        CryptoExecutor.staticInit()
+        future = CryptoExecutor.executor.submit(CryptoExecutor.runOperation, operation, function, args)
+        future.operation = operation
+        future.add_done_callback(lambda doneFuture: operation.started.set())
+        return future
+
+    @staticmethod
+    def getTimeoutSec():
+        return email_sec_chal.cryptoOperationTimeoutSec if email_sec_chal.cryptoOperationTimeoutSec > 0 else None
+
+    # The timeout counts from the start of the operation, the time it waits in the queue behind others does not count.
+    @staticmethod
+    def getRemainingSec(operation):
+        timeoutSec = CryptoExecutor.getTimeoutSec()
+        if timeoutSec is None or operation.startTime is None:
+            return timeoutSec
+        return max(0, operation.startTime + timeoutSec - time.monotonic())
+
+    @staticmethod
+    def timedOut(future):
+        future.cancel()
+        future.operation.kill()
+        return email_sec_chal.PgpException("The crypto operation %s did not finish in %d seconds." % (future.operation.name, CryptoExecutor.getTimeoutSec()))
+
+    @staticmethod
+    def wait(future):
+        future.operation.started.wait()
+        try:
+            return future.result(timeout = CryptoExecutor.getRemainingSec(future.operation))
+        except concurrent.futures.TimeoutError:
+            raise CryptoExecutor.timedOut(future)
+
+    @staticmethod
+    def run(function, *args):
+        # Already on a crypto worker, e.g. in a whole stage submitted by the asyncio runtime, which is timed as one operation.
+        if getattr(CryptoExecutor.threadLocal, "operation", None) is not None:
+            return function(*args)
+        return CryptoExecutor.wait(CryptoExecutor.submit(function, *args))
+
+    # For the asyncio runtime: the event loop awaits the operation instead of blocking a thread on it.
+    @staticmethod
+    async def runAsync(function, *args):
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+        def setStarted():
+            if not started.done():
+                started.set_result(None)
+        operation = CryptoOperation(getattr(function, "__qualname__", repr(function)), lambda: loop.call_soon_threadsafe(setStarted))
+        future = CryptoExecutor.submitOperation(operation, function, args)
+        result = asyncio.wrap_future(future)
+        await asyncio.wait([started, result], return_when = asyncio.FIRST_COMPLETED)
+        try:
+            return await asyncio.wait_for(result, CryptoExecutor.getRemainingSec(operation))
+        except asyncio.TimeoutError:
+            raise CryptoExecutor.timedOut(future)
@@ -1,93 +1,556 @@
 # -*- coding: utf-8 -*-
 import email_sec_chal
+import collections
+import contextlib
+import hashlib
 import os
 import sqlite3
 import logging
+import threading
 import time
+import zlib
 
 
 class Db:
     
     initialized = False
     conn = None
+    threadLocal = threading.local()
+    statementCacheSize = 256
+    busyTimeoutSec = 30
+    minSqliteVersion = (3, 35, 0)      # For RETURNING, upserts need 3.24.
     
+    # Correspondent rows and keys, shared by all threads. All writes to correspondents go through the methods below,
+    # which update the cache under writeLock in the order they are committed. They also increment the generation in the
+    # cache_generation table in the same transaction, so that a write by another process clears the cache. The
+    # generation is read once per transaction and at most every generationCheckIntervalSec outside of transactions.
+    cacheLock = threading.Lock()
+    writeLock = threading.RLock()
+    correspondentCache = collections.OrderedDict()
+    keyCache = collections.OrderedDict()
+    cacheWriteCount = 0
+    cacheGeneration = None
+    generationCheckIntervalSec = 0.1
+    nextGenerationCheckTime = 0
+    maxKeyCacheSize = 256
+    
+    seenMessagesEvictionIntervalSec = 60
+    nextSeenMessagesEvictionTime = 0
+    
+    
+    @staticmethod
+    def getDbFilePath():
+        return os.path.join(email_sec_chal.dataDir, "email_sec_chal.sqlite3")
     
     @staticmethod
     def createDbConnection():
-        return sqlite3.connect(os.path.join(email_sec_chal.dataDir, "email_sec_chal.sqlite3"), isolation_level=None)
+        for pragmaValue in (email_sec_chal.dbJournalMode, email_sec_chal.dbSynchronous):
+            if not pragmaValue.isalpha():
+                raise email_sec_chal.EmailSecChalException("Invalid SQLite pragma value: %s" % pragmaValue)
+        conn = sqlite3.connect(Db.getDbFilePath(), isolation_level=None, timeout=Db.busyTimeoutSec, cached_statements=Db.statementCacheSize)
+        conn.execute("PRAGMA synchronous = %s" % email_sec_chal.dbSynchronous)
+        conn.execute("PRAGMA cache_size = %d" % -email_sec_chal.dbCacheSizeKb)
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+    
+    # Each thread keeps one connection per database file for its whole life.
+    @staticmethod
+    def getConnection():
+        connections = getattr(Db.threadLocal, "connections", None)
+        if connections is None:
+            connections = {}
+            Db.threadLocal.connections = connections
+        dbFilePath = Db.getDbFilePath()
+        conn = connections.get(dbFilePath)
+        if conn is None:
+            conn = Db.createDbConnection()
+            connections[dbFilePath] = conn
+            logging.debug("EmailSecChal: db: Opened a connection to %s in thread %s" % (dbFilePath, threading.current_thread().name))
+        return conn
+    
+    # Closes the connections of the current thread.
+    @staticmethod
+    def closeConnections():
+        connections = getattr(Db.threadLocal, "connections", None)
+        if connections is not None:
+            for conn in connections.values():
+                conn.close()
+            connections.clear()
         
     @staticmethod
     def staticInit():
         if Db.initialized:
             return
         
+        if sqlite3.sqlite_version_info < Db.minSqliteVersion:
+            raise email_sec_chal.EmailSecChalException("SQLite %s is too old, at least %s is needed" % (sqlite3.sqlite_version, ".".join(map(str, Db.minSqliteVersion))))
         if not os.access(email_sec_chal.dataDir, os.F_OK):
             os.makedirs(email_sec_chal.dataDir)
 
-        conn = Db.createDbConnection()
+        conn = Db.getConnection()
+        cursor = conn.cursor()
+        # Persistent in the database file. With WAL, readers do not block the writer and the writer does not block them.
+        cursor.execute("PRAGMA journal_mode = %s" % email_sec_chal.dbJournalMode)
+        logging.debug("EmailSecChal: db: Journal mode: %s" % cursor.fetchone()[0])
+        Db.migrate(conn)
+        
+        Db.clearCache()
+        logging.debug("EmailSecChal: db: Static initialization successful")
+        Db.initialized = True
+    
+    # The schema version is the number of migrations applied, kept in PRAGMA user_version. Only append to the list.
+    # Databases from before the versioning are at version 0 whatever they already have, so each migration checks
+    # what is there before changing it.
+    @staticmethod
+    def getMigrations():
+        return [Db.createCorrespondentsTable, Db.addLastReplyColumn, Db.createRateLimitBucketsTable, Db.createSeenMessagesTable, Db.moveKeysToKeysTable, Db.createCacheGenerationTable]
+    
+    # Each migration runs in its own transaction, which also rechecks the version in case another process got there first.
+    @staticmethod
+    def migrate(conn):
+        migrations = Db.getMigrations()
         cursor = conn.cursor()
+        while True:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute("PRAGMA user_version")
+                version = cursor.fetchone()[0]
+                if version > len(migrations):
+                    raise email_sec_chal.EmailSecChalException("The DB schema version %d is newer than the latest known version %d" % (version, len(migrations)))
+                if version == len(migrations):
+                    cursor.execute("COMMIT")
+                    break
+                migration = migrations[version]
+                startTime = time.perf_counter()
+                migration(cursor)
+                cursor.execute("PRAGMA user_version = %d" % (version + 1))
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            logging.info("EmailSecChal: db: Migrated the DB schema to version %d with %s in %.3f seconds" % (version + 1, migration.__name__, time.perf_counter() - startTime))
+        logging.debug("EmailSecChal: db: The DB schema is at version %d" % version)
+    
+    @staticmethod
+    def getColumnNames(cursor, tableName):
+        cursor.execute("PRAGMA table_info(%s)" % tableName)
+        return [row[1] for row in cursor.fetchall()]
+    
+    @staticmethod
+    def createCorrespondentsTable(cursor):
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS correspondents (
                 email_address TEXT PRIMARY KEY,
                 key TEXT DEFAULT NULL,
                 red_herring_sent INTEGER DEFAULT -1)""")
-        logging.debug("EmailSecChal: db: Created the correspondents DB table")
-        
-        logging.debug("EmailSecChal: db: Static initialization successful")
-        Db.initialized = True
+    
+    @staticmethod
+    def addLastReplyColumn(cursor):
+        if "last_reply" not in Db.getColumnNames(cursor, "correspondents"):
+            cursor.execute("ALTER TABLE correspondents ADD COLUMN last_reply INTEGER DEFAULT -1")
+    
+    @staticmethod
+    def createRateLimitBucketsTable(cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL)""")
+    
+    @staticmethod
+    def createSeenMessagesTable(cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS seen_messages (
+                dedup_key TEXT PRIMARY KEY,
+                seen REAL NOT NULL)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS seen_messages_seen ON seen_messages (seen)")
+
+    # Moves the keys that used to be stored as text in every correspondents row into the keys table. The key column is
+    # dropped by rebuilding the table, which unlike DROP COLUMN works with any SQLite version.
+    @staticmethod
+    def moveKeysToKeysTable(cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS keys (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                armor_type TEXT DEFAULT NULL,
+                compressed INTEGER NOT NULL DEFAULT 0)""")
+        columnNames = Db.getColumnNames(cursor, "correspondents")
+        if "key_hash" not in columnNames:
+            cursor.execute("ALTER TABLE correspondents ADD COLUMN key_hash TEXT DEFAULT NULL REFERENCES keys (hash)")
+        if "key" in columnNames:
+            cursor.execute("SELECT email_address, key FROM correspondents WHERE key IS NOT NULL")
+            rows = cursor.fetchall()
+            for emailAddress, key in rows:
+                keyHash = Db.storeKey(cursor, key)
+                cursor.execute("UPDATE correspondents SET key_hash = ? WHERE email_address = ?", (keyHash, emailAddress))
+            cursor.execute("""
+                CREATE TABLE correspondents_new (
+                    email_address TEXT PRIMARY KEY,
+                    red_herring_sent INTEGER DEFAULT -1,
+                    last_reply INTEGER DEFAULT -1,
+                    key_hash TEXT DEFAULT NULL REFERENCES keys (hash))""")
+            cursor.execute("""
+                INSERT INTO correspondents_new (email_address, red_herring_sent, last_reply, key_hash)
+                SELECT email_address, red_herring_sent, last_reply, key_hash FROM correspondents""")
+            cursor.execute("DROP TABLE correspondents")
+            cursor.execute("ALTER TABLE correspondents_new RENAME TO correspondents")
+            logging.info("EmailSecChal: db: Moved the keys of %d correspondents into the keys DB table" % len(rows))
+        cursor.execute("CREATE INDEX IF NOT EXISTS correspondents_key_hash ON correspondents (key_hash)")
+    
+    @staticmethod
+    def createCacheGenerationTable(cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS cache_generation (generation INTEGER NOT NULL)")
+        cursor.execute("INSERT INTO cache_generation (generation) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM cache_generation)")
+    
+    # Armored keys are stored in binary if they can be armored back to the same text, compressed if that makes them smaller.
+    @staticmethod
+    def encodeKey(key):
+        data = key.encode("utf-8")
+        armorType = None
+        match = email_sec_chal.openpgp.armorRe.search(key)
+        if match is not None:
+            try:
+                binaryData = email_sec_chal.openpgp.dearmor(key, False)     # Armoring it back checks it.
+                if email_sec_chal.openpgp.armor(binaryData, match.group(1)) == key:
+                    data, armorType = binaryData, match.group(1)
+            except email_sec_chal.PgpException:
+                pass
+        keyHash = hashlib.sha256(data).hexdigest()
+        compressed = False
+        if email_sec_chal.dbCompressKeys:
+            compressedData = zlib.compress(data, 9)
+            if len(compressedData) < len(data):
+                data, compressed = compressedData, True
+        return keyHash, data, armorType, compressed
+    
+    @staticmethod
+    def decodeKey(data, armorType, compressed):
+        data = bytes(data)
+        if compressed:
+            data = zlib.decompress(data)
+        if armorType is not None:
+            return email_sec_chal.openpgp.armor(data, armorType)
+        return data.decode("utf-8")
+    
+    # Returns the hash of the key, which is stored only once however many correspondents use it.
+    @staticmethod
+    def storeKey(cursor, key):
+        keyHash, data, armorType, compressed = Db.encodeKey(key)
+        cursor.execute("INSERT OR IGNORE INTO keys (hash, data, armor_type, compressed) VALUES(?, ?, ?, ?)", (keyHash, data, armorType, int(compressed)))
+        return keyHash
+
+    @staticmethod
+    def clearCache():
+        with Db.cacheLock:
+            Db.correspondentCache.clear()
+            Db.keyCache.clear()
+            Db.cacheWriteCount += 1
+            Db.cacheGeneration = None
+            Db.nextGenerationCheckTime = 0
+    
+    # The caller holds cacheLock. The least recently used entries are evicted.
+    @staticmethod
+    def putInCache(cache, maxSize, name, value):
+        cache[name] = value
+        cache.move_to_end(name)
+        while len(cache) > maxSize:
+            cache.popitem(last=False)
 
     def __init__(self):
         Db.staticInit()
-        self.conn = Db.createDbConnection()
+        self.conn = Db.getConnection()
+    
+    # Takes the write lock right away, so that what is read inside the transaction is still valid when it is written.
+    # Inside another transaction, it is part of that one. The correspondent rows written in the transaction are only
+    # seen by the transaction until it is committed, then they go into the shared cache.
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.conn.in_transaction:
+            yield
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        Db.threadLocal.transactionRows = {}
+        Db.threadLocal.cacheUpdates = []
+        Db.threadLocal.generationChecked = False
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            with Db.cacheLock:
+                Db.clearCorrespondentCache(None)    # The generation may have been read from the transaction.
+            raise
+        else:
+            self.conn.execute("COMMIT")
+            Db.updateCache(Db.threadLocal.cacheUpdates)
+        finally:
+            Db.threadLocal.transactionRows = None
+            Db.threadLocal.cacheUpdates = None
         
     def getCorrespondentsCount(self):
         cursor = self.conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM correspondents")
         return cursor.fetchone()[0]
-        
-    def correspondentExists(self, emailAddress):
+    
+    # The (key hash, red herring sent, last reply) row of the correspondent, None if there is no such correspondent.
+    def getCorrespondentState(self, emailAddress):
         emailAddress = emailAddress.lower()
+        transactionRows = Db.getTransactionRows(self.conn)
+        if transactionRows is not None and emailAddress in transactionRows:
+            return transactionRows[emailAddress]
         cursor = self.conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM correspondents WHERE email_address = ?", (emailAddress, ))
-        count = cursor.fetchone()[0]
-        return count > 0
+        if self.isGenerationCheckDue(transactionRows is not None):
+            cursor.execute("SELECT generation FROM cache_generation")
+            generation = cursor.fetchone()[0]
+            with Db.cacheLock:
+                if generation != Db.cacheGeneration:
+                    Db.clearCorrespondentCache(generation)
+        with Db.cacheLock:
+            if emailAddress in Db.correspondentCache:
+                Db.correspondentCache.move_to_end(emailAddress)
+                return Db.correspondentCache[emailAddress]
+            writeCount = Db.cacheWriteCount
+        cursor.execute("SELECT key_hash, red_herring_sent, last_reply FROM correspondents WHERE email_address = ?", (emailAddress, ))
+        state = cursor.fetchone()
+        with Db.cacheLock:
+            # A write in the meantime may have made what was just read stale.
+            if writeCount == Db.cacheWriteCount:
+                Db.putInCache(Db.correspondentCache, email_sec_chal.dbCorrespondentCacheSize, emailAddress, state)
+        return state
+    
+    # The rows written in the current transaction of the connection, None outside of transaction().
+    @staticmethod
+    def getTransactionRows(conn):
+        if not conn.in_transaction:
+            return None
+        return getattr(Db.threadLocal, "transactionRows", None)
+    
+    # No other process writes while a transaction holds the DB lock, so the generation is read once per transaction.
+    def isGenerationCheckDue(self, inTransaction):
+        if inTransaction:
+            if Db.threadLocal.generationChecked:
+                return False
+            Db.threadLocal.generationChecked = True
+            return True
+        now = time.monotonic()
+        with Db.cacheLock:
+            if now < Db.nextGenerationCheckTime:
+                return False
+            Db.nextGenerationCheckTime = now + Db.generationCheckIntervalSec
+        return True
+    
+    # The caller holds cacheLock. Keys never change, so only the correspondents are cleared.
+    @staticmethod
+    def clearCorrespondentCache(generation):
+        Db.correspondentCache.clear()
+        Db.cacheWriteCount += 1
+        Db.cacheGeneration = generation
+    
+    # Called in the transaction of every write to correspondents, returns the new generation.
+    def incrementCacheGeneration(self, cursor):
+        cursor.execute("UPDATE cache_generation SET generation = generation + 1 RETURNING generation")
+        return cursor.fetchone()[0]
+    
+    # Called in the transaction of every write to correspondents, with the generation it set and, for each address, the
+    # rows it returned: the correspondent row as it is now in the DB, or none if the row did not change.
+    def correspondentsWritten(self, generation, writtenRows):
+        transactionRows = Db.getTransactionRows(self.conn)
+        for emailAddress, rows in writtenRows.items():
+            for row in rows:
+                transactionRows[emailAddress] = tuple(row)
+        Db.threadLocal.cacheUpdates.append((generation, writtenRows))
+    
+    # Called with writeLock held once the outermost transaction is committed, with what correspondentsWritten() got.
+    @staticmethod
+    def updateCache(cacheUpdates):
+        with Db.cacheLock:
+            for generation, writtenRows in cacheUpdates:
+                if Db.cacheGeneration is None or generation != Db.cacheGeneration + 1:
+                    Db.clearCorrespondentCache(generation)     # Another process wrote in the meantime.
+                Db.cacheGeneration = generation
+                Db.cacheWriteCount += 1
+                for emailAddress, rows in writtenRows.items():
+                    for row in rows:
+                        Db.putInCache(Db.correspondentCache, email_sec_chal.dbCorrespondentCacheSize, emailAddress, tuple(row))
+        
+    def correspondentExists(self, emailAddress):
+        return self.getCorrespondentState(emailAddress) is not None
             
     def getCorrespondentKey(self, emailAddress):
-        emailAddress = emailAddress.lower()
+        state = self.getCorrespondentState(emailAddress)
+        if state is not None and state[0] is not None:
+            return self.getKey(state[0])
+        return None
+    
+    # Keys never change under their hash, so they can be cached without being invalidated.
+    def getKey(self, keyHash):
+        with Db.cacheLock:
+            if keyHash in Db.keyCache:
+                Db.keyCache.move_to_end(keyHash)
+                return Db.keyCache[keyHash]
         cursor = self.conn.cursor()
-        cursor.execute("SELECT key FROM correspondents WHERE email_address = ?", (emailAddress, ))
+        cursor.execute("SELECT data, armor_type, compressed FROM keys WHERE hash = ?", (keyHash, ))
         row = cursor.fetchone()
-        if row is not None:
-            return row[0]
-        return None
+        if row is None:
+            return None
+        key = Db.decodeKey(*row)
+        with Db.cacheLock:
+            Db.putInCache(Db.keyCache, Db.maxKeyCacheSize, keyHash, key)
+        return key
+    
+    def getKeysCount(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM keys")
+        return cursor.fetchone()[0]
     
     def setCorrespondentKey(self, emailAddress, key):
-        emailAddress = emailAddress.lower()
+        return self.setCorrespondentKeys([emailAddress], key)
+    
+    # Sets the key of all the addresses in one transaction, so they all change together. Returns the keys it replaced.
+    def setCorrespondentKeys(self, emailAddresses, key):
+        oldKeys = set()
+        oldKeyHashes = set()
+        writtenRows = {}
         cursor = self.conn.cursor()
-        if not self.correspondentExists(emailAddress):
-            cursor.execute("INSERT INTO correspondents (email_address, key, red_herring_sent) VALUES(?, ?, ?)", (emailAddress, key, -1))
-            logging.debug("EmailSecChal: db: Added a new correspondent key in the DB for %s" % emailAddress)
-        else:
-            cursor.execute("UPDATE correspondents SET key = ?, red_herring_sent = -1 WHERE email_address = ?", (key, emailAddress))
-            logging.debug("EmailSecChal: db: Updated the correspondent key in the DB for %s" % emailAddress)
+        with Db.writeLock:
+            with self.transaction():
+                keyHash = Db.storeKey(cursor, key)
+                for emailAddress in emailAddresses:
+                    emailAddress = emailAddress.lower()
+                    # From the DB rather than the cache, a key missed here would stay in the keys table for good.
+                    cursor.execute("SELECT key_hash FROM correspondents WHERE email_address = ?", (emailAddress, ))
+                    row = cursor.fetchone()
+                    if row is not None and row[0] is not None and row[0] != keyHash:
+                        oldKeys.add(self.getKey(row[0]))
+                        oldKeyHashes.add(row[0])
+                    cursor.execute("""
+                        INSERT INTO correspondents (email_address, key_hash, red_herring_sent) VALUES(?, ?, -1)
+                        ON CONFLICT (email_address) DO UPDATE SET key_hash = excluded.key_hash, red_herring_sent = -1
+                        RETURNING key_hash, red_herring_sent, last_reply""", (emailAddress, keyHash))
+                    writtenRows[emailAddress] = cursor.fetchall()
+                generation = self.incrementCacheGeneration(cursor)
+                # The keys no correspondent uses any more, the new one too if there was no address.
+                for candidateKeyHash in oldKeyHashes | {keyHash}:
+                    cursor.execute("DELETE FROM keys WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM correspondents WHERE key_hash = ?)", (candidateKeyHash, candidateKeyHash))
+                self.correspondentsWritten(generation, writtenRows)
+        logging.debug("EmailSecChal: db: Set the correspondent key in the DB for %s" % ", ".join(emailAddresses))
+        oldKeys.discard(None)
+        return oldKeys
 
     def getRedHerringSentTimestamp(self, emailAddress):
-        emailAddress = emailAddress.lower()
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT red_herring_sent FROM correspondents WHERE email_address = ?", (emailAddress, ))
-        row = cursor.fetchone()
-        if row is not None:
-            return row[0]
+        state = self.getCorrespondentState(emailAddress)
+        if state is not None:
+            return state[1]
         return -1
     
     def redHerringSent(self, emailAddress):
         emailAddress = emailAddress.lower()
         cursor = self.conn.cursor()
-        if not self.correspondentExists(emailAddress):
-            cursor.execute("INSERT INTO correspondents (email_address, red_herring_sent) VALUES(?, ?)", (emailAddress, self.getCurrentTimestamp()))
-        else:
-            cursor.execute("UPDATE correspondents SET red_herring_sent = ? WHERE email_address = ? AND NOT red_herring_sent >= 0", (self.getCurrentTimestamp(), emailAddress))
+        with Db.writeLock:
+            with self.transaction():
+                cursor.execute("""
+                    INSERT INTO correspondents (email_address, red_herring_sent) VALUES(?, ?)
+                    ON CONFLICT (email_address) DO UPDATE SET red_herring_sent = excluded.red_herring_sent WHERE NOT correspondents.red_herring_sent >= 0
+                    RETURNING key_hash, red_herring_sent, last_reply""", (emailAddress, self.getCurrentTimestamp()))
+                rows = cursor.fetchall()
+                generation = self.incrementCacheGeneration(cursor)
+                self.correspondentsWritten(generation, {emailAddress: rows})
         logging.debug("EmailSecChal: db: Set red herring as sent in DB for %s" % emailAddress)
         
+    def getLastReplyTimestamp(self, emailAddress):
+        state = self.getCorrespondentState(emailAddress)
+        if state is not None:
+            return state[2]
+        return -1
+    
+    def replySent(self, emailAddress):
+        emailAddress = emailAddress.lower()
+        cursor = self.conn.cursor()
+        with Db.writeLock:
+            with self.transaction():
+                cursor.execute("""
+                    INSERT INTO correspondents (email_address, last_reply) VALUES(?, ?)
+                    ON CONFLICT (email_address) DO UPDATE SET last_reply = excluded.last_reply
+                    RETURNING key_hash, red_herring_sent, last_reply""", (emailAddress, self.getCurrentTimestamp()))
+                rows = cursor.fetchall()
+                generation = self.incrementCacheGeneration(cursor)
+                self.correspondentsWritten(generation, {emailAddress: rows})
+        logging.debug("EmailSecChal: db: Set the last reply time in DB for %s" % emailAddress)
+    
+    # Whether a request would be coalesced with the last reply to the correspondent.
+    def isInCoalescingWindow(self, emailAddress):
+        if email_sec_chal.coalescingWindowSec <= 0:
+            return False
+        lastReplyTimestamp = self.getLastReplyTimestamp(emailAddress)
+        return lastReplyTimestamp >= 0 and self.getCurrentTimestamp() < lastReplyTimestamp + email_sec_chal.coalescingWindowSec
+    
+    # Runs decide() and records the reply it decides on in one transaction, so that of several bot processes deciding
+    # on a reply to the same correspondent, only the first one sees no earlier reply. decide() returns whether the
+    # impostor bot replies, or None for no reply. Returns that and what cancelReply() needs if the reply is not sent.
+    def reserveReply(self, emailAddress, decide):
+        with Db.writeLock:
+            with self.transaction():
+                oldState = self.getCorrespondentState(emailAddress)
+                asImpostor = decide()
+                if asImpostor is None:
+                    return None, None
+                self.replySent(emailAddress)
+                if asImpostor:
+                    self.redHerringSent(emailAddress)
+                newState = self.getCorrespondentState(emailAddress)
+        return asImpostor, (oldState, newState)
+    
+    # Restores the red herring and last reply times from before reserveReply(), unless they changed since.
+    def cancelReply(self, emailAddress, reservation):
+        emailAddress = emailAddress.lower()
+        oldState, newState = reservation
+        oldState = oldState if oldState is not None else (None, -1, -1)
+        cursor = self.conn.cursor()
+        with Db.writeLock:
+            with self.transaction():
+                cursor.execute("""
+                    UPDATE correspondents SET red_herring_sent = ?, last_reply = ?
+                    WHERE email_address = ? AND red_herring_sent = ? AND last_reply = ?
+                    RETURNING key_hash, red_herring_sent, last_reply""", (oldState[1], oldState[2], emailAddress, newState[1], newState[2]))
+                rows = cursor.fetchall()
+                generation = self.incrementCacheGeneration(cursor)
+                self.correspondentsWritten(generation, {emailAddress: rows})
+        logging.debug("EmailSecChal: db: Cancelled the reply in DB for %s" % emailAddress)
+    
+    def getRateLimitBucket(self, name):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT tokens, updated FROM rate_limit_buckets WHERE name = ?", (name, ))
+        return cursor.fetchone()
+    
+    def setRateLimitBucket(self, name, tokens, updated):
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO rate_limit_buckets (name, tokens, updated) VALUES(?, ?, ?)", (name, tokens, updated))
+        
+    def isMessageSeen(self, dedupKey):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM seen_messages WHERE dedup_key = ? AND seen > ?", (dedupKey, time.time() - email_sec_chal.dedupTtlSec))
+        return cursor.fetchone()[0] > 0
+    
+    # Evicting scans the index, so it is done once in a while rather than for every message.
+    def messageSeen(self, dedupKey):
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO seen_messages (dedup_key, seen) VALUES(?, ?)", (dedupKey, now))
+        if now >= Db.nextSeenMessagesEvictionTime:
+            Db.nextSeenMessagesEvictionTime = now + Db.seenMessagesEvictionIntervalSec
+            self.evictSeenMessages(now)
+    
+    # Evicts the expired entries and the oldest ones above dedupMaxEntries.
+    def evictSeenMessages(self, now=None):
+        now = now if now is not None else time.time()
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM seen_messages WHERE seen <= ?", (now - email_sec_chal.dedupTtlSec, ))
+        cursor.execute("DELETE FROM seen_messages WHERE dedup_key IN (SELECT dedup_key FROM seen_messages ORDER BY seen DESC LIMIT -1 OFFSET ?)", (email_sec_chal.dedupMaxEntries, ))
+    
+    def getSeenMessagesCount(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM seen_messages")
+        return cursor.fetchone()[0]
+        
     def getCurrentTimestamp(self):
         return int(time.time())
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+
+
+
+# Runs tasks on a fixed set of worker threads. Tasks with the same key run one at a time in the order of submission,
+# tasks with different keys run in parallel.
+class Dispatcher:
+
+    workerCount = 0
+    workers = None
+    condition = None
+    pendingTasks = None
+    activeKeys = None
+    closed = False
+
+
+    def __init__(self, workerCount_=0):
+        self.workerCount = workerCount_ if workerCount_ > 0 else (os.cpu_count() or 1)
+        self.condition = threading.Condition()
+        self.pendingTasks = collections.deque()
+        self.activeKeys = set()
+        self.closed = False
+        self.workers = []
+        for i in range(self.workerCount):
+            worker = threading.Thread(target=self.work, name="dispatcher-%d" % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        logging.debug("EmailSecChal: dispatcher: Started %d workers" % self.workerCount)
+
+    def submit(self, key, function, *args):
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.closed:
+                raise email_sec_chal.EmailSecChalException("The dispatcher is closed.")
+            self.pendingTasks.append((key, future, function, args))
+            self.condition.notify_all()
+        return future
+
+    # Must be called with the lock held.
+    def takeTask(self):
+        for task in self.pendingTasks:
+            if task[0] not in self.activeKeys:
+                self.pendingTasks.remove(task)
+                self.activeKeys.add(task[0])
+                self.condition.notify_all()     # For waitForPendingCount().
+                return task
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                task = self.takeTask()
+                while task is None:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    task = self.takeTask()
+            key, future, function, args = task
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.activeKeys.discard(key)
+                    self.condition.notify_all()
+
+    def getPendingCount(self):
+        with self.condition:
+            return len(self.pendingTasks)
+
+    # Waits until fewer than maxCount tasks wait for a worker, returns False on timeout.
+    def waitForPendingCount(self, maxCount, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.closed or len(self.pendingTasks) < maxCount, timeout)
+
+    # Waits until all the submitted tasks are done, returns False on timeout.
+    def join(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pendingTasks and not self.activeKeys, timeout)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            for _, future, _, _ in self.pendingTasks:
+                future.cancel()
+            self.pendingTasks.clear()
+            self.condition.notify_all()
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join()
@@ -12,3 +12,6 @@ class MsgException(EmailSecChalException):
 
 class PgpException(EmailSecChalException):
     pass
+
+class UnsupportedOperationException(PgpException):
+    pass
@@ -160,23 +160,19 @@ class PgpMimeIncomingMessage(IncomingMessage):
             self.encrypted = True
             encryptedPayload = self.originalMessage.get_payload(1).get_payload()
 
-            decryptedResult = self.pgp.impostorGpg.decrypt(encryptedPayload.encode())
-            if decryptedResult:
+            decryptedResult, self.forImpostor = email_sec_chal.CryptoExecutor.run(self.pgp.decrypt, encryptedPayload.encode())
+            if not decryptedResult:
+                logging.warning("EmailSecChal: incoming_message: PGP/MIME message from %s (%s) could not be decrypted:\n%s" % \
+                    (self.emailAddress, self.id, email_sec_chal.Pgp.getDecryptionError(decryptedResult)))
+                self.signedAndVerified = False
+                self.plainMessage = email.mime.multipart.MIMEMultipart()
+                return
+            if self.forImpostor:
                 logging.warning("EmailSecChal: incoming_message: PGP/MIME message from %s (%s) was decrypted by the impostor bot's key" % \
                     (self.emailAddress, self.id))
-                self.forImpostor = True
             else:
-                decryptedResult = self.pgp.officialGpg.decrypt(encryptedPayload.encode())
-                if decryptedResult:
-                    logging.debug("EmailSecChal: incoming_message: PGP/MIME message from %s (%s) was decrypted by the official bot's key" % \
-                        (self.emailAddress, self.id))
-                    self.forImpostor = False
-                else:
-                    logging.warning("EmailSecChal: incoming_message: PGP/MIME message from %s (%s) could not be decrypted:\n%s" % \
-                        (self.emailAddress, self.id, decryptedResult.stderr))
-                    self.signedAndVerified = False
-                    self.plainMessage = email.mime.multipart.MIMEMultipart()
-                    return
+                logging.debug("EmailSecChal: incoming_message: PGP/MIME message from %s (%s) was decrypted by the official bot's key" % \
+                    (self.emailAddress, self.id))
                 
             self.signedAndVerified = decryptedResult.valid
             self.plainMessage = email.message_from_bytes(decryptedResult.data)
@@ -187,7 +183,7 @@ class PgpMimeIncomingMessage(IncomingMessage):
         if self.isSigned():
             signature = self.plainMessage.get_payload(1).get_payload()
             self.plainMessage = self.plainMessage.get_payload(0)
-            verifiedResult = self.pgp.verifyMessageWithDetachedSignature(self.plainMessage, signature)
+            verifiedResult = email_sec_chal.CryptoExecutor.run(self.pgp.verifyMessageWithDetachedSignature, self.plainMessage, signature)
             self.signedAndVerified = verifiedResult.valid
             
         logging.debug("EmailSecChal: incoming_message: PGP/MIME message from %s (%s) is %s and %s" % \
@@ -234,21 +230,17 @@ class PgpInlineIncomingMessage(IncomingMessage):
         if self.isEncrypted(plainText):
             msgPart.encrypted = True
             
-            decryptedResult = self.pgp.impostorGpg.decrypt(plainText.encode())
-            if decryptedResult:
+            decryptedResult, msgPart.forImpostor = email_sec_chal.CryptoExecutor.run(self.pgp.decrypt, plainText.encode())
+            if not decryptedResult:
+                logging.warning("EmailSecChal: incoming_message: Inline PGP message from %s (%s) has a message part that could not be decrypted:\n%s" % \
+                    (self.emailAddress, self.id, email_sec_chal.Pgp.getDecryptionError(decryptedResult)))
+                return None
+            if msgPart.forImpostor:
                 logging.warning("EmailSecChal: incoming_message: Inline PGP  message from %s (%s) has a message part that was decrypted by the impostor bot's key" % \
                     (self.emailAddress, self.id))
-                msgPart.forImpostor = True
             else:
-                decryptedResult = self.pgp.officialGpg.decrypt(plainText.encode())
-                if decryptedResult:
-                    logging.debug("EmailSecChal: incoming_message: Inline PGP message from %s (%s) has a message part that was decrypted by the official bot's key" % \
-                        (self.emailAddress, self.id))
-                    msgPart.forImpostor = False
-                else:
-                    logging.warning("EmailSecChal: incoming_message: Inline PGP message from %s (%s) has a message part that could not be decrypted:\n%s" % \
-                        (self.emailAddress, self.id, decryptedResult.stderr))
-                    return None
+                logging.debug("EmailSecChal: incoming_message: Inline PGP message from %s (%s) has a message part that was decrypted by the official bot's key" % \
+                    (self.emailAddress, self.id))
 
             msgPart.signedAndVerified = decryptedResult.valid
             msgPart.plainText = str(decryptedResult.data, "utf-8", "ignore")
@@ -264,7 +256,7 @@ class PgpInlineIncomingMessage(IncomingMessage):
                 logging.debug("EmailSecChal: incoming_message: Inline PGP message from %s (%s) has a message part that has been signed and encrypted in two separate steps" % \
                     (self.emailAddress, self.id))
             
-            decryptedResult = self.pgp.officialGpg.decrypt(plainText.encode())
+            decryptedResult = email_sec_chal.CryptoExecutor.run(self.pgp.verifyInline, plainText.encode())
             msgPart.signedAndVerified = decryptedResult.valid
             msgPart.plainText = str(decryptedResult.data, "utf-8", "ignore")
             
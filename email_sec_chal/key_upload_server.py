@@ -37,17 +37,18 @@ class KeyUploadRequestHandler(http.server.BaseHTTPRequestHandler):
         KeyUploadRequestHandler.rootFSPath = os.path.normcase(KeyUploadRequestHandler.rootFSPath)
         logging.debug("EmailSecChal: key_upload_server: The root file system path is: %s" % KeyUploadRequestHandler.rootFSPath)
         
-        with email_sec_chal.Pgp() as pgp:
-            KeyUploadRequestHandler.officialBotPublicKey = pgp.getOfficialPublicKey()
-            KeyUploadRequestHandler.officialBotPublicKeyFileTime = os.stat(email_sec_chal.Pgp.officialBotKeysFilePath).st_mtime
-            officialBotPublicKeyFileName = email_sec_chal.Pgp.botEmailAddress + " pub.asc"
-            logging.debug("EmailSecChal: key_upload_server: The official bot's public key file name is: %s" % officialBotPublicKeyFileName)
-            KeyUploadRequestHandler.officialBotKeyFingerprint = pgp.officialFingerprints[0]
-        
-            KeyUploadRequestHandler.officialBotPublicKeyVirtualFilePaths.append(os.path.join(KeyUploadRequestHandler.rootFSPath, officialBotPublicKeyFileName))
-            KeyUploadRequestHandler.officialBotPublicKeyVirtualFilePaths.append(os.path.join(KeyUploadRequestHandler.rootFSPath, officialBotPublicKeyFileName + ".txt"))
-            
-            KeyUploadRequestHandler.impostorBotKeyFingerprint = pgp.impostorFingerprints[0]
+        email_sec_chal.Pgp.staticInit()
+        officialIdentity = email_sec_chal.BotIdentity.get("official")
+        KeyUploadRequestHandler.officialBotPublicKey = officialIdentity.publicKey
+        KeyUploadRequestHandler.officialBotPublicKeyFileTime = officialIdentity.keysFileTime
+        officialBotPublicKeyFileName = email_sec_chal.Pgp.botEmailAddress + " pub.asc"
+        logging.debug("EmailSecChal: key_upload_server: The official bot's public key file name is: %s" % officialBotPublicKeyFileName)
+        KeyUploadRequestHandler.officialBotKeyFingerprint = officialIdentity.fingerprints[0]
+        
+        KeyUploadRequestHandler.officialBotPublicKeyVirtualFilePaths.append(os.path.join(KeyUploadRequestHandler.rootFSPath, officialBotPublicKeyFileName))
+        KeyUploadRequestHandler.officialBotPublicKeyVirtualFilePaths.append(os.path.join(KeyUploadRequestHandler.rootFSPath, officialBotPublicKeyFileName + ".txt"))
+        
+        KeyUploadRequestHandler.impostorBotKeyFingerprint = email_sec_chal.BotIdentity.get("impostor").fingerprints[0]
         
         logging.debug("EmailSecChal: key_upload_server: Static initialization successful")
         KeyUploadRequestHandler.initialized = True
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+
+
+class BotKeyring:
+
+    botName = None
+    gnupgHomeDir = None
+    backend = None
+    fingerprints = []
+    correspondentKeyHash = None
+    correspondentFingerprints = []
+    lastUsed = 0
+
+
+    def __init__(self, botName_, botKeys):
+        self.botName = botName_
+        self.gnupgHomeDir = email_sec_chal.Workspace.create("pool_" + self.botName + "_")
+        self.backend = email_sec_chal.createCryptoBackend(self.gnupgHomeDir)
+        self.fingerprints = self.backend.importKeys(botKeys)
+        self.correspondentFingerprints = []
+        logging.debug("EmailSecChal: keyring_pool: Created a GPG home directory for the %s bot in %s" % (self.botName, self.gnupgHomeDir))
+
+    def importCorrespondentKey(self, correspondentKey, correspondentKeyHash):
+        self.correspondentFingerprints = self.backend.importKeys(correspondentKey)
+        self.correspondentKeyHash = correspondentKeyHash
+        logging.debug("EmailSecChal: keyring_pool: Imported the correspondent keys %s in %s" % (", ".join(self.correspondentFingerprints), self.gnupgHomeDir))
+
+    # A correspondent key merged into a bot key cannot be removed, the keyring must not be reused then.
+    def removeCorrespondentKey(self):
+        fingerprints = [fingerprint for fingerprint in set(self.correspondentFingerprints) if fingerprint not in self.fingerprints]
+        botKeyTouched = len(fingerprints) < len(set(self.correspondentFingerprints))
+        self.correspondentKeyHash = None
+        self.correspondentFingerprints = []
+        if botKeyTouched:
+            logging.warning("EmailSecChal: keyring_pool: The correspondent keys touched the bot keys in %s" % self.gnupgHomeDir)
+            return False
+        if not fingerprints:
+            return True
+        if not self.backend.deleteKeys(fingerprints):
+            logging.warning("EmailSecChal: keyring_pool: Cannot remove keys %s from %s" % (", ".join(fingerprints), self.gnupgHomeDir))
+            return False
+        logging.debug("EmailSecChal: keyring_pool: Removed keys %s from %s" % (", ".join(fingerprints), self.gnupgHomeDir))
+        return True
+
+    def destroy(self):
+        email_sec_chal.Workspace.remove(self.gnupgHomeDir)
+
+
+
+class KeyringPool:
+
+    size = 0
+    botKeys = None
+    idleKeyrings = None
+    preparedKeyrings = None     # (bot name, correspondent key hash) -> keyrings with that key imported, least recently used first
+    preparedCacheSize = 0
+    preparedCacheIdleSec = 0
+    lock = None
+
+
+    def __init__(self, size_, botKeys_, preparedCacheSize_=0, preparedCacheIdleSec_=0):
+        self.size = size_
+        self.botKeys = botKeys_
+        self.idleKeyrings = {botName: [] for botName in self.botKeys}
+        self.preparedKeyrings = collections.OrderedDict()
+        self.preparedCacheSize = preparedCacheSize_
+        self.preparedCacheIdleSec = preparedCacheIdleSec_
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getKeyHash(correspondentKey):
+        if isinstance(correspondentKey, str):
+            correspondentKey = correspondentKey.encode()
+        return hashlib.sha256(correspondentKey).hexdigest()
+
+    def warmUp(self):
+        for botName in self.botKeys:
+            keyrings = [BotKeyring(botName, self.botKeys[botName]) for _ in range(self.size - self.getIdleCount(botName))]
+            with self.lock:
+                self.idleKeyrings[botName].extend(keyrings)
+        logging.info("EmailSecChal: keyring_pool: Warmed up %d keyrings per bot" % self.size)
+
+    def getIdleCount(self, botName):
+        with self.lock:
+            return len(self.idleKeyrings[botName])
+
+    def getPreparedCount(self):
+        with self.lock:
+            return sum(len(keyrings) for keyrings in self.preparedKeyrings.values())
+
+    def acquire(self, botName, correspondentKey=None):
+        correspondentKeyHash = KeyringPool.getKeyHash(correspondentKey) if correspondentKey is not None else None
+        keyring = None
+        with self.lock:
+            evictedKeyrings = self.getEvictedKeyrings()
+            preparedKeyrings = self.preparedKeyrings.get((botName, correspondentKeyHash))
+            if preparedKeyrings:
+                keyring = preparedKeyrings.pop()
+                if not preparedKeyrings:
+                    del self.preparedKeyrings[(botName, correspondentKeyHash)]
+                logging.debug("EmailSecChal: keyring_pool: Checked out the prepared %s bot keyring in %s" % (botName, keyring.gnupgHomeDir))
+        for evictedKeyring in evictedKeyrings:
+            self.returnToIdle(evictedKeyring)
+        if keyring is not None:
+            return keyring
+
+        with self.lock:
+            if self.idleKeyrings[botName]:
+                keyring = self.idleKeyrings[botName].pop()
+                logging.debug("EmailSecChal: keyring_pool: Checked out the %s bot keyring in %s" % (botName, keyring.gnupgHomeDir))
+        if keyring is None:
+            keyring = BotKeyring(botName, self.botKeys[botName])
+        if correspondentKey is not None:
+            try:
+                keyring.importCorrespondentKey(correspondentKey, correspondentKeyHash)
+            except BaseException:
+                keyring.destroy()       # It may hold part of the key.
+                raise
+        return keyring
+
+    def release(self, keyring):
+        keyring.lastUsed = time.monotonic()
+        evictedKeyrings = []
+        with self.lock:
+            if keyring.correspondentKeyHash is not None and self.preparedCacheSize > 0:
+                preparedKey = (keyring.botName, keyring.correspondentKeyHash)
+                self.preparedKeyrings.setdefault(preparedKey, []).append(keyring)
+                self.preparedKeyrings.move_to_end(preparedKey)
+                evictedKeyrings = self.getEvictedKeyrings()
+                keyring = None
+        for evictedKeyring in evictedKeyrings:
+            self.returnToIdle(evictedKeyring)
+        if keyring is not None:
+            self.returnToIdle(keyring)
+
+    # Must be called with the lock held.
+    def getEvictedKeyrings(self):
+        evictedKeyrings = []
+        preparedCount = sum(len(keyrings) for keyrings in self.preparedKeyrings.values())
+        idleThreshold = time.monotonic() - self.preparedCacheIdleSec
+        while self.preparedKeyrings:
+            preparedKey, keyrings = next(iter(self.preparedKeyrings.items()))
+            if preparedCount <= self.preparedCacheSize and (self.preparedCacheIdleSec <= 0 or keyrings[-1].lastUsed >= idleThreshold):
+                break
+            del self.preparedKeyrings[preparedKey]
+            preparedCount -= len(keyrings)
+            evictedKeyrings.extend(keyrings)
+        if evictedKeyrings:
+            logging.debug("EmailSecChal: keyring_pool: Evicted %d prepared keyrings" % len(evictedKeyrings))
+        return evictedKeyrings
+
+    def returnToIdle(self, keyring):
+        if keyring.removeCorrespondentKey():
+            with self.lock:
+                idleKeyrings = self.idleKeyrings[keyring.botName]
+                if len(idleKeyrings) < self.size:
+                    idleKeyrings.append(keyring)
+                    logging.debug("EmailSecChal: keyring_pool: Returned the %s bot keyring in %s" % (keyring.botName, keyring.gnupgHomeDir))
+                    return
+        keyring.destroy()
+
+    def invalidate(self, correspondentKey):
+        correspondentKeyHash = KeyringPool.getKeyHash(correspondentKey)
+        evictedKeyrings = []
+        with self.lock:
+            for preparedKey in [preparedKey for preparedKey in self.preparedKeyrings if preparedKey[1] == correspondentKeyHash]:
+                evictedKeyrings.extend(self.preparedKeyrings.pop(preparedKey))
+        for evictedKeyring in evictedKeyrings:
+            self.returnToIdle(evictedKeyring)
+        if evictedKeyrings:
+            logging.debug("EmailSecChal: keyring_pool: Invalidated %d prepared keyrings" % len(evictedKeyrings))
+
+    def close(self):
+        with self.lock:
+            keyrings = [keyring for idleKeyrings in self.idleKeyrings.values() for keyring in idleKeyrings]
+            keyrings += [keyring for preparedKeyrings in self.preparedKeyrings.values() for keyring in preparedKeyrings]
+            for idleKeyrings in self.idleKeyrings.values():
+                idleKeyrings.clear()
+            self.preparedKeyrings.clear()
+        for keyring in keyrings:
+            keyring.destroy()
@@ -1,81 +1,275 @@
 # -*- coding: utf-8 -*-
-import mailbox
-import time
+import os.path
 import email_sec_chal
+import itertools
 import logging
+import mailbox
+import threading
+import time
 
 
 
 class MailBot:
     
     mbox = None
-    db = None
-    failedMessagesKeys = None
+    watcher = None
+    dispatcher = None
+    threadLocal = None
+    triage = None
+    rateLimiter = None
+    listener = None
+    deliveredCounter = None
+    claimLimited = False        # Whether the last claimMessages() left messages in the Maildir.
 
     
+    def getMaildirPath(self):
+        return os.path.expanduser("~/Maildir")
+    
     def getMailbox(self):
-        return mailbox.Maildir("~/Maildir", factory = mailbox.MaildirMessage)
+        processingDir = os.path.join(self.getMaildirPath(), "processing", email_sec_chal.instanceName)
+        return email_sec_chal.ClaimingMaildir(self.getMaildirPath(), processingDir)
+    
+    def createWatcher(self):
+        return email_sec_chal.createMaildirWatcher(self.getMaildirPath())
+    
+    # Each worker thread has its own DB connection.
+    def getDb(self):
+        db = getattr(self.threadLocal, "db", None)
+        if db is None:
+            db = email_sec_chal.Db()
+            self.threadLocal.db = db
+        return db
     
     def run(self):
+        self.threadLocal = threading.local()
+        self.triage = email_sec_chal.Triage()
+        self.rateLimiter = email_sec_chal.RateLimiter()
+        email_sec_chal.Db.staticInit()      # Before the workers, which would race to do it.
+        email_sec_chal.Pgp.staticInit()
+        email_sec_chal.CryptoExecutor.staticInit()
+        if email_sec_chal.mailListener == "none":
+            self.runMaildir()
+        else:
+            self.runListener()
+    
+    def runMaildir(self):
         self.mbox = self.getMailbox()
-        self.db = email_sec_chal.Db()
-        self.failedMessagesKeys = set()
+        self.mbox.recover()
+        self.watcher = self.createWatcher()
+        self.dispatcher = email_sec_chal.Dispatcher(email_sec_chal.dispatcherWorkerCount)
 
-        logging.info("EmailSecChal: mail_bot: Successfully started")
+        logging.info("EmailSecChal: mail_bot: Successfully started with %d workers" % self.dispatcher.workerCount)
         
-        while True:
-            time.sleep(1)
-            
-            self.mbox.lock()
-            try:
-                for msgKey in self.mbox.iterkeys():
-                    if msgKey in self.failedMessagesKeys:
-                        logging.debug("EmailSecChal: mail_bot: Skipping previously failed message with key %s" % msgKey)
-                        continue
-                    origMsg = self.mbox[msgKey]
-                    
-                    try:
-                        with email_sec_chal.IncomingMessage.create(origMsg) as incomingMsg:
-                        
-                            if incomingMsg.emailAddress == email_sec_chal.Pgp.botEmailAddress:
-                                logging.warning("EmailSecChal: mail_bot: Ignoring spoofed message from myself (%s)" % incomingMsg.id)
-                            else:
-                                msgRecipientsEmailAddresses = email_sec_chal.util.getMessageRecipientsEmailAddresses(origMsg)
-                                if email_sec_chal.Pgp.botEmailAddress in msgRecipientsEmailAddresses:
-                                    self.processRequestMessage(incomingMsg)
-                                
-                    except Exception:
-                        logging.exception("EmailSecChal: mail_bot: Failed processing message %s" % msgKey)
-                        self.failedMessagesKeys.add(msgKey)
-                        
-                    if msgKey not in self.failedMessagesKeys:    
-                        self.mbox.discard(msgKey)
-                        
-            finally:            
-                self.mbox.unlock()
+        try:
+            while True:
+                msgCount = self.processMailbox()
+                self.watcher.processed(msgCount)
+                if self.claimLimited:
+                    # The Maildir may hold more messages, they are claimed as soon as a worker takes one of ours.
+                    self.dispatcher.waitForPendingCount(email_sec_chal.maildirMaxPending)
+                else:
+                    self.watcher.wait(self.mbox.nextRetryTime)
+        finally:
+            self.dispatcher.join()      # The claimed messages are finished rather than left for recover().
+            self.dispatcher.close()
+            self.watcher.close()
+    
+    # The MTA hands the messages over directly, without going through the Maildir.
+    def runListener(self):
+        self.deliveredCounter = itertools.count()
+        self.dispatcher = email_sec_chal.Dispatcher(email_sec_chal.dispatcherWorkerCount)
+        self.listener = email_sec_chal.createMailListener(self)
+
+        logging.info("EmailSecChal: mail_bot: Successfully started with %d workers" % self.dispatcher.workerCount)
+        
+        try:
+            self.listener.serve_forever()
+        finally:
+            self.listener.server_close()
+            self.dispatcher.close()
+                
+    # The mailbox is locked only while the messages are claimed, not while they are processed.
+    # Failed messages are not in the Maildir anymore, they come back from the quarantine when their retry is due.
+    # At most maxCount messages are claimed from the Maildir, the quarantine waits for the next pass if that limit is hit.
+    def claimMessages(self, maxCount=None):
+        claimedMessages = []
+        self.claimLimited = False
+        self.mbox.lock()
+        try:
+            for msgKey in list(self.mbox.iterkeys()):
+                if maxCount is not None and len(claimedMessages) >= maxCount:
+                    self.claimLimited = True
+                    break
+                claimedMessage = self.mbox.claim(msgKey)
+                if claimedMessage is not None:
+                    claimedMessages.append(claimedMessage)
+            if not self.claimLimited:
+                claimedMessages.extend(self.mbox.claimQuarantined())
+        finally:            
+            self.mbox.unlock()
+        return claimedMessages
                 
+    # Does not wait for the messages, each one is finished by finishMessage() as soon as it is done, so that a slow
+    # message does not hold up the others. Only as many messages are claimed as may wait for a worker.
+    def processMailbox(self):
+        claimedMessages = self.claimMessages(email_sec_chal.maildirMaxPending - self.dispatcher.getPendingCount())
+        
+        for claimedMessage in claimedMessages:
+            # Whatever a message does to the admission, it must not take down the loop with the other messages.
+            try:
+                admitted, retryTime = self.admitMessage(claimedMessage)
+                if admitted:
+                    future = self.submitMessage(claimedMessage)
+            except Exception as e:
+                logging.exception("EmailSecChal: mail_bot: Failed admitting message %s" % claimedMessage.key)
+                self.quarantine(claimedMessage, "%s: %s" % (type(e).__name__, e))
+                continue
+            if not admitted:
+                if retryTime is None:
+                    self.mbox.complete(claimedMessage)
+                else:
+                    self.mbox.defer(claimedMessage, "rate limited", retryTime)
+                continue
+            future.add_done_callback(lambda future, claimedMessage=claimedMessage: self.finishMessage(claimedMessage, future))
+        return len(claimedMessages)
+    
+    # Called on the worker thread once the message is done.
+    def finishMessage(self, claimedMessage, future):
+        try:
+            if future.cancelled():
+                # The bot is stopping, the message stays in the processing directory until recover() requeues it.
+                self.forgetMessage(claimedMessage)
+                return
+            error = future.result()
+            if error is None:
+                self.messageProcessed(claimedMessage)
+                self.mbox.complete(claimedMessage)
+            else:
+                self.quarantine(claimedMessage, error)
+        except Exception:
+            logging.exception("EmailSecChal: mail_bot: Failed finishing message %s" % claimedMessage.key)
+    
+    # Returns whether the message is to be processed now and, if not, when to retry it or None to drop it.
+    # Both checks are done before any crypto work.
+    # An admitted message is in flight for deduplication until messageProcessed() or forgetMessage().
+    def admitMessage(self, claimedMessage):
+        dedupKey = claimedMessage.getDedupKey() if email_sec_chal.dedupTtlSec > 0 else None
+        if not self.triage.accept(claimedMessage.headers, self.getDb(), dedupKey):
+            return False, None
+        try:
+            senderEmailAddress = email_sec_chal.util.getMessageSenderEmailAddress(claimedMessage.headers)
+            retryTime = self.rateLimiter.admit(senderEmailAddress, self.getDb())
+        except Exception:
+            self.forgetMessage(claimedMessage)
+            raise
+        if retryTime is None:
+            return True, None
+        self.forgetMessage(claimedMessage)
+        if email_sec_chal.rateLimitAction == "drop":
+            return False, None
+        return False, min(retryTime, time.time() + email_sec_chal.quarantineMaxDelaySec)
+    
+    def submitMessage(self, claimedMessage):
+        # Messages from the same correspondent are processed in order because of the red herring and the silent period.
+        # That holds within this process only; across bot processes, decideReply() serializes the replies in the DB.
+        senderEmailAddress = email_sec_chal.util.getMessageSenderEmailAddress(claimedMessage.headers)
+        return self.dispatcher.submit(senderEmailAddress, self.processMessage, claimedMessage)
+    
+    def getPendingCount(self):
+        return self.dispatcher.getPendingCount()
+    
+    # Called by the mail listener, returns None on success and the error otherwise.
+    def deliverMessage(self, data):
+        claimedMessage = email_sec_chal.ClaimedMessage("delivered-%d" % next(self.deliveredCounter), mailbox.MaildirMessage(data))
+        admitted, retryTime = self.admitMessage(claimedMessage)
+        if not admitted:
+            return None if retryTime is None else "rate limited"     # The MTA defers it.
+        error = self.submitMessage(claimedMessage).result()
+        if error is None:
+            self.messageProcessed(claimedMessage)
+        else:
+            self.forgetMessage(claimedMessage)      # The MTA retries it.
+        return error
+    
+    def messageProcessed(self, claimedMessage):
+        if claimedMessage.dedupKey is not None:
+            self.getDb().messageSeen(claimedMessage.dedupKey)
+            self.triage.release(claimedMessage.dedupKey)
+    
+    def forgetMessage(self, claimedMessage):
+        if claimedMessage.dedupKey is not None:
+            self.triage.release(claimedMessage.dedupKey)
+    
+    def quarantine(self, claimedMessage, error):
+        self.forgetMessage(claimedMessage)
+        record = self.mbox.quarantine(claimedMessage, error)
+        if record.nextRetryTime is not None:
+            logging.warning("EmailSecChal: mail_bot: Quarantined message %s after %d failed attempts, next retry in %d seconds" % (claimedMessage.key, record.attempts, record.nextRetryTime - record.lastFailureTime))
+        else:
+            logging.error("EmailSecChal: mail_bot: Quarantined message %s for good after %d failed attempts" % (claimedMessage.key, record.attempts))
+    
+    # Returns None on success and the error otherwise.
+    def processMessage(self, claimedMessage):
+        try:
+            with email_sec_chal.IncomingMessage.create(claimedMessage.getMessage()) as incomingMsg:
+                self.processRequestMessage(incomingMsg)
+        except Exception as e:
+            logging.exception("EmailSecChal: mail_bot: Failed processing message %s" % claimedMessage.key)
+            return "%s: %s" % (type(e).__name__, e)
+        return None
+            
     def processRequestMessage(self, incomingMsg):
-        redHerringSentTimestamp = self.db.getRedHerringSentTimestamp(incomingMsg.emailAddress)
+        asImpostor, reservation = self.decideReply(incomingMsg)
+        if asImpostor is not None:
+            try:
+                self.reply(asImpostor, incomingMsg, incomingMsg.emailAddress, incomingMsg.id)
+            except Exception:
+                self.getDb().cancelReply(incomingMsg.emailAddress, reservation)
+                raise
+    
+    # Whether the impostor bot should reply, or None if there should be no reply at all. The reply is recorded in the DB
+    # right away, the caller cancels it with the returned reservation if it cannot be sent.
+    def decideReply(self, incomingMsg):
+        db = self.getDb()
+        if self.isReplySuppressed(db, incomingMsg):
+            return None, None
+        
+        msgPart = self.findValidMessagePart(incomingMsg, incomingMsg.emailAddress, incomingMsg.id)
+        if msgPart is None:
+            return None, None
+        logging.info("EmailSecChal: mail_bot: Received a valid request from %s (%s)" % (incomingMsg.emailAddress, incomingMsg.id))
+        # Another bot process may have replied to the correspondent since the check above, so it is repeated together
+        # with recording the reply.
+        def decide():
+            if self.isReplySuppressed(db, incomingMsg):
+                return None
+            return msgPart.forImpostor or db.getRedHerringSentTimestamp(incomingMsg.emailAddress) < 0
+        return db.reserveReply(incomingMsg.emailAddress, decide)
+    
+    def isReplySuppressed(self, db, incomingMsg):
+        redHerringSentTimestamp = db.getRedHerringSentTimestamp(incomingMsg.emailAddress)
         if redHerringSentTimestamp >= 0:
             endOfSilentPeriodTimestamp = redHerringSentTimestamp + email_sec_chal.silentPeriodSec
-            if self.db.getCurrentTimestamp() < endOfSilentPeriodTimestamp:
+            if db.getCurrentTimestamp() < endOfSilentPeriodTimestamp:
                 logging.info("EmailSecChal: mail_bot: Ignoring a request from %s (%s) in the silent period" % (incomingMsg.emailAddress, incomingMsg.id))
-                return
-        
-        msgPart = self.findValidMessagePart(incomingMsg, incomingMsg.emailAddress, incomingMsg.id)
-        if msgPart is not None:
-            logging.info("EmailSecChal: mail_bot: Received a valid request from %s (%s)" % (incomingMsg.emailAddress, incomingMsg.id))
-            impostorShouldReply = msgPart.forImpostor or redHerringSentTimestamp < 0
-            self.reply(impostorShouldReply, incomingMsg, incomingMsg.emailAddress, incomingMsg.id)
+                return True
+        # A burst of requests gets the one reply decided for the first of them.
+        if db.isInCoalescingWindow(incomingMsg.emailAddress):
+            logging.info("EmailSecChal: mail_bot: Coalescing a request from %s (%s) with the last reply" % (incomingMsg.emailAddress, incomingMsg.id))
+            return True
+        return False
         
     def reply(self, asImpostor, incomingMsg, emailAddress, msgId):
         with self.createReplyMessage(incomingMsg) as replyMsg:
             replyMsg.send(asImpostor)
-            if asImpostor:
-                logging.info("EmailSecChal: mail_bot: Replied to %s as the impostor bot (%s)" % (emailAddress, msgId))
-                self.db.redHerringSent(emailAddress)
-            else:
-                logging.info("EmailSecChal: mail_bot: Replied to %s as the official bot (%s)" % (emailAddress, msgId))
+            self.replied(asImpostor, emailAddress, msgId)
+    
+    # The reply is already recorded in the DB by decideReply().
+    def replied(self, asImpostor, emailAddress, msgId):
+        if asImpostor:
+            logging.info("EmailSecChal: mail_bot: Replied to %s as the impostor bot (%s)" % (emailAddress, msgId))
+        else:
+            logging.info("EmailSecChal: mail_bot: Replied to %s as the official bot (%s)" % (emailAddress, msgId))
                 
     def createReplyMessage(self, incomingMsg):
         return email_sec_chal.OutgoingMessage(incomingMsg)
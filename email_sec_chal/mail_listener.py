@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import logging
+import socket
+import socketserver
+
+
+
+# Just enough of LMTP (RFC 2033) and SMTP (RFC 5321) for an MTA to hand messages over to the bot.
+# Each message is processed before the end of DATA is answered, so a failure is a 4xx and the message stays
+# queued in the MTA, which retries it later.
+class MailListenerRequestHandler(socketserver.StreamRequestHandler):
+
+    maxLineLength = 65536
+    maxMessageSize = 10 * 1024 * 1024
+
+    greeted = False
+    sender = None
+    recipients = None
+
+
+    def handle(self):
+        self.greeted = False
+        self.resetTransaction()
+        self.reply(220, "%s %s email_sec_chal ready" % (socket.getfqdn(), "LMTP" if self.server.lmtp else "ESMTP"))
+        while True:
+            line = self.rfile.readline(MailListenerRequestHandler.maxLineLength)
+            if not line:
+                return
+            command, _, argument = str(line, "ascii", "replace").rstrip("\r\n").partition(" ")
+            command = command.upper()
+            if command == "QUIT":
+                self.reply(221, "2.0.0 Bye")
+                return
+            handler = getattr(self, "handle" + command, None) if command.isalpha() else None
+            if handler is None:
+                self.reply(502, "5.5.1 Command not implemented")
+            else:
+                handler(argument.strip())
+
+    def reply(self, code, text):
+        self.wfile.write(bytes("%d %s\r\n" % (code, text), "ascii", "replace"))
+        self.wfile.flush()
+
+    def resetTransaction(self):
+        self.sender = None
+        self.recipients = []
+
+    def greet(self, argument, lmtp):
+        if lmtp != self.server.lmtp:
+            self.reply(500, "5.5.1 Use %s" % ("LHLO" if self.server.lmtp else "EHLO"))
+            return
+        self.greeted = True
+        self.resetTransaction()
+        self.wfile.write(bytes("250-%s\r\n250-PIPELINING\r\n250-8BITMIME\r\n250-ENHANCEDSTATUSCODES\r\n250 SIZE %d\r\n" % \
+            (socket.getfqdn(), MailListenerRequestHandler.maxMessageSize), "ascii"))
+        self.wfile.flush()
+
+    def handleLHLO(self, argument):
+        self.greet(argument, True)
+
+    def handleEHLO(self, argument):
+        self.greet(argument, False)
+
+    def handleHELO(self, argument):
+        if self.server.lmtp:
+            self.reply(500, "5.5.1 Use LHLO")
+            return
+        self.greeted = True
+        self.resetTransaction()
+        self.reply(250, socket.getfqdn())
+
+    def handleMAIL(self, argument):
+        if not self.greeted:
+            self.reply(503, "5.5.1 Say hello first")
+        elif self.sender is not None:
+            self.reply(503, "5.5.1 Nested MAIL command")
+        elif not argument.upper().startswith("FROM:"):
+            self.reply(501, "5.5.4 Syntax: MAIL FROM:<address>")
+        elif self.server.isBusy():
+            self.reply(451, "4.3.2 Too many messages pending, try again later")
+        else:
+            self.sender = argument[5:].strip().partition(" ")[0]
+            self.reply(250, "2.1.0 Sender OK")
+
+    def handleRCPT(self, argument):
+        if self.sender is None:
+            self.reply(503, "5.5.1 Need MAIL command")
+        elif not argument.upper().startswith("TO:"):
+            self.reply(501, "5.5.4 Syntax: RCPT TO:<address>")
+        else:
+            self.recipients.append(argument[3:].strip().partition(" ")[0])
+            self.reply(250, "2.1.5 Recipient OK")
+
+    def handleDATA(self, argument):
+        if not self.recipients:
+            self.reply(503, "5.5.1 Need RCPT command")
+            return
+        self.reply(354, "Start mail input; end with <CRLF>.<CRLF>")
+        data = self.readData()
+        if data is None:
+            code, text = 552, "5.3.4 Message too big"
+        else:
+            code, text = self.server.deliver(data)
+        # LMTP answers once per recipient, SMTP once per message.
+        for recipient in (self.recipients if self.server.lmtp else [None]):
+            self.reply(code, text)
+        self.resetTransaction()
+
+    # Returns None if the message is too big, it is read to the end anyway.
+    def readData(self):
+        lines = []
+        size = 0
+        # An over-long line is read in chunks, only the first one starts a line.
+        lineStart = True
+        while True:
+            line = self.rfile.readline(MailListenerRequestHandler.maxLineLength)
+            if not line:
+                raise EOFError("The connection was closed in the middle of DATA")
+            if lineStart and line in (b".\r\n", b".\n"):
+                break
+            if lineStart and line.startswith(b"."):
+                line = line[1:]
+            lineStart = line.endswith(b"\n")
+            size += len(line)
+            if size <= MailListenerRequestHandler.maxMessageSize:
+                lines.append(line)
+        if size > MailListenerRequestHandler.maxMessageSize:
+            return None
+        return b"".join(lines)
+
+    def handleRSET(self, argument):
+        self.resetTransaction()
+        self.reply(250, "2.0.0 OK")
+
+    def handleNOOP(self, argument):
+        self.reply(250, "2.0.0 OK")
+
+    def handleVRFY(self, argument):
+        self.reply(252, "2.5.2 Cannot verify the user")
+
+
+
+class MailListener(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    mailBot = None
+    lmtp = True
+    maxPending = 0
+
+
+    def __init__(self, mailBot_, address, lmtp_=True, maxPending_=64):
+        self.mailBot = mailBot_
+        self.lmtp = lmtp_
+        self.maxPending = maxPending_
+        socketserver.ThreadingTCPServer.__init__(self, address, MailListenerRequestHandler)
+
+    def isBusy(self):
+        return self.mailBot.getPendingCount() >= self.maxPending
+
+    def deliver(self, data):
+        if self.isBusy():
+            return 451, "4.3.2 Too many messages pending, try again later"
+        try:
+            error = self.mailBot.deliverMessage(data)
+        except Exception:
+            logging.exception("EmailSecChal: mail_listener: Cannot deliver a message")
+            error = "internal error"
+        if error is not None:
+            return 451, "4.3.0 Processing failed, try again later"
+        return 250, "2.0.0 Delivered"
+
+    def handle_error(self, request, client_address):
+        logging.warning("EmailSecChal: mail_listener: Error in the session with %s" % (client_address,), exc_info=True)
+
+
+
+def createMailListener(mailBot):
+    if email_sec_chal.mailListener not in ("lmtp", "smtp"):
+        raise email_sec_chal.EmailSecChalException("Unknown mail listener: %s" % email_sec_chal.mailListener)
+    listener = MailListener(mailBot, (email_sec_chal.mailListenerHost, email_sec_chal.mailListenerPort), email_sec_chal.mailListener == "lmtp", email_sec_chal.mailListenerMaxPending)
+    logging.info("EmailSecChal: mail_listener: Listening for %s on %s:%d" % (email_sec_chal.mailListener.upper(), email_sec_chal.mailListenerHost, listener.server_address[1]))
+    return listener
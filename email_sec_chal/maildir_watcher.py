@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import time
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+
+def createMaildirWatcher(maildirPath):
+    if email_sec_chal.maildirWatcher in ("auto", "inotify"):
+        try:
+            return InotifyMaildirWatcher(maildirPath)
+        except OSError:
+            if email_sec_chal.maildirWatcher == "inotify":
+                raise
+            logging.warning("EmailSecChal: maildir_watcher: inotify is not available, falling back to polling %s" % maildirPath, exc_info=True)
+    elif email_sec_chal.maildirWatcher != "polling":
+        raise email_sec_chal.EmailSecChalException("Unknown Maildir watcher: %s" % email_sec_chal.maildirWatcher)
+    return PollingMaildirWatcher(email_sec_chal.maildirPollMinIntervalSec, email_sec_chal.maildirPollMaxIntervalSec)
+
+
+
+# Waits until there may be new messages in a Maildir.
+class MaildirWatcher:
+
+    # Returns at the latest at the deadline, a time.time() value, such as when the next quarantined message is due.
+    def wait(self, deadline=None):
+        raise NotImplementedError()
+
+    @staticmethod
+    def getTimeout(intervalSec, deadline):
+        if deadline is None:
+            return intervalSec
+        return max(0, min(intervalSec, deadline - time.time()))
+
+    # Called after each pass over the Maildir with the number of messages found in it.
+    def processed(self, msgCount):
+        pass
+
+    def close(self):
+        pass
+
+
+
+class InotifyMaildirWatcher(MaildirWatcher):
+
+    libc = None
+    fd = -1
+    rescanIntervalSec = 0
+
+
+    @staticmethod
+    def loadLibc():
+        if InotifyMaildirWatcher.libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            if not hasattr(libc, "inotify_init1"):
+                raise OSError(errno.ENOSYS, "The C library does not support inotify")
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            InotifyMaildirWatcher.libc = libc
+        return InotifyMaildirWatcher.libc
+
+    def __init__(self, maildirPath, rescanIntervalSec_=None):
+        libc = InotifyMaildirWatcher.loadLibc()
+        # Quarantined messages are waited for with the deadline of wait(). The Maildir is still scanned from time to time
+        # without any events, in case some were lost when the event queue overflowed.
+        self.rescanIntervalSec = rescanIntervalSec_ if rescanIntervalSec_ is not None else email_sec_chal.maildirPollMaxIntervalSec
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_init1: " + os.strerror(e))
+        newDirPath = os.path.join(maildirPath, "new")
+        if libc.inotify_add_watch(self.fd, os.fsencode(newDirPath), IN_MOVED_TO | IN_CREATE | IN_CLOSE_WRITE) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            self.fd = -1
+            raise OSError(e, "inotify_add_watch: " + os.strerror(e), newDirPath)
+        logging.info("EmailSecChal: maildir_watcher: Watching %s with inotify" % newDirPath)
+
+    def wait(self, deadline=None):
+        readableFds, _, _ = select.select([self.fd], [], [], MaildirWatcher.getTimeout(self.rescanIntervalSec, deadline))
+        if not readableFds:
+            return False
+        try:
+            while os.read(self.fd, 65536):     # All pending events mean the same: rescan.
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+
+# Polls often while messages keep arriving and backs off while the Maildir is empty.
+class PollingMaildirWatcher(MaildirWatcher):
+
+    minIntervalSec = 0
+    maxIntervalSec = 0
+    intervalSec = 0
+
+
+    def __init__(self, minIntervalSec_, maxIntervalSec_):
+        self.minIntervalSec = minIntervalSec_
+        self.maxIntervalSec = max(minIntervalSec_, maxIntervalSec_)
+        self.intervalSec = self.minIntervalSec
+        logging.info("EmailSecChal: maildir_watcher: Polling every %g to %g seconds" % (self.minIntervalSec, self.maxIntervalSec))
+
+    def wait(self, deadline=None):
+        time.sleep(MaildirWatcher.getTimeout(self.intervalSec, deadline))
+        return True
+
+    def processed(self, msgCount):
+        if msgCount > 0:
+            self.intervalSec = self.minIntervalSec
+        else:
+            self.intervalSec = min(max(self.intervalSec * 2, self.minIntervalSec), self.maxIntervalSec)
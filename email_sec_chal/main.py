@@ -2,6 +2,7 @@
 import logging
 import email_sec_chal
 import configparser
+import socket
 import sys
 
 
@@ -9,12 +10,52 @@ configFile = "email_sec_chal.ini"
 resourceDir = None
 dataDir = None
 tempDir = None
+memoryTempDir = None
+tempDirQuotaMb = 0
 
 triggerWords = set()
 logLevel = logging.NOTSET
 keyUploadServerPort = -1
 smtpServerHost = None
 silentPeriodSec = 0
+keyringPoolSize = 4
+keyringPoolWarmUp = False
+cryptoBackend = "gnupg"
+correspondentKeyringCacheSize = 64
+correspondentKeyringCacheIdleSec = 600
+botIdentityCachePersisted = True
+cryptoWorkerCount = 0
+cryptoOperationTimeoutSec = 60
+maxKeySizeKb = 64
+maildirWatcher = "auto"
+maildirPollMinIntervalSec = 1.0
+maildirPollMaxIntervalSec = 30.0
+dispatcherWorkerCount = 0
+maildirMaxPending = 256
+instanceName = socket.gethostname()
+quarantineBaseDelaySec = 60
+quarantineMaxDelaySec = 86400
+quarantineMaxAttempts = 10
+mailListener = "none"
+mailListenerHost = "localhost"
+mailListenerPort = 24
+mailListenerMaxPending = 64
+runtime = "threads"
+asyncMaxInFlight = 256
+rateLimitSenderBurst = 0
+rateLimitSenderPerHour = 60
+rateLimitGlobalBurst = 0
+rateLimitGlobalPerHour = 3600
+rateLimitAction = "defer"
+rateLimitPersisted = False
+dedupTtlSec = 0
+dedupMaxEntries = 100000
+coalescingWindowSec = 0
+dbJournalMode = "WAL"
+dbSynchronous = "NORMAL"
+dbCacheSizeKb = 8192
+dbCompressKeys = True
+dbCorrespondentCacheSize = 10000
 
 
 def loadConfiguration():
@@ -26,9 +67,49 @@ def loadConfiguration():
     email_sec_chal.keyUploadServerPort = int(config["misc"]["key_upload_server_port"])
     email_sec_chal.smtpServerHost = config["misc"]["smtp_server_host"]
     email_sec_chal.silentPeriodSec = int(config["misc"]["silent_period_sec"])
+    email_sec_chal.maildirWatcher = config.get("misc", "maildir_watcher", fallback="auto")
+    email_sec_chal.maildirPollMinIntervalSec = config.getfloat("misc", "maildir_poll_min_interval_sec", fallback=1.0)
+    email_sec_chal.maildirPollMaxIntervalSec = config.getfloat("misc", "maildir_poll_max_interval_sec", fallback=30.0)
+    email_sec_chal.dispatcherWorkerCount = config.getint("misc", "dispatcher_worker_count", fallback=0)
+    email_sec_chal.maildirMaxPending = config.getint("misc", "maildir_max_pending", fallback=256)
+    email_sec_chal.instanceName = config.get("misc", "instance_name", fallback=socket.gethostname())
+    email_sec_chal.quarantineBaseDelaySec = config.getint("misc", "quarantine_base_delay_sec", fallback=60)
+    email_sec_chal.quarantineMaxDelaySec = config.getint("misc", "quarantine_max_delay_sec", fallback=86400)
+    email_sec_chal.quarantineMaxAttempts = config.getint("misc", "quarantine_max_attempts", fallback=10)
+    email_sec_chal.mailListener = config.get("misc", "mail_listener", fallback="none")
+    email_sec_chal.mailListenerHost = config.get("misc", "mail_listener_host", fallback="localhost")
+    email_sec_chal.mailListenerPort = config.getint("misc", "mail_listener_port", fallback=24)
+    email_sec_chal.mailListenerMaxPending = config.getint("misc", "mail_listener_max_pending", fallback=64)
+    email_sec_chal.runtime = config.get("misc", "runtime", fallback="threads")
+    email_sec_chal.asyncMaxInFlight = config.getint("misc", "async_max_in_flight", fallback=256)
+    email_sec_chal.rateLimitSenderBurst = config.getint("misc", "rate_limit_sender_burst", fallback=0)
+    email_sec_chal.rateLimitSenderPerHour = config.getfloat("misc", "rate_limit_sender_per_hour", fallback=60)
+    email_sec_chal.rateLimitGlobalBurst = config.getint("misc", "rate_limit_global_burst", fallback=0)
+    email_sec_chal.rateLimitGlobalPerHour = config.getfloat("misc", "rate_limit_global_per_hour", fallback=3600)
+    email_sec_chal.rateLimitAction = config.get("misc", "rate_limit_action", fallback="defer")
+    email_sec_chal.rateLimitPersisted = config.getboolean("misc", "rate_limit_persisted", fallback=False)
+    email_sec_chal.dedupTtlSec = config.getint("misc", "dedup_ttl_sec", fallback=0)
+    email_sec_chal.dedupMaxEntries = config.getint("misc", "dedup_max_entries", fallback=100000)
+    email_sec_chal.coalescingWindowSec = config.getint("misc", "coalescing_window_sec", fallback=0)
+    email_sec_chal.dbJournalMode = config.get("misc", "db_journal_mode", fallback="WAL").upper()
+    email_sec_chal.dbSynchronous = config.get("misc", "db_synchronous", fallback="NORMAL").upper()
+    email_sec_chal.dbCacheSizeKb = config.getint("misc", "db_cache_size_kb", fallback=8192)
+    email_sec_chal.dbCompressKeys = config.getboolean("misc", "db_compress_keys", fallback=True)
+    email_sec_chal.dbCorrespondentCacheSize = config.getint("misc", "db_correspondent_cache_size", fallback=10000)
     email_sec_chal.resourceDir = config["dirs"]["resource_dir"]
     email_sec_chal.dataDir = config["dirs"]["data_dir"]
     email_sec_chal.tempDir = config["dirs"]["temp_dir"]
+    email_sec_chal.memoryTempDir = config.get("dirs", "memory_temp_dir", fallback=None)
+    email_sec_chal.tempDirQuotaMb = config.getint("dirs", "temp_dir_quota_mb", fallback=0)
+    email_sec_chal.keyringPoolSize = config.getint("pgp", "keyring_pool_size", fallback=4)
+    email_sec_chal.keyringPoolWarmUp = config.getboolean("pgp", "keyring_pool_warm_up", fallback=False)
+    email_sec_chal.cryptoBackend = config.get("pgp", "crypto_backend", fallback="gnupg")
+    email_sec_chal.correspondentKeyringCacheSize = config.getint("pgp", "correspondent_keyring_cache_size", fallback=64)
+    email_sec_chal.correspondentKeyringCacheIdleSec = config.getint("pgp", "correspondent_keyring_cache_idle_sec", fallback=600)
+    email_sec_chal.botIdentityCachePersisted = config.getboolean("pgp", "bot_identity_cache_persisted", fallback=True)
+    email_sec_chal.cryptoWorkerCount = config.getint("pgp", "crypto_worker_count", fallback=0)
+    email_sec_chal.cryptoOperationTimeoutSec = config.getint("pgp", "crypto_operation_timeout_sec", fallback=60)
+    email_sec_chal.maxKeySizeKb = config.getint("pgp", "max_key_size_kb", fallback=64)
     
     logging.basicConfig(format="%(asctime)s [%(levelname)s]: %(message)s", datefmt="%Y.%m.%d %H:%M:%S", level=email_sec_chal.logLevel)
     
@@ -36,9 +117,39 @@ def loadConfiguration():
     logging.info("EmailSecChal: main: Log level: %s" % logging.getLevelName(email_sec_chal.logLevel))
     logging.info("EmailSecChal: main: Key upload server port: %d" % email_sec_chal.keyUploadServerPort)
     logging.info("EmailSecChal: main: SMTP server host: %s" % email_sec_chal.smtpServerHost)
+    logging.info("EmailSecChal: main: Maildir watcher: %s" % email_sec_chal.maildirWatcher)
+    logging.info("EmailSecChal: main: Maildir polling interval: %g to %g sec" % (email_sec_chal.maildirPollMinIntervalSec, email_sec_chal.maildirPollMaxIntervalSec))
+    logging.info("EmailSecChal: main: Instance name: %s" % email_sec_chal.instanceName)
+    logging.info("EmailSecChal: main: Dispatcher worker count: %s" % (email_sec_chal.dispatcherWorkerCount if email_sec_chal.dispatcherWorkerCount > 0 else "number of CPUs"))
+    logging.info("EmailSecChal: main: At most %d Maildir messages waiting for a worker" % email_sec_chal.maildirMaxPending)
+    logging.info("EmailSecChal: main: Mail listener: %s on %s:%d, at most %d pending messages" % (email_sec_chal.mailListener, email_sec_chal.mailListenerHost, email_sec_chal.mailListenerPort, email_sec_chal.mailListenerMaxPending))
+    logging.info("EmailSecChal: main: Runtime: %s" % email_sec_chal.runtime)
+    logging.info("EmailSecChal: main: Maximum messages in flight with asyncio: %d" % email_sec_chal.asyncMaxInFlight)
+    logging.info("EmailSecChal: main: Rate limit per sender: bursts of %d, %g per hour" % (email_sec_chal.rateLimitSenderBurst, email_sec_chal.rateLimitSenderPerHour))
+    logging.info("EmailSecChal: main: Global rate limit: bursts of %d, %g per hour" % (email_sec_chal.rateLimitGlobalBurst, email_sec_chal.rateLimitGlobalPerHour))
+    logging.info("EmailSecChal: main: Rate limited messages are %s, persisted: %s" % ("dropped" if email_sec_chal.rateLimitAction == "drop" else "deferred", email_sec_chal.rateLimitPersisted))
+    if email_sec_chal.dedupTtlSec > 0:
+        logging.info("EmailSecChal: main: Duplicate messages are remembered for %d seconds, at most %d of them" % (email_sec_chal.dedupTtlSec, email_sec_chal.dedupMaxEntries))
+    else:
+        logging.info("EmailSecChal: main: Duplicate messages are not dropped")
+    logging.info("EmailSecChal: main: Coalescing window: %d sec" % email_sec_chal.coalescingWindowSec)
+    logging.info("EmailSecChal: main: SQLite journal mode: %s, synchronous: %s, cache size: %d KB, compressed keys: %s, correspondent cache size: %d" % \
+        (email_sec_chal.dbJournalMode, email_sec_chal.dbSynchronous, email_sec_chal.dbCacheSizeKb, email_sec_chal.dbCompressKeys, email_sec_chal.dbCorrespondentCacheSize))
+    logging.info("EmailSecChal: main: Quarantine retry delay: %d to %d seconds, at most %d attempts" % (email_sec_chal.quarantineBaseDelaySec, email_sec_chal.quarantineMaxDelaySec, email_sec_chal.quarantineMaxAttempts))
     logging.info("EmailSecChal: main: Resource directory: %s" % email_sec_chal.resourceDir)
     logging.info("EmailSecChal: main: Data directory: %s" % email_sec_chal.dataDir)
     logging.info("EmailSecChal: main: Temporary directory: %s" % email_sec_chal.tempDir)
+    logging.info("EmailSecChal: main: Memory-backed temporary directory: %s" % email_sec_chal.memoryTempDir)
+    logging.info("EmailSecChal: main: Temporary directory quota: %d MB" % email_sec_chal.tempDirQuotaMb)
+    logging.info("EmailSecChal: main: Keyring pool size: %d" % email_sec_chal.keyringPoolSize)
+    logging.info("EmailSecChal: main: Keyring pool warm-up: %s" % email_sec_chal.keyringPoolWarmUp)
+    logging.info("EmailSecChal: main: Crypto backend: %s" % email_sec_chal.cryptoBackend)
+    logging.info("EmailSecChal: main: Correspondent keyring cache size: %d" % email_sec_chal.correspondentKeyringCacheSize)
+    logging.info("EmailSecChal: main: Correspondent keyring cache idle time: %d sec" % email_sec_chal.correspondentKeyringCacheIdleSec)
+    logging.info("EmailSecChal: main: Bot identity cache persisted: %s" % email_sec_chal.botIdentityCachePersisted)
+    logging.info("EmailSecChal: main: Crypto worker count: %s" % (email_sec_chal.cryptoWorkerCount if email_sec_chal.cryptoWorkerCount > 0 else "number of CPUs"))
+    logging.info("EmailSecChal: main: Crypto operation timeout: %d sec" % email_sec_chal.cryptoOperationTimeoutSec)
+    logging.info("EmailSecChal: main: Maximum minimized key size: %d KB" % email_sec_chal.maxKeySizeKb)
 
 
 def main():
@@ -51,6 +162,12 @@ def main():
         logging.exception("EmailSecChal: main: Cannot read configuration")
         sys.exit(1)
 
+    try:
+        email_sec_chal.Workspace.staticInit()
+    except:
+        logging.exception("EmailSecChal: main: Cannot prepare the temporary directory")
+        sys.exit(1)
+
     try:
         email_sec_chal.startKeyUploadServer()
     except:
@@ -58,7 +175,12 @@ def main():
         sys.exit(2)
         
     try:
-        mailBot = email_sec_chal.MailBot()
+        if email_sec_chal.runtime == "asyncio":
+            mailBot = email_sec_chal.AsyncMailBot()
+        elif email_sec_chal.runtime == "threads":
+            mailBot = email_sec_chal.MailBot()
+        else:
+            raise email_sec_chal.EmailSecChalException("Unknown runtime: %s" % email_sec_chal.runtime)
         mailBot.run()
     except:
         logging.exception("EmailSecChal: main: The mailbot stopped with an exception")
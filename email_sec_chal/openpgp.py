@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import base64
+import binascii
+import bz2
+import hashlib
+import re
+import time
+import zlib
+
+
+PACKET_TAG_PKESK = 1
+PACKET_TAG_SIGNATURE = 2
+PACKET_TAG_SKESK = 3
+PACKET_TAG_ONE_PASS_SIGNATURE = 4
+PACKET_TAG_SECRET_KEY = 5
+PACKET_TAG_PUBLIC_KEY = 6
+PACKET_TAG_SECRET_SUBKEY = 7
+PACKET_TAG_COMPRESSED_DATA = 8
+PACKET_TAG_SYMMETRICALLY_ENCRYPTED_DATA = 9
+PACKET_TAG_MARKER = 10
+PACKET_TAG_LITERAL_DATA = 11
+PACKET_TAG_TRUST = 12
+PACKET_TAG_USER_ID = 13
+PACKET_TAG_PUBLIC_SUBKEY = 14
+PACKET_TAG_USER_ATTRIBUTE = 17
+PACKET_TAG_SEIPD = 18
+PACKET_TAG_AEAD_ENCRYPTED_DATA = 20
+
+SIGNATURE_TYPES_CERTIFICATION = {0x10, 0x11, 0x12, 0x13}
+SIGNATURE_TYPE_SUBKEY_BINDING = 0x18
+SIGNATURE_TYPE_DIRECT_KEY = 0x1F
+SIGNATURE_TYPE_KEY_REVOCATION = 0x20
+SIGNATURE_TYPE_SUBKEY_REVOCATION = 0x28
+SIGNATURE_TYPE_CERTIFICATION_REVOCATION = 0x30
+
+SUBPACKET_TYPE_CREATION_TIME = 2
+SUBPACKET_TYPE_KEY_EXPIRATION_TIME = 9
+SUBPACKET_TYPE_ISSUER = 16
+SUBPACKET_TYPE_ISSUER_FINGERPRINT = 33
+
+WILDCARD_KEY_ID = "0000000000000000"
+
+armorRe = re.compile("-----BEGIN PGP ((?!SIGNED MESSAGE)[A-Z ,/0-9]+)-----[ \\t]*\\r?\\n(.*?)-----END PGP \\1-----", re.DOTALL)
+cleartextRe = re.compile("-----BEGIN PGP SIGNED MESSAGE-----[ \\t]*\\r?\\n(?:[^\\r\\n]+\\r?\\n)*\\r?\\n(.*?)\\r?\\n-----BEGIN PGP SIGNATURE-----", re.DOTALL)
+maxCompressionDepth = 4
+maxDecompressedSize = 1 << 20     # Enough to reach the packets we are interested in; the rest is the literal data.
+
+
+
+class TruncatedPacketException(email_sec_chal.PgpException):
+    pass
+
+
+
+class PacketSummary:
+
+    encrypted = False
+    recipientKeyIds = None
+    onePassSigned = False
+    signed = False
+    issuerKeyIds = None
+    keyIds = None
+    secretKey = False
+    userIds = None
+    literalData = False
+
+
+    def __init__(self):
+        self.recipientKeyIds = set()
+        self.issuerKeyIds = set()
+        self.keyIds = set()
+        self.userIds = []
+
+    def hasKey(self):
+        return (bool(self.keyIds) or self.secretKey) and bool(self.userIds)
+
+
+
+class SignatureInfo:
+
+    version = None
+    type = None
+    creationTime = 0
+    keyExpirationTime = 0     # Seconds after the creation of the key, 0 if it does not expire.
+    issuerKeyIds = None
+
+
+    def __init__(self):
+        self.issuerKeyIds = set()
+
+
+
+class MinimizedKey:
+
+    key = None
+    originalSize = 0
+    minimizedSize = 0
+    removedKeys = 0
+    removedSubkeys = 0
+    removedUserIds = 0
+    removedSignatures = 0
+    removedPackets = 0
+
+
+
+def createCrc24Table():
+    table = []
+    for octet in range(256):
+        crc = octet << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+        table.append(crc & 0xFFFFFF)
+    return table
+
+crc24Table = createCrc24Table()
+
+def crc24(data):
+    crc = 0xB704CE
+    table = crc24Table
+    for octet in data:
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ octet]
+    return crc
+
+
+# The checksum is only worth verifying when the data is used as is, not when only the packet headers are read: it costs
+# a Python loop over every octet.
+def dearmor(data, verifyChecksum=True):
+    if isinstance(data, bytes):
+        data = data.decode("ascii", "ignore")
+    match = armorRe.search(data)
+    if match is None:
+        raise email_sec_chal.PgpException("No ASCII armor found.")
+
+    lines = [line.strip() for line in match.group(2).splitlines()]
+    while lines and ":" in lines[0]:    # Armor headers; base64 data never contains a colon.
+        lines.pop(0)
+    base64Lines = []
+    checksum = None
+    for line in lines:
+        if len(line) == 5 and line.startswith("="):
+            checksum = line[1:]
+            break
+        base64Lines.append(line)
+
+    try:
+        binaryData = base64.b64decode("".join(base64Lines), validate=True)
+        if checksum is not None:
+            checksum = int.from_bytes(base64.b64decode(checksum, validate=True), "big")
+    except binascii.Error:
+        raise email_sec_chal.PgpException("Invalid base64 data in ASCII armor.")
+    if verifyChecksum and checksum is not None and checksum != crc24(binaryData):
+        raise email_sec_chal.PgpException("ASCII armor checksum mismatch.")
+    return binaryData
+
+
+def toBinary(data, verifyChecksum=True):
+    if isinstance(data, bytes) and data and data[0] & 0x80:
+        return data
+    return dearmor(data, verifyChecksum)
+
+
+def iterPackets(data, truncated=False):
+    try:
+        yield from iterPacketsInternal(data)
+    except TruncatedPacketException:
+        if not truncated:
+            raise
+
+
+def iterPacketsInternal(data):
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        pos += 1
+        if not header & 0x80:
+            raise email_sec_chal.PgpException("Invalid OpenPGP packet header at offset %d." % (pos - 1))
+
+        if header & 0x40:
+            tag = header & 0x3f
+            body = bytearray()
+            while True:
+                length, partial, pos = readNewFormatLength(data, pos)
+                if pos + length > len(data):
+                    raise TruncatedPacketException("Truncated OpenPGP packet body.")
+                body += data[pos:pos+length]
+                pos += length
+                if not partial:
+                    break
+            body = bytes(body)
+        else:
+            tag = (header >> 2) & 0x0f
+            lengthType = header & 0x03
+            if lengthType == 3:
+                length = len(data) - pos
+            else:
+                lengthSize = 1 << lengthType
+                if pos + lengthSize > len(data):
+                    raise TruncatedPacketException("Truncated OpenPGP packet header.")
+                length = int.from_bytes(data[pos:pos+lengthSize], "big")
+                pos += lengthSize
+            if pos + length > len(data):
+                raise TruncatedPacketException("Truncated OpenPGP packet body.")
+            body = data[pos:pos+length]
+            pos += length
+
+        yield tag, body
+
+
+def readNewFormatLength(data, pos):
+    if pos >= len(data):
+        raise TruncatedPacketException("Truncated OpenPGP packet header.")
+    firstOctet = data[pos]
+    if firstOctet < 192:
+        return firstOctet, False, pos + 1
+    if firstOctet < 224:
+        if pos + 2 > len(data):
+            raise TruncatedPacketException("Truncated OpenPGP packet header.")
+        return ((firstOctet - 192) << 8) + data[pos+1] + 192, False, pos + 2
+    if firstOctet == 255:
+        if pos + 5 > len(data):
+            raise TruncatedPacketException("Truncated OpenPGP packet header.")
+        return int.from_bytes(data[pos+1:pos+5], "big"), False, pos + 5
+    return 1 << (firstOctet & 0x1f), True, pos + 1
+
+
+def decompress(body):
+    if not body:
+        raise email_sec_chal.PgpException("Empty compressed data packet.")
+    algorithm = body[0]
+    if algorithm == 0:
+        return body[1:], True
+    try:
+        if algorithm == 1:
+            decompressor = zlib.decompressobj(-15)
+            data = decompressor.decompress(body[1:], maxDecompressedSize)
+            return data, not decompressor.unconsumed_tail
+        if algorithm == 2:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(body[1:], maxDecompressedSize)
+            return data, not decompressor.unconsumed_tail
+        if algorithm == 3:
+            decompressor = bz2.BZ2Decompressor()
+            data = decompressor.decompress(body[1:], maxDecompressedSize)
+            return data, decompressor.eof
+    except (zlib.error, OSError, ValueError):
+        raise email_sec_chal.PgpException("Corrupt compressed data packet.")
+    raise email_sec_chal.PgpException("Unknown compression algorithm %d." % algorithm)
+
+
+def calculateKeyId(publicKeyBody):
+    if not publicKeyBody:
+        return None
+    version = publicKeyBody[0]
+    if version == 4:
+        return hashlib.sha1(b"\x99" + len(publicKeyBody).to_bytes(2, "big") + publicKeyBody).digest()[-8:].hex().upper()
+    if version == 5:
+        return hashlib.sha256(b"\x9a" + len(publicKeyBody).to_bytes(4, "big") + publicKeyBody).digest()[:8].hex().upper()
+    if version == 6:
+        return hashlib.sha256(b"\x9b" + len(publicKeyBody).to_bytes(4, "big") + publicKeyBody).digest()[:8].hex().upper()
+    return None     # v3 key IDs depend on the algorithm-specific key material.
+
+
+def iterSubpackets(data):
+    pos = 0
+    while pos < len(data):
+        firstOctet = data[pos]
+        if firstOctet < 192:
+            length = firstOctet
+            pos += 1
+        elif firstOctet < 255:
+            if pos + 2 > len(data):
+                raise email_sec_chal.PgpException("Truncated signature subpacket.")
+            length = ((firstOctet - 192) << 8) + data[pos+1] + 192
+            pos += 2
+        else:
+            if pos + 5 > len(data):
+                raise email_sec_chal.PgpException("Truncated signature subpacket.")
+            length = int.from_bytes(data[pos+1:pos+5], "big")
+            pos += 5
+        if length == 0 or pos + length > len(data):
+            raise email_sec_chal.PgpException("Truncated signature subpacket.")
+        yield data[pos] & 0x7f, data[pos+1:pos+length]
+        pos += length
+
+
+def parseSignature(signatureBody):
+    signature = SignatureInfo()
+    if not signatureBody:
+        return signature
+    signature.version = signatureBody[0]
+    if signature.version == 3:
+        if len(signatureBody) < 15:
+            raise email_sec_chal.PgpException("Truncated signature packet.")
+        signature.type = signatureBody[2]
+        signature.creationTime = int.from_bytes(signatureBody[3:7], "big")
+        signature.issuerKeyIds.add(signatureBody[7:15].hex().upper())
+        return signature
+
+    if signature.version == 4 or signature.version == 5:
+        lengthSize = 2
+    elif signature.version == 6:
+        lengthSize = 4
+    else:
+        return signature
+    if len(signatureBody) < 4:
+        raise email_sec_chal.PgpException("Truncated signature packet.")
+    signature.type = signatureBody[1]
+
+    pos = 4
+    for hashed in (True, False):
+        if pos + lengthSize > len(signatureBody):
+            raise email_sec_chal.PgpException("Truncated signature packet.")
+        length = int.from_bytes(signatureBody[pos:pos+lengthSize], "big")
+        pos += lengthSize
+        for subpacketType, subpacketData in iterSubpackets(signatureBody[pos:pos+length]):
+            if subpacketType == SUBPACKET_TYPE_ISSUER and len(subpacketData) == 8:
+                signature.issuerKeyIds.add(subpacketData.hex().upper())
+            elif subpacketType == SUBPACKET_TYPE_ISSUER_FINGERPRINT and len(subpacketData) == 21:
+                signature.issuerKeyIds.add(subpacketData[-8:].hex().upper())
+            elif subpacketType == SUBPACKET_TYPE_ISSUER_FINGERPRINT and len(subpacketData) == 33:
+                signature.issuerKeyIds.add(subpacketData[1:9].hex().upper())
+            elif hashed and subpacketType == SUBPACKET_TYPE_CREATION_TIME and len(subpacketData) == 4:     # Unhashed times could be forged.
+                signature.creationTime = int.from_bytes(subpacketData, "big")
+            elif hashed and subpacketType == SUBPACKET_TYPE_KEY_EXPIRATION_TIME and len(subpacketData) == 4:
+                signature.keyExpirationTime = int.from_bytes(subpacketData, "big")
+        pos += length
+    return signature
+
+
+def getSignatureIssuerKeyIds(signatureBody):
+    return parseSignature(signatureBody).issuerKeyIds
+
+
+def inspect(data, summary=None, depth=0, truncated=False):
+    if summary is None:
+        summary = PacketSummary()
+        data = toBinary(data, False)      # Only the headers are read, decrypting or verifying checks the data.
+
+    keyPacketSeen = False
+    for tag, body in iterPackets(data, truncated):
+        if tag == PACKET_TAG_PKESK:
+            summary.encrypted = True
+            if len(body) >= 9 and body[0] == 3:
+                summary.recipientKeyIds.add(body[1:9].hex().upper())
+            else:
+                summary.recipientKeyIds.add(WILDCARD_KEY_ID)    # We cannot tell the recipient of an unknown PKESK version.
+        elif tag in (PACKET_TAG_SKESK, PACKET_TAG_SYMMETRICALLY_ENCRYPTED_DATA, PACKET_TAG_SEIPD, PACKET_TAG_AEAD_ENCRYPTED_DATA):
+            summary.encrypted = True
+        elif tag == PACKET_TAG_ONE_PASS_SIGNATURE:
+            summary.onePassSigned = True
+            if len(body) >= 12 and body[0] == 3:
+                summary.issuerKeyIds.add(body[4:12].hex().upper())
+        elif tag == PACKET_TAG_SIGNATURE:
+            if keyPacketSeen:
+                continue    # A key signature, not a data one.
+            summary.signed = True
+            summary.issuerKeyIds |= getSignatureIssuerKeyIds(body)
+        elif tag in (PACKET_TAG_PUBLIC_KEY, PACKET_TAG_PUBLIC_SUBKEY):
+            keyPacketSeen = True
+            keyId = calculateKeyId(body)
+            if keyId is not None:
+                summary.keyIds.add(keyId)
+        elif tag in (PACKET_TAG_SECRET_KEY, PACKET_TAG_SECRET_SUBKEY):
+            keyPacketSeen = True
+            summary.secretKey = True
+        elif tag == PACKET_TAG_USER_ID:
+            summary.userIds.append(body.decode("utf-8", "replace"))
+        elif tag == PACKET_TAG_LITERAL_DATA:
+            summary.literalData = True
+        elif tag == PACKET_TAG_COMPRESSED_DATA:
+            if depth >= maxCompressionDepth:
+                raise email_sec_chal.PgpException("Too deeply nested compressed data.")
+            decompressedData, complete = decompress(body)
+            inspect(decompressedData, summary, depth + 1, not complete)
+    return summary
+
+
+def getCleartext(signedMessage):
+    if isinstance(signedMessage, bytes):
+        signedMessage = signedMessage.decode("utf-8", "ignore")
+    match = cleartextRe.search(signedMessage)
+    if match is None:
+        return None
+    lines = match.group(1).split("\n")
+    lines = [line[2:] if line.startswith("- ") else line for line in lines]
+    return "\n".join(lines)
+
+
+def encodePacket(tag, body):
+    length = len(body)
+    if length < 192:
+        header = bytes([length])
+    elif length < 8384:
+        header = bytes([((length - 192) >> 8) + 192, (length - 192) & 0xFF])
+    else:
+        header = b"\xff" + length.to_bytes(4, "big")
+    return bytes([0xC0 | tag]) + header + body
+
+
+def armor(binaryData, blockType):
+    base64Data = base64.b64encode(binaryData).decode("ascii")
+    lines = ["-----BEGIN PGP %s-----" % blockType, ""]
+    lines += [base64Data[pos:pos+64] for pos in range(0, len(base64Data), 64)]
+    lines.append("=" + base64.b64encode(crc24(binaryData).to_bytes(3, "big")).decode("ascii"))
+    lines.append("-----END PGP %s-----" % blockType)
+    return "\n".join(lines) + "\n"
+
+
+# All the binding signatures and revocations. They are not verified here and anyone can claim the primary key as the
+# issuer, so none of them can be preferred over the others; gpg verifies them on import and picks the latest valid one.
+def selectSelfSignatures(signatures, bindingTypes, revocationTypes):
+    bindingSignatures = [signature for signature in signatures if signature[0].type in bindingTypes]
+    revocationSignatures = [signature for signature in signatures if signature[0].type in revocationTypes]
+    return bindingSignatures, revocationSignatures
+
+
+# Whether any of the binding signatures leaves the key unexpired; the others may be forged or superseded.
+def isBoundUnexpired(keyBody, bindingSignatures, now):
+    for signature, _ in bindingSignatures:
+        if signature.keyExpirationTime == 0 or len(keyBody) < 5 or int.from_bytes(keyBody[1:5], "big") + signature.keyExpirationTime > now:
+            return True
+    return False
+
+
+def minimizeKeyBlock(packets, minimizedKey, now):
+    tag, primaryKeyBody = packets[0]
+    primaryKeyId = calculateKeyId(primaryKeyBody) if tag == PACKET_TAG_PUBLIC_KEY else None
+    if primaryKeyId is None:    # Secret and v3 keys are not accepted.
+        minimizedKey.removedKeys += 1
+        return b""
+
+    directSignatures = []
+    components = []     # User IDs, user attributes and subkeys, each with its self-signatures.
+    for tag, body in packets[1:]:
+        if tag == PACKET_TAG_SIGNATURE:
+            try:
+                signature = parseSignature(body)
+            except email_sec_chal.PgpException:
+                minimizedKey.removedSignatures += 1
+                continue
+            if primaryKeyId not in signature.issuerKeyIds:
+                minimizedKey.removedSignatures += 1     # Third-party certifications are what signature flooding abuses.
+                continue
+            (components[-1][2] if components else directSignatures).append((signature, body))
+        elif tag in (PACKET_TAG_USER_ID, PACKET_TAG_USER_ATTRIBUTE, PACKET_TAG_PUBLIC_SUBKEY):
+            components.append((tag, body, []))
+        else:
+            minimizedKey.removedPackets += 1
+
+    keyData = bytearray(encodePacket(PACKET_TAG_PUBLIC_KEY, primaryKeyBody))
+    bindingSignatures, revocationSignatures = selectSelfSignatures(directSignatures, {SIGNATURE_TYPE_DIRECT_KEY}, {SIGNATURE_TYPE_KEY_REVOCATION})
+    minimizedKey.removedSignatures += len(directSignatures) - len(bindingSignatures) - len(revocationSignatures)
+    for _, body in revocationSignatures + bindingSignatures:
+        keyData += encodePacket(PACKET_TAG_SIGNATURE, body)
+
+    userIdCount = 0
+    subkeyData = bytearray()
+    for tag, body, signatures in components:
+        if tag == PACKET_TAG_PUBLIC_SUBKEY:
+            bindingSignatures, revocationSignatures = selectSelfSignatures(signatures, {SIGNATURE_TYPE_SUBKEY_BINDING}, {SIGNATURE_TYPE_SUBKEY_REVOCATION})
+            if not isBoundUnexpired(body, bindingSignatures, now):     # Revoked subkeys are left to gpg, the revocation may be forged.
+                minimizedKey.removedSubkeys += 1
+                minimizedKey.removedSignatures += len(signatures)
+                continue
+            minimizedKey.removedSignatures += len(signatures) - len(bindingSignatures) - len(revocationSignatures)
+            subkeyData += encodePacket(tag, body)
+            for _, signatureBody in revocationSignatures + bindingSignatures:
+                subkeyData += encodePacket(PACKET_TAG_SIGNATURE, signatureBody)
+        else:
+            bindingSignatures, revocationSignatures = selectSelfSignatures(signatures, SIGNATURE_TYPES_CERTIFICATION, {SIGNATURE_TYPE_CERTIFICATION_REVOCATION})
+            if tag == PACKET_TAG_USER_ATTRIBUTE or not bindingSignatures:    # Photos are not needed, and unbound user IDs are ignored by gpg.
+                minimizedKey.removedUserIds += 1
+                minimizedKey.removedSignatures += len(signatures)
+                continue
+            minimizedKey.removedSignatures += len(signatures) - len(bindingSignatures) - len(revocationSignatures)
+            keyData += encodePacket(tag, body)
+            for _, signatureBody in revocationSignatures + bindingSignatures:
+                keyData += encodePacket(PACKET_TAG_SIGNATURE, signatureBody)
+            userIdCount += 1
+
+    if userIdCount == 0:
+        minimizedKey.removedKeys += 1
+        return b""
+    return bytes(keyData + subkeyData)
+
+
+# Reduces public keys to what is needed to encrypt to them and verify their signatures.
+def minimizeKeys(data, maxSize=0, now=None):
+    if now is None:
+        now = time.time()
+    binaryData = toBinary(data)
+
+    keyBlocks = []
+    for tag, body in iterPackets(binaryData):
+        if tag in (PACKET_TAG_PUBLIC_KEY, PACKET_TAG_SECRET_KEY):
+            keyBlocks.append([(tag, body)])
+        elif keyBlocks:
+            keyBlocks[-1].append((tag, body))
+
+    minimizedKey = MinimizedKey()
+    minimizedKey.originalSize = len(binaryData)
+    keyData = b"".join(minimizeKeyBlock(packets, minimizedKey, now) for packets in keyBlocks)
+    if not keyData:
+        raise email_sec_chal.PgpException("No usable public key found.")
+    if maxSize > 0 and len(keyData) > maxSize:
+        raise email_sec_chal.PgpException("The minimized key has %d bytes, more than the limit of %d bytes." % (len(keyData), maxSize))
+    minimizedKey.minimizedSize = len(keyData)
+    minimizedKey.key = armor(keyData, "PUBLIC KEY BLOCK")
+    return minimizedKey
@@ -58,7 +58,7 @@ class OutgoingMessage:
     def construct(self, asImpostor):
         msg = self.constructUnencrypted(asImpostor)
         logging.debug("EmailSecChal: outgoing_message: Unencrypted message to % successfully created" % self.incomingMsg.emailAddress)
-        msg = self.pgp.signAndEncrypt(msg, asImpostor)
+        msg = email_sec_chal.CryptoExecutor.run(self.pgp.signAndEncrypt, msg, asImpostor)
         logging.debug("EmailSecChal: outgoing_message: Message to % successfully signed and encrypted" % self.incomingMsg.emailAddress)
         
         msg["To"] = self.incomingMsg.originalMessage["From"]
@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
-import shutil
 import os
-import tempfile
 import email_sec_chal
+import contextlib
 import logging
 import io
+import threading
 import email.generator
-import gnupg
 import email.mime.multipart
 import email.mime.application
 import email.encoders
@@ -21,17 +20,26 @@ class Pgp:
     botFrom = None
     botEmailAddress = None
     officialBotKeysFilePath = None
+    keyringPool = None
+    officialKeyIds = set()
+    impostorKeyIds = set()
 
     db = None
     emailAddress = None
+    officialKeyring = None
+    impostorKeyring = None
     officialGnupgHomeDir = None
     impostorGnupgHomeDir = None
-    officialGpg = None
-    impostorGpg = None
+    officialBackend = None
+    impostorBackend = None
     officialFingerprints = []
     impostorFingerprints = []
     correspondentKey = None
     correspondentFingerprints = []
+    correspondentKeyIds = None
+    lock = None
+    runningCount = 0
+    closed = False
         
     
     @staticmethod
@@ -39,8 +47,7 @@ class Pgp:
         if Pgp.initialized:
             return
         
-        if not os.access(email_sec_chal.tempDir, os.F_OK):
-            os.makedirs(email_sec_chal.tempDir)
+        email_sec_chal.Workspace.staticInit()
 
         Pgp.officialBotKeysFilePath = os.path.join(email_sec_chal.resourceDir, "officialBot.asc")
         with open(Pgp.officialBotKeysFilePath, "r") as officialBotKeysFile:
@@ -50,58 +57,60 @@ class Pgp:
         with open(impostorBotKeysFilePath, "r") as impostorBotKeysFile:
             Pgp.impostorBotKeys = impostorBotKeysFile.read()
             
-        Pgp.botFrom = Pgp.getBotFromHeaderValue()
+        Pgp.botFrom = email_sec_chal.BotIdentity.get("official").uids[0]
+        logging.info("EmailSecChal: pgp: The value for the bot's From header is: " + Pgp.botFrom)
         Pgp.botEmailAddress = Pgp.uidToEmailAddress(Pgp.botFrom)
         Pgp.botEmailAddress = Pgp.botEmailAddress.lower()
+        
+        if Pgp.keyringPool is not None:
+            Pgp.keyringPool.close()
+        Pgp.keyringPool = email_sec_chal.KeyringPool(email_sec_chal.keyringPoolSize, {"official": Pgp.officialBotKeys, "impostor": Pgp.impostorBotKeys},
+            email_sec_chal.correspondentKeyringCacheSize, email_sec_chal.correspondentKeyringCacheIdleSec)
+        if email_sec_chal.keyringPoolWarmUp:
+            Pgp.keyringPool.warmUp()
+        Pgp.officialKeyIds = set(email_sec_chal.BotIdentity.get("official").keyIds)
+        Pgp.impostorKeyIds = set(email_sec_chal.BotIdentity.get("impostor").keyIds)
 
         logging.debug("EmailSecChal: pgp: Static initialization successful")
         Pgp.initialized = True
         
     @staticmethod
     def createGpg(gnupgHomeDir):
-        return gnupg.GPG(gnupghome = gnupgHomeDir, verbose=logging.getLogger().isEnabledFor(logging.DEBUG))
+        return email_sec_chal.PipeGpg(gnupghome = gnupgHomeDir, verbose=logging.getLogger().isEnabledFor(logging.DEBUG))
     
     @staticmethod
     def createTempGpg():
-        gnupgHomeDir = tempfile.mkdtemp(dir = email_sec_chal.tempDir)
+        gnupgHomeDir = email_sec_chal.Workspace.create("scratch_")
         gpg = Pgp.createGpg(gnupgHomeDir)
         return gpg, gnupgHomeDir
     
     @staticmethod    
-    def getBotFromHeaderValue():
-        gpg, gnupgHomeDir = Pgp.createTempGpg()
+    def storeCorrespondentKey(correspondentKey):
         try:
-            gpg.import_keys(Pgp.officialBotKeys)
-            botFrom = gpg.list_keys(secret = True)[0]["uids"][0]
-        finally:
-            shutil.rmtree(gnupgHomeDir, ignore_errors=True)
+            minimizedKey = email_sec_chal.openpgp.minimizeKeys(correspondentKey, email_sec_chal.maxKeySizeKb * 1024)
+        except email_sec_chal.PgpException as e:
+            logging.info("EmailSecChal: pgp: Rejected an uploaded key: %s" % e)
+            return []
+        logging.info("EmailSecChal: pgp: Minimized an uploaded key from %d to %d bytes, removed %d keys, %d subkeys, %d user IDs, %d signatures and %d other packets" % \
+            (minimizedKey.originalSize, minimizedKey.minimizedSize, minimizedKey.removedKeys, minimizedKey.removedSubkeys, minimizedKey.removedUserIds, minimizedKey.removedSignatures, minimizedKey.removedPackets))
+        correspondentKey = minimizedKey.key
         
-        logging.info("EmailSecChal: pgp: The value for the bot's From header is: " + botFrom)
-        return botFrom
-
-    @staticmethod    
-    def storeCorrespondentKey(correspondentKey):
-        gpg, gnupgHomeDir = Pgp.createTempGpg()
+        Pgp.staticInit()
+        keyring = Pgp.keyringPool.acquire("official")     # Scanning does not import anything, so any keyring will do.
         try:
-            tmpFile = tempfile.NamedTemporaryFile(dir = email_sec_chal.tempDir, delete=False, mode="w")
-            try:
-                tmpFile.write(correspondentKey)
-                tmpFile.close()
-                keys = gpg.scan_keys(tmpFile.name)
-            finally:
-                email_sec_chal.removeFile(tmpFile.name)
+            keys = keyring.backend.scanKeys(correspondentKey)
         finally:
-            shutil.rmtree(gnupgHomeDir, ignore_errors=True)
+            Pgp.keyringPool.release(keyring)
             
         emailAddresses = []
-        db = email_sec_chal.Db()
         for key in keys:
             for uid in key["uids"]:
                 emailAddress = Pgp.uidToEmailAddress(uid)
                 if emailAddress is not None:
-                    emailAddress = emailAddress.lower()
-                    emailAddresses.append(emailAddress)
-                    db.setCorrespondentKey(emailAddress, correspondentKey)
+                    emailAddresses.append(emailAddress.lower())
+        oldKeys = email_sec_chal.Db().setCorrespondentKeys(emailAddresses, correspondentKey)
+        for oldKey in oldKeys:
+            Pgp.keyringPool.invalidate(oldKey)     # The keyrings prepared with the replaced keys are of no more use.
                 
         logging.info("EmailSecChal: pgp: Imported keys for the following addresses: %s" % (", ".join(emailAddresses)))
         return emailAddresses
@@ -110,22 +119,24 @@ class Pgp:
         Pgp.staticInit()
         
         self.db = email_sec_chal.Db()
+        self.lock = threading.Lock()
+        self.runningCount = 0
+        self.closed = False
         self.emailAddress = emailAddress_
         logging.debug("EmailSecChal: pgp: Creating an instance for %s" % (self.emailAddress if self.emailAddress is not None else "nobody"))
         if self.emailAddress is not None:
             self.emailAddress = self.emailAddress.lower()
         
-        self.officialGnupgHomeDir, self.officialGpg, self.officialFingerprints = self.initBotGpg("official", Pgp.officialBotKeys)
-        self.impostorGnupgHomeDir, self.impostorGpg, self.impostorFingerprints = self.initBotGpg("impostor", Pgp.impostorBotKeys)
+        self.correspondentKey = None
+        self.correspondentFingerprints = []
+        self.correspondentKeyIds = set()
         if self.emailAddress:
             self.loadCorrespondentKeyFromDb()
-    
-    def initBotGpg(self, botName, botKeys):
-        gnupgHomeDir = tempfile.mkdtemp(dir = email_sec_chal.tempDir, prefix = self.emailAddress + "_" + botName + "_")
-        gpg = Pgp.createGpg(gnupgHomeDir)
-        importResult = gpg.import_keys(botKeys)
-        logging.debug("EmailSecChal: pgp: Created a GPG home directory in %s" % gnupgHomeDir)
-        return gnupgHomeDir, gpg, importResult.fingerprints
+        self.officialKeyring = Pgp.keyringPool.acquire("official", self.correspondentKey)
+        self.officialGnupgHomeDir, self.officialBackend, self.officialFingerprints = self.officialKeyring.gnupgHomeDir, self.officialKeyring.backend, self.officialKeyring.fingerprints
+        self.impostorKeyring = Pgp.keyringPool.acquire("impostor", self.correspondentKey)
+        self.impostorGnupgHomeDir, self.impostorBackend, self.impostorFingerprints = self.impostorKeyring.gnupgHomeDir, self.impostorKeyring.backend, self.impostorKeyring.fingerprints
+        self.correspondentFingerprints = self.officialKeyring.correspondentFingerprints
 
     def __enter__(self):
         return self
@@ -133,72 +144,148 @@ class Pgp:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
         
+    # An operation that timed out may still be running on its crypto worker when the instance is closed, the keyrings
+    # are then released when it finishes. An operation that starts after the instance is closed fails.
     def close(self):
-        self.removeGnupgHomeDir(self.officialGnupgHomeDir)
-        self.removeGnupgHomeDir(self.impostorGnupgHomeDir)
-        
-    def removeGnupgHomeDir(self, gnupgHomeDir):
+        with self.lock:
+            self.closed = True
+            release = self.runningCount == 0
+        if release:
+            self.releaseKeyrings()
+        else:
+            logging.warning("EmailSecChal: pgp: Keeping the keyrings of the instance for %s until its timed out operation finishes" % self.emailAddress)
+    
+    def releaseKeyrings(self):
+        if self.officialKeyring is not None:
+            Pgp.keyringPool.release(self.officialKeyring)
+            self.officialKeyring = None
+        if self.impostorKeyring is not None:
+            Pgp.keyringPool.release(self.impostorKeyring)
+            self.impostorKeyring = None
+    
+    @contextlib.contextmanager
+    def operation(self):
+        with self.lock:
+            if self.closed:
+                raise email_sec_chal.PgpException("The instance for %s is already closed." % self.emailAddress)
+            self.runningCount += 1
         try:
-            shutil.rmtree(gnupgHomeDir)
-            logging.debug("EmailSecChal: pgp: Deleted the GPG home directory %s" % gnupgHomeDir)
-        except:
-            logging.warning("EmailSecChal: pgp: Cannot remove directory %s" % gnupgHomeDir, exc_info=True)
+            yield
+        finally:
+            with self.lock:
+                self.runningCount -= 1
+                release = self.closed and self.runningCount == 0
+            if release:
+                self.releaseKeyrings()
 
         
     def loadCorrespondentKeyFromDb(self):
         self.correspondentKey = self.db.getCorrespondentKey(self.emailAddress)
         if self.correspondentKey is not None:
-            importResult = self.officialGpg.import_keys(self.correspondentKey)
-            self.correspondentFingerprints = importResult.fingerprints
-            self.impostorGpg.import_keys(self.correspondentKey)
+            try:
+                packetSummary = email_sec_chal.openpgp.inspect(self.correspondentKey)
+                self.correspondentKeyIds = None if packetSummary.secretKey else packetSummary.keyIds
+            except email_sec_chal.PgpException:
+                self.correspondentKeyIds = None
             
-    def getBotPublicKey(self, fingerprints, gpg, botName):
-        for fingerprint in fingerprints:
-            publicKey = gpg.export_keys(fingerprint)
-            if publicKey:
-                return publicKey
-        raise email_sec_chal.PgpException("The public key of the %s bot could not be exported." % botName)
+    # The bots whose keys the message is encrypted to. What the parser cannot read is left to both bots, gpg may
+    # still be able to.
+    def getRecipientBots(self, encryptedData):
+        try:
+            packetSummary = email_sec_chal.openpgp.inspect(encryptedData)
+        except email_sec_chal.PgpException as e:
+            logging.info("EmailSecChal: pgp: Cannot find the recipients of an encrypted message from %s, trying both bots: %s" % (self.emailAddress, e))
+            return ["impostor", "official"]
+        
+        recipientKeyIds = packetSummary.recipientKeyIds
+        if email_sec_chal.openpgp.WILDCARD_KEY_ID in recipientKeyIds:
+            return ["impostor", "official"]
+        recipientBots = []
+        if recipientKeyIds & Pgp.impostorKeyIds:
+            recipientBots.append("impostor")
+        if recipientKeyIds & Pgp.officialKeyIds:
+            recipientBots.append("official")
+        return recipientBots
+    
+    def decrypt(self, encryptedData):
+        with self.operation():
+            decryptedResult = None
+            for botName in self.getRecipientBots(encryptedData):
+                backend = self.impostorBackend if botName == "impostor" else self.officialBackend
+                decryptedResult = backend.decrypt(encryptedData)
+                if decryptedResult:
+                    return decryptedResult, botName == "impostor"
+            return decryptedResult, False
+    
+    @staticmethod
+    def getDecryptionError(decryptedResult):
+        if decryptedResult is None:
+            return "not encrypted for any of the bot keys"
+        return decryptedResult.stderr
     
+    def isVerifiable(self, signedData):
+        try:
+            packetSummary = email_sec_chal.openpgp.inspect(signedData)
+        except email_sec_chal.PgpException as e:
+            logging.info("EmailSecChal: pgp: Invalid signature data from %s: %s" % (self.emailAddress, e))
+            return False
+        
+        if not (packetSummary.signed or packetSummary.onePassSigned):
+            logging.debug("EmailSecChal: pgp: No signature in the signed data from %s" % self.emailAddress)
+            return False
+        if packetSummary.issuerKeyIds and self.correspondentKeyIds is not None:
+            if not packetSummary.issuerKeyIds & (Pgp.officialKeyIds | self.correspondentKeyIds):
+                logging.debug("EmailSecChal: pgp: Data from %s is signed by unknown keys: %s" % (self.emailAddress, ", ".join(sorted(packetSummary.issuerKeyIds))))
+                return False
+        return True
+    
+    def verifyInline(self, signedData):
+        with self.operation():
+            if self.isVerifiable(signedData):
+                return self.officialBackend.decrypt(signedData)
+        
+            cleartext = email_sec_chal.openpgp.getCleartext(signedData)
+            if cleartext is None:
+                return self.officialBackend.decrypt(signedData)     # The signed data is still needed, and only the backend can extract it.
+            return email_sec_chal.CryptoResult(data_=cleartext.encode())
+            
     def getOfficialPublicKey(self):
-        return self.getBotPublicKey(self.officialFingerprints, self.officialGpg, "official")
+        return email_sec_chal.BotIdentity.get("official").publicKey
 
     def getImpostorPublicKey(self):
-        return self.getBotPublicKey(self.impostorFingerprints, self.impostorGpg, "impostor")
+        return email_sec_chal.BotIdentity.get("impostor").publicKey
             
 
     def verifyMessageWithDetachedSignature(self, msg, signature):
-        binaryData = self.convertToBinary(msg)
-        
-        signatureFile = tempfile.NamedTemporaryFile(dir = email_sec_chal.tempDir, delete=False, mode="w")
-        signatureFile.write(signature)
-        signatureFile.close()
-        logging.debug("EmailSecChal: pgp: Wrote detached signature to temporary file %s" % signatureFile.name)
+        with self.operation():
+            if not self.isVerifiable(signature):
+                return email_sec_chal.CryptoResult()
         
-        verified = self.officialGpg.verify_data(signatureFile.name, binaryData)
-        email_sec_chal.removeFile(signatureFile.name)
-        return verified
+            binaryData = self.convertToBinary(msg)
+            return self.officialBackend.verifyDetached(binaryData, signature)
 
     def signAndEncrypt(self, msg, asImpostor):
-        binaryData = self.convertToBinary(msg)
-        if asImpostor:
-            recipients = self.correspondentFingerprints + self.impostorFingerprints
-            encryptedData = self.impostorGpg.encrypt(binaryData, recipients, sign=self.impostorFingerprints[0], always_trust=True)
-        else:
-            recipients = self.correspondentFingerprints + self.officialFingerprints
-            encryptedData = self.officialGpg.encrypt(binaryData, recipients, sign=self.officialFingerprints[0], always_trust=True)
+        with self.operation():
+            binaryData = self.convertToBinary(msg)
+            if asImpostor:
+                recipients = self.correspondentFingerprints + self.impostorFingerprints
+                encryptedData = self.impostorBackend.signAndEncrypt(binaryData, recipients, self.impostorFingerprints[0])
+            else:
+                recipients = self.correspondentFingerprints + self.officialFingerprints
+                encryptedData = self.officialBackend.signAndEncrypt(binaryData, recipients, self.officialFingerprints[0])
         
-        encryptedMsg = email.mime.multipart.MIMEMultipart("encrypted", protocol="application/pgp-encrypted")
+            encryptedMsg = email.mime.multipart.MIMEMultipart("encrypted", protocol="application/pgp-encrypted")
         
-        pgpIdentification = email.mime.application.MIMEApplication("Version: 1\n", "pgp-encrypted", email.encoders.encode_7or8bit)
-        email_sec_chal.removeMimeVersion(pgpIdentification)
-        encryptedMsg.attach(pgpIdentification)
+            pgpIdentification = email.mime.application.MIMEApplication("Version: 1\n", "pgp-encrypted", email.encoders.encode_7or8bit)
+            email_sec_chal.removeMimeVersion(pgpIdentification)
+            encryptedMsg.attach(pgpIdentification)
         
-        encryptedAsc = email.mime.application.MIMEApplication(str(encryptedData), "octet-stream", email.encoders.encode_7or8bit)
-        email_sec_chal.removeMimeVersion(encryptedAsc)
-        email_sec_chal.setMimeAttachmentFileName(encryptedAsc, "encrypted.asc")
-        encryptedMsg.attach(encryptedAsc)
+            encryptedAsc = email.mime.application.MIMEApplication(encryptedData, "octet-stream", email.encoders.encode_7or8bit)
+            email_sec_chal.removeMimeVersion(encryptedAsc)
+            email_sec_chal.setMimeAttachmentFileName(encryptedAsc, "encrypted.asc")
+            encryptedMsg.attach(encryptedAsc)
         
-        return encryptedMsg
+            return encryptedMsg
 
     def convertToBinary(self, msg):
         buf = io.BytesIO()
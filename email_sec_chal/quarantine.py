@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import json
+import os
+
+
+
+# The sidecar record of a message that failed processing.
+class QuarantineRecord:
+
+    key = None
+    subpath = None
+    error = None
+    attempts = 0
+    firstFailureTime = None
+    lastFailureTime = None
+    nextRetryTime = None    # None after the last attempt; the message then stays in quarantine until removed by hand.
+
+
+    @staticmethod
+    def getRetryDelaySec(attempts):
+        return min(email_sec_chal.quarantineBaseDelaySec * (2 ** (attempts - 1)), email_sec_chal.quarantineMaxDelaySec)
+
+    @staticmethod
+    def load(recordPath):
+        with open(recordPath, "r") as recordFile:
+            recordData = json.load(recordFile)
+        record = QuarantineRecord(recordData["key"], recordData["subpath"])
+        record.error = recordData["error"]
+        record.attempts = recordData["attempts"]
+        record.firstFailureTime = recordData["firstFailureTime"]
+        record.lastFailureTime = recordData["lastFailureTime"]
+        record.nextRetryTime = recordData["nextRetryTime"]
+        return record
+
+    def __init__(self, key_, subpath_=None):
+        self.key = key_
+        self.subpath = subpath_
+
+    def recordFailure(self, error, now):
+        self.error = error
+        self.attempts += 1
+        if self.firstFailureTime is None:
+            self.firstFailureTime = now
+        self.lastFailureTime = now
+        if self.attempts < email_sec_chal.quarantineMaxAttempts:
+            self.nextRetryTime = now + QuarantineRecord.getRetryDelaySec(self.attempts)
+        else:
+            self.nextRetryTime = None
+
+    # Postponed without having failed, e.g. when the sender is rate limited.
+    def defer(self, reason, retryTime):
+        self.error = reason
+        self.nextRetryTime = retryTime
+
+    def isDue(self, now):
+        return self.nextRetryTime is not None and self.nextRetryTime <= now
+
+    def save(self, recordPath):
+        tmpRecordPath = recordPath + ".tmp"
+        with open(tmpRecordPath, "w") as recordFile:
+            json.dump({
+                "key": self.key,
+                "subpath": self.subpath,
+                "error": self.error,
+                "attempts": self.attempts,
+                "firstFailureTime": self.firstFailureTime,
+                "lastFailureTime": self.lastFailureTime,
+                "nextRetryTime": self.nextRetryTime
+            }, recordFile)
+        os.replace(tmpRecordPath, recordPath)
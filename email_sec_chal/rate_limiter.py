@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import collections
+import logging
+import threading
+import time
+
+
+
+class TokenBucket:
+
+    capacity = 0
+    refillPerSec = 0.0
+    tokens = 0.0
+    updated = 0.0
+
+
+    def __init__(self, capacity_, refillPerSec_, tokens_, updated_):
+        self.capacity = capacity_
+        self.refillPerSec = refillPerSec_
+        self.tokens = tokens_
+        self.updated = updated_
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refillPerSec)
+            self.updated = now
+
+    def isFull(self):
+        return self.tokens >= self.capacity
+
+    # The time at which there will be a token to take.
+    def getAvailableTime(self):
+        if self.tokens >= 1:
+            return self.updated
+        if self.refillPerSec <= 0:
+            return float("inf")
+        return self.updated + (1 - self.tokens) / self.refillPerSec
+
+
+
+# Token buckets per sender address and one for all senders together, checked after triage and before any crypto work.
+# A bucket with a capacity of 0 does not limit anything.
+class RateLimiter:
+
+    globalBucketName = "*"
+    maxBucketCount = 10000
+
+    buckets = None
+    counts = None
+    lock = None
+
+
+    def __init__(self):
+        self.buckets = {}
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def getBucket(self, name, capacity, refillPerHour, now, db):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = TokenBucket(capacity, refillPerHour / 3600.0, capacity, now)
+            if email_sec_chal.rateLimitPersisted:
+                row = db.getRateLimitBucket(name)
+                if row is not None:
+                    bucket.tokens, bucket.updated = row
+            self.buckets[name] = bucket
+        bucket.refill(now)
+        return bucket
+
+    def saveBucket(self, name, bucket, db):
+        if email_sec_chal.rateLimitPersisted:
+            db.setRateLimitBucket(name, bucket.tokens, bucket.updated)
+
+    # Full buckets are the same as new ones, so they are forgotten when there are too many.
+    def pruneBuckets(self, now):
+        if len(self.buckets) <= RateLimiter.maxBucketCount:
+            return
+        for name, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.isFull():
+                del self.buckets[name]
+
+    # Returns None if the message is admitted, otherwise the time at which it may be retried.
+    def admit(self, emailAddress, db, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            limits = []
+            if email_sec_chal.rateLimitSenderBurst > 0:
+                limits.append((emailAddress.lower(), email_sec_chal.rateLimitSenderBurst, email_sec_chal.rateLimitSenderPerHour))
+            if email_sec_chal.rateLimitGlobalBurst > 0:
+                limits.append((RateLimiter.globalBucketName, email_sec_chal.rateLimitGlobalBurst, email_sec_chal.rateLimitGlobalPerHour))
+            buckets = [(name, self.getBucket(name, capacity, refillPerHour, now, db)) for name, capacity, refillPerHour in limits]
+
+            retryTime = max([bucket.getAvailableTime() for _, bucket in buckets] + [now])
+            if retryTime <= now:
+                for name, bucket in buckets:
+                    bucket.tokens -= 1
+                    self.saveBucket(name, bucket, db)
+                self.counts["accepted"] += 1
+                self.pruneBuckets(now)
+                return None
+
+            action = "dropped" if email_sec_chal.rateLimitAction == "drop" else "deferred"
+            self.counts[action] += 1
+            logging.warning("EmailSecChal: rate_limiter: Rate limited a message from %s (%s); %d deferred and %d dropped so far" % \
+                (emailAddress, action, self.counts["deferred"], self.counts["dropped"]))
+            return retryTime
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import collections
+import logging
+import threading
+
+
+
+# Rejects messages by their headers alone, before any gpg work is done for them.
+# An accepted message is in flight until it is released, a copy of it that comes in meanwhile is a duplicate. It is
+# remembered in the DB only once it has been processed, so that a message put back after a crash is not taken for a
+# duplicate of itself.
+class Triage:
+
+    rejectedCounts = None
+    inFlightDedupKeys = None
+    lock = None
+
+
+    def __init__(self):
+        self.rejectedCounts = collections.Counter()
+        self.inFlightDedupKeys = set()
+        self.lock = threading.Lock()
+
+    def getRejectedCount(self):
+        return sum(self.rejectedCounts.values())
+
+    def getRejectionReason(self, headers, db, dedupKey=None):
+        emailAddress = email_sec_chal.util.getMessageSenderEmailAddress(headers)
+        if not emailAddress:
+            return "no sender"
+        if emailAddress == email_sec_chal.Pgp.botEmailAddress:
+            return "spoofed sender"
+        if email_sec_chal.Pgp.botEmailAddress not in email_sec_chal.util.getMessageRecipientsEmailAddresses(headers):
+            return "bot not a recipient"
+        if dedupKey is not None and (dedupKey in self.inFlightDedupKeys or db.isMessageSeen(dedupKey)):
+            return "duplicate"
+        # Rechecked by MailBot.decideReply, as an earlier message from the same correspondent may start a silent period
+        # or a coalescing window.
+        redHerringSentTimestamp = db.getRedHerringSentTimestamp(emailAddress)
+        if redHerringSentTimestamp >= 0 and db.getCurrentTimestamp() < redHerringSentTimestamp + email_sec_chal.silentPeriodSec:
+            return "silent period"
+        if db.isInCoalescingWindow(emailAddress):
+            return "coalesced"
+        return None
+
+    # A message whose headers cannot be triaged is rejected, not left to fail the caller.
+    def accept(self, headers, db, dedupKey=None):
+        with self.lock:
+            try:
+                rejectionReason = self.getRejectionReason(headers, db, dedupKey)
+            except Exception:
+                logging.warning("EmailSecChal: triage: Cannot triage a message (%s)" % headers.get("Message-ID"), exc_info=True)
+                rejectionReason = "invalid headers"
+            if rejectionReason is None:
+                if dedupKey is not None:
+                    self.inFlightDedupKeys.add(dedupKey)
+                return True
+        self.rejectedCounts[rejectionReason] += 1
+        logging.info("EmailSecChal: triage: Rejected a message (%s): %s; %d messages rejected so far" % \
+            (headers.get("Message-ID"), rejectionReason, self.getRejectedCount()))
+        return False
+
+    def release(self, dedupKey):
+        with self.lock:
+            self.inFlightDedupKeys.discard(dedupKey)
@@ -50,11 +50,12 @@ def getHeaderValue(message, headerName):
         return cgi.parse_header(header)
     return None, None
 
+# Headers with raw 8-bit bytes are parsed into email.header.Header objects, str() decodes them.
 def getMessageRecipientsEmailAddresses(message):
     to = message.get_all("To", [])
     cc = message.get_all("CC", [])
     bcc = message.get_all("BCC", [])
-    parsedRecipientAddresses = email.utils.getaddresses(to + cc + bcc)
+    parsedRecipientAddresses = email.utils.getaddresses([str(header) for header in to + cc + bcc])
     
     recipientEmailAddresses = set()
     for _, emailAddress in parsedRecipientAddresses:
@@ -65,7 +66,7 @@ def getMessageSenderEmailAddress(message):
     from_ = message.get("From")
     if from_ is None:
         return None
-    _, emailAddress = email.utils.parseaddr(from_)
+    _, emailAddress = email.utils.parseaddr(str(from_))
     if emailAddress is None:
         return None
     return emailAddress.lower()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import email_sec_chal
+import fnmatch
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+
+# Every process keeps its workspaces under its own root, <base>/workspaces/<instance>-<pid>, next to a lock file that
+# it holds for as long as it runs. Several instances can share the temporary directory: a root is swept only once
+# its lock can be taken, that is once its owner is gone. The workspaces that earlier versions kept right in the base
+# directory are swept only while no other process holds its lock.
+class Workspace:
+
+    initialized = False
+    baseDir = None
+    rootDir = None
+    lockFile = None
+    quotaBytes = 0
+    usage = 0
+    nextUsageUpdateTime = 0
+    usageUpdateIntervalSec = 5
+    liveWorkspaces = set()
+    maxLiveCount = 0
+    lock = threading.Lock()
+    legacyPatterns = ["*_official_*", "*_impostor_*", "scratch_*"]
+
+
+    @staticmethod
+    def staticInit():
+        if Workspace.initialized:
+            return
+
+        Workspace.baseDir = None
+        if email_sec_chal.memoryTempDir:
+            try:
+                os.makedirs(email_sec_chal.memoryTempDir, exist_ok=True)
+                Workspace.baseDir = email_sec_chal.memoryTempDir
+            except OSError:
+                logging.warning("EmailSecChal: workspace: Cannot use the memory-backed directory %s, falling back to %s" % (email_sec_chal.memoryTempDir, email_sec_chal.tempDir), exc_info=True)
+        if Workspace.baseDir is None:
+            os.makedirs(email_sec_chal.tempDir, exist_ok=True)
+            Workspace.baseDir = email_sec_chal.tempDir
+        Workspace.quotaBytes = email_sec_chal.tempDirQuotaMb * 1024 * 1024
+        with Workspace.lock:
+            Workspace.liveWorkspaces = set()
+            Workspace.maxLiveCount = 0
+            Workspace.usage = 0
+            Workspace.nextUsageUpdateTime = 0
+
+        ownersDir = os.path.join(Workspace.baseDir, "workspaces")
+        os.makedirs(ownersDir, exist_ok=True)
+        Workspace.rootDir = os.path.join(ownersDir, "%s-%d" % (email_sec_chal.instanceName, os.getpid()))
+        if Workspace.lockFile is not None:
+            Workspace.lockFile.close()
+        # The lock is taken before the root exists, so a root without a held lock is never one that is being created.
+        Workspace.lockFile = open(Workspace.rootDir + ".lock", "a")
+        if fcntl is not None:
+            fcntl.flock(Workspace.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.makedirs(Workspace.rootDir, exist_ok=True)
+        Workspace.sweep()
+
+        logging.info("EmailSecChal: workspace: Using %s for temporary data" % Workspace.rootDir)
+        Workspace.initialized = True
+
+    # Removes the roots of the processes that are gone, the legacy workspaces if no other process is alive and the
+    # workspaces of this process that are not live.
+    @staticmethod
+    def sweep():
+        sweptCount = 0
+        ownersDir = os.path.dirname(Workspace.rootDir)
+        if fcntl is not None:
+            otherOwnerAlive = False
+            for entry in os.listdir(ownersDir):
+                lockPath = os.path.join(ownersDir, entry)
+                if not entry.endswith(".lock") or lockPath == Workspace.lockFile.name:
+                    continue
+                with open(lockPath, "a") as lockFile:
+                    try:
+                        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        otherOwnerAlive = True
+                        continue
+                    shutil.rmtree(lockPath[:-len(".lock")], ignore_errors=True)
+                    os.remove(lockPath)
+                sweptCount += 1
+            if not otherOwnerAlive:
+                for entry in os.listdir(Workspace.baseDir):
+                    path = os.path.join(Workspace.baseDir, entry)
+                    if os.path.isdir(path) and any(fnmatch.fnmatch(entry, pattern) for pattern in Workspace.legacyPatterns):
+                        shutil.rmtree(path, ignore_errors=True)
+                        sweptCount += 1
+        for entry in os.listdir(Workspace.rootDir):
+            path = os.path.join(Workspace.rootDir, entry)
+            with Workspace.lock:
+                if path in Workspace.liveWorkspaces:
+                    continue
+            shutil.rmtree(path, ignore_errors=True)
+            sweptCount += 1
+        if sweptCount > 0:
+            logging.info("EmailSecChal: workspace: Removed %d stale workspaces from %s" % (sweptCount, ownersDir))
+        return sweptCount
+
+    # The usage of the workspaces of this process, recomputed at most every usageUpdateIntervalSec.
+    @staticmethod
+    def getUsage():
+        now = time.monotonic()
+        with Workspace.lock:
+            if now < Workspace.nextUsageUpdateTime:
+                return Workspace.usage
+            Workspace.nextUsageUpdateTime = now + Workspace.usageUpdateIntervalSec
+        usage = 0
+        for dirPath, _, fileNames in os.walk(Workspace.rootDir):
+            for fileName in fileNames:
+                try:
+                    usage += os.lstat(os.path.join(dirPath, fileName)).st_size
+                except OSError:
+                    pass    # Removed in the meantime.
+        with Workspace.lock:
+            Workspace.usage = usage
+        return usage
+
+    @staticmethod
+    def create(prefix):
+        Workspace.staticInit()
+        if Workspace.quotaBytes > 0:
+            usage = Workspace.getUsage()
+            if usage >= Workspace.quotaBytes:
+                raise email_sec_chal.EmailSecChalException("The temporary data quota is exhausted: %d of %d bytes used in %s" % (usage, Workspace.quotaBytes, Workspace.rootDir))
+
+        path = tempfile.mkdtemp(dir = Workspace.rootDir, prefix = prefix)
+        with Workspace.lock:
+            Workspace.liveWorkspaces.add(path)
+            liveCount = len(Workspace.liveWorkspaces)
+            newMaximum = liveCount > Workspace.maxLiveCount
+            Workspace.maxLiveCount = max(liveCount, Workspace.maxLiveCount)
+        if newMaximum:
+            logging.info("EmailSecChal: workspace: %d live workspaces (new maximum)" % liveCount)
+        logging.debug("EmailSecChal: workspace: Created %s, %d live workspaces" % (path, liveCount))
+        return path
+
+    @staticmethod
+    def remove(path):
+        try:
+            shutil.rmtree(path)
+        except:
+            logging.warning("EmailSecChal: workspace: Cannot remove directory %s" % path, exc_info=True)
+        with Workspace.lock:
+            Workspace.liveWorkspaces.discard(path)
+            liveCount = len(Workspace.liveWorkspaces)
+        logging.debug("EmailSecChal: workspace: Removed %s, %d live workspaces" % (path, liveCount))
+
+    @staticmethod
+    def getLiveCount():
+        with Workspace.lock:
+            return len(Workspace.liveWorkspaces)
@@ -18,11 +18,15 @@ setuptools.setup(
     ],
                  
     install_requires = [
-        "python-gnupg >= 0.4.1",
+        "python-gnupg >= 0.5.1, < 0.6",
         "beautifulsoup4 >= 4.4.1",
         "html2text >= 2016.1.8",
         "requests >= 2.9.1"
     ],
+    
+    extras_require = {
+        "in_process": ["PGPy >= 0.5.4"]
+    },
                  
     entry_points = {
         "console_scripts": [
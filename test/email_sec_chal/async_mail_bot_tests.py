@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import asyncio
+import email
+import email.message
+import mailbox
+import os.path
+import shutil
+import threading
+import unittest.mock
+
+
+
+# Stands in for the SMTP server, it is a MailListener in SMTP mode that just keeps the messages.
+class SmtpSink:
+
+    messages = None
+    listener = None
+
+
+    def __init__(self, maxPending=16):
+        self.messages = []
+        self.listener = email_sec_chal.MailListener(self, ("127.0.0.1", 0), False, maxPending)
+        threading.Thread(target=self.listener.serve_forever, daemon=True).start()
+
+    def getPort(self):
+        return self.listener.server_address[1]
+
+    def getPendingCount(self):
+        return 0
+
+    def deliverMessage(self, data):
+        self.messages.append(data)
+        return None
+
+    def close(self):
+        self.listener.shutdown()
+        self.listener.server_close()
+
+
+
+class AsyncMailBotTests(test.email_sec_chal.Tests):
+
+    correspondentEmailAddress = "gbr@voidland.org"
+    correspondentKeyId = "9011E1A9"
+
+    maildirPath = None
+    smtpSink = None
+
+
+    def setUp(self):
+        test.email_sec_chal.Tests.setUp(self)
+        test.email_sec_chal.Tests.clearDb()
+        email_sec_chal.Pgp.storeCorrespondentKey(test.email_sec_chal.Tests.readPublicKey(AsyncMailBotTests.correspondentEmailAddress, AsyncMailBotTests.correspondentKeyId))
+        email_sec_chal.silentPeriodSec = 0
+        email_sec_chal.triggerWords = set(["GC65Z29", "OC13031"])
+
+        AsyncMailBotTests.maildirPath = os.path.join(email_sec_chal.tempDir, "Maildir")
+        shutil.rmtree(AsyncMailBotTests.maildirPath, ignore_errors=True)
+        mailbox.Maildir(AsyncMailBotTests.maildirPath, create=True)
+        AsyncMailBotTests.smtpSink = SmtpSink()
+
+    def tearDown(self):
+        AsyncMailBotTests.smtpSink.close()
+        test.email_sec_chal.Tests.tearDown(self)
+
+    def addMessage(self, msgFileName):
+        msgFilePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "messages", msgFileName + ".eml")
+        with open(msgFilePath, "rb") as f:
+            return mailbox.Maildir(AsyncMailBotTests.maildirPath).add(f.read())
+
+    def createMailBot(self):
+        mailBot = email_sec_chal.AsyncMailBot()
+        mailBot.getMaildirPath = lambda: AsyncMailBotTests.maildirPath
+        mailBot.createSmtpClient = lambda: email_sec_chal.AsyncSmtpClient("127.0.0.1", AsyncMailBotTests.smtpSink.getPort())
+        mailBot.mbox = mailBot.getMailbox()
+        mailBot.repliesAsImpostor = []
+        replied = mailBot.replied
+        def recordReply(asImpostor, emailAddress, msgId):
+            mailBot.repliesAsImpostor.append(asImpostor)
+            replied(asImpostor, emailAddress, msgId)
+        mailBot.replied = recordReply
+        return mailBot
+
+    def processMailbox(self, mailBot):
+        async def processMailboxAsync():
+            mailBot.initRuntime()
+            msgCount = await mailBot.processMailboxAsync()
+            await mailBot.joinAsync()
+            return msgCount
+        return asyncio.run(processMailboxAsync())
+
+
+    def testSendmail(self):
+        client = email_sec_chal.AsyncSmtpClient("127.0.0.1", AsyncMailBotTests.smtpSink.getPort())
+        asyncio.run(client.sendmail("gbr@voidland.voidland.org", "gbr@voidland.org", "Subject: Alabala\n\n.First line\nSecond line"))
+        self.assertEqual([b"Subject: Alabala\r\n\r\n.First line\r\nSecond line\r\n"], AsyncMailBotTests.smtpSink.messages)
+
+    def testSendmailRejected(self):
+        AsyncMailBotTests.smtpSink.listener.maxPending = 0
+        client = email_sec_chal.AsyncSmtpClient("127.0.0.1:%d" % AsyncMailBotTests.smtpSink.getPort())
+        with self.assertRaises(email_sec_chal.EmailSecChalException):
+            asyncio.run(client.sendmail("gbr@voidland.voidland.org", "gbr@voidland.org", "Subject: Alabala\n\n"))
+        self.assertEqual([], AsyncMailBotTests.smtpSink.messages)
+
+    def testHappyPath(self):
+        for i in range(3):
+            self.addMessage("validRequestForOfficialBot")
+        mailBot = self.createMailBot()
+
+        self.assertEqual(3, self.processMailbox(mailBot))
+
+        # In order for the same correspondent: only the first reply is the red herring.
+        self.assertEqual([True, False, False], mailBot.repliesAsImpostor)
+        self.assertEqual(3, len(AsyncMailBotTests.smtpSink.messages))
+        reply = email.message_from_bytes(AsyncMailBotTests.smtpSink.messages[0])
+        self.assertIn(AsyncMailBotTests.correspondentEmailAddress, reply["To"])
+        self.assertEqual("multipart/encrypted", reply.get_content_type())
+        self.assertEqual([], list(mailBot.mbox.iterkeys()))
+        self.assertEqual([], mailBot.mbox.getQuarantineRecords())
+
+    def testSmtpFailureQuarantines(self):
+        msgKey = self.addMessage("validRequestForOfficialBot")
+        mailBot = self.createMailBot()
+        AsyncMailBotTests.smtpSink.listener.maxPending = 0
+
+        self.assertEqual(1, self.processMailbox(mailBot))
+
+        self.assertEqual([], mailBot.repliesAsImpostor)
+        records = mailBot.mbox.getQuarantineRecords()
+        self.assertEqual([msgKey], [record.key for record in records])
+        self.assertTrue(records[0].error.startswith("EmailSecChalException: "))
+        # The reply that was not sent is not recorded.
+        db = email_sec_chal.Db()
+        self.assertEqual(-1, db.getRedHerringSentTimestamp(AsyncMailBotTests.correspondentEmailAddress))
+        self.assertEqual(-1, db.getLastReplyTimestamp(AsyncMailBotTests.correspondentEmailAddress))
+
+    def testSlowMessageDoesNotHoldUpOthers(self):
+        maildir = mailbox.Maildir(AsyncMailBotTests.maildirPath)
+        msgKeys = {}
+        for sender in ("slow@voidland.org", "fast@voidland.org"):
+            msg = email.message.EmailMessage()
+            msg["From"] = sender
+            msg["Subject"] = "Alabala"
+            msgKeys[sender] = maildir.add(msg)
+        mailBot = self.createMailBot()
+        finishedKeys = []
+        async def processMessageAsync(claimedMessage):
+            if claimedMessage.key == msgKeys["slow@voidland.org"]:
+                while not finishedKeys:
+                    await asyncio.sleep(0.01)
+            return None
+        mailBot.processMessageAsync = processMessageAsync
+        finishMessage = mailBot.finishMessage
+        def recordFinish(claimedMessage, future):
+            finishMessage(claimedMessage, future)
+            finishedKeys.append(claimedMessage.key)
+        mailBot.finishMessage = recordFinish
+
+        async def processMailboxAsync():
+            mailBot.initRuntime()
+            mailBot.triage = unittest.mock.MagicMock()      # Neither message is a request.
+            self.assertEqual(2, await mailBot.processMailboxAsync())
+            await asyncio.wait_for(mailBot.joinAsync(), 10)
+        asyncio.run(processMailboxAsync())
+
+        self.assertEqual([msgKeys["fast@voidland.org"], msgKeys["slow@voidland.org"]], finishedKeys)
+        self.assertEqual([], list(mailBot.mbox.iterkeys()))
+        self.assertEqual([], mailBot.mbox.getQuarantineRecords())
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import os.path
+import email
+import email.mime.text
+import sys
+import threading
+import time
+
+# Run with: python -m test.email_sec_chal.benchmarks [iterations]
+
+
+
+def readEncryptedPayload(msgFileName):
+    moduleDir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(moduleDir, "messages", msgFileName + ".eml"), "rb") as f:
+        return email.message_from_binary_file(f).get_payload(1).get_payload().encode()
+
+
+def benchmarkCryptoBackend(backendName, iterations):
+    test.email_sec_chal.Tests.setUpClass()
+    try:
+        email_sec_chal.cryptoBackend = backendName
+        email_sec_chal.keyringPoolWarmUp = True
+        email_sec_chal.Pgp.storeCorrespondentKey(test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "345933AF"))
+        email_sec_chal.Pgp.staticInit()
+
+        officialData = readEncryptedPayload("validRequestForOfficialBot")
+        impostorData = readEncryptedPayload("validRequestForImpostorBot")
+        reply = email.mime.text.MIMEText("Alabala", "plain", "utf-8")
+
+        timings = {"decrypt (official)": 0.0, "decrypt (impostor)": 0.0, "sign and encrypt (official)": 0.0, "sign and encrypt (impostor)": 0.0}
+        for _ in range(iterations):
+            with email_sec_chal.Pgp("gbr@voidland.org") as pgp:
+                for name, operation in [
+                        ("decrypt (official)", lambda: pgp.decrypt(officialData)),
+                        ("decrypt (impostor)", lambda: pgp.decrypt(impostorData)),
+                        ("sign and encrypt (official)", lambda: pgp.signAndEncrypt(reply, False)),
+                        ("sign and encrypt (impostor)", lambda: pgp.signAndEncrypt(reply, True))]:
+                    startTime = time.perf_counter()
+                    operation()
+                    timings[name] += time.perf_counter() - startTime
+
+        for name, timing in timings.items():
+            print("%-12s %-28s %8.2f ms/op" % (backendName, name, timing * 1000 / iterations))
+    finally:
+        email_sec_chal.Pgp.keyringPool.close()
+        test.email_sec_chal.Tests.tearDownClass()
+
+
+# Decrypts messages from different correspondents through the dispatcher, as MailBot does.
+def benchmarkDispatcher(iterations):
+    test.email_sec_chal.Tests.setUpClass()
+    try:
+        cpuCount = os.cpu_count() or 1
+        email_sec_chal.keyringPoolSize = cpuCount
+        email_sec_chal.keyringPoolWarmUp = True
+        email_sec_chal.cryptoWorkerCount = cpuCount
+        email_sec_chal.Pgp.staticInit()
+        officialData = readEncryptedPayload("validRequestForOfficialBot")
+
+        def processMessage(emailAddress):
+            with email_sec_chal.Pgp(emailAddress) as pgp:
+                return email_sec_chal.CryptoExecutor.run(pgp.decrypt, officialData)[0].ok
+
+        msgCount = iterations * cpuCount
+        baseline = None
+        workerCount = 1
+        while True:
+            dispatcher = email_sec_chal.Dispatcher(workerCount)
+            try:
+                startTime = time.perf_counter()
+                futures = [dispatcher.submit("correspondent%d@voidland.org" % i, processMessage, "correspondent%d@voidland.org" % i) for i in range(msgCount)]
+                if not all(future.result() for future in futures):
+                    raise Exception("A message could not be decrypted")
+                throughput = msgCount / (time.perf_counter() - startTime)
+            finally:
+                dispatcher.close()
+            baseline = baseline or throughput
+            print("dispatcher   %2d workers %28.1f msg/s (x%.2f)" % (workerCount, throughput, throughput / baseline))
+            if workerCount >= cpuCount:
+                break
+            workerCount = min(workerCount * 2, cpuCount)
+    finally:
+        email_sec_chal.Pgp.keyringPool.close()
+        email_sec_chal.CryptoExecutor.shutdown()
+        test.email_sec_chal.Tests.tearDownClass()
+
+
+# Two threads look up and update correspondents at the same time, as the key upload server and the bot do. First as it
+# used to be, with a new rollback journal connection for every Db, then with the per thread WAL connections.
+def benchmarkDb(iterations):
+    threadCount = 2
+    opCount = iterations * 50
+    baseline = None
+    for name, journalMode, synchronous, connectionPerDb in [("rollback, connection per Db", "DELETE", "FULL", True), ("WAL, connection per thread", "WAL", "NORMAL", False)]:
+        test.email_sec_chal.Tests.setUpClass()
+        try:
+            email_sec_chal.dbJournalMode = journalMode
+            email_sec_chal.dbSynchronous = synchronous
+            email_sec_chal.Db.staticInit()
+            email_sec_chal.Db.closeConnections()
+
+            def work(threadIndex):
+                for i in range(opCount):
+                    if connectionPerDb:
+                        email_sec_chal.Db.closeConnections()
+                    db = email_sec_chal.Db()
+                    emailAddress = "correspondent%d_%d@voidland.org" % (threadIndex, i % 20)
+                    db.getRedHerringSentTimestamp(emailAddress)
+                    db.redHerringSent(emailAddress)
+                email_sec_chal.Db.closeConnections()
+
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(threadCount)]
+            startTime = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            throughput = threadCount * opCount / (time.perf_counter() - startTime)
+        finally:
+            test.email_sec_chal.Tests.tearDownClass()
+        baseline = baseline or throughput
+        print("db           %-28s %8.1f op/s (x%.2f)" % (name, throughput, throughput / baseline))
+
+
+# Cached correspondent lookups, first reading the cache generation on every lookup as it used to be, then at most every
+# generationCheckIntervalSec.
+def benchmarkCorrespondentCache(iterations):
+    opCount = iterations * 5000
+    baseline = None
+    for name, generationCheckIntervalSec in [("generation read every time", 0), ("generation read every %g s" % email_sec_chal.Db.generationCheckIntervalSec, email_sec_chal.Db.generationCheckIntervalSec)]:
+        test.email_sec_chal.Tests.setUpClass()
+        originalGenerationCheckIntervalSec = email_sec_chal.Db.generationCheckIntervalSec
+        try:
+            email_sec_chal.Db.generationCheckIntervalSec = generationCheckIntervalSec
+            db = email_sec_chal.Db()
+            emailAddresses = ["correspondent%d@voidland.org" % i for i in range(20)]
+            for emailAddress in emailAddresses:
+                db.replySent(emailAddress)
+            startTime = time.perf_counter()
+            for i in range(opCount):
+                db.getLastReplyTimestamp(emailAddresses[i % len(emailAddresses)])
+            throughput = opCount / (time.perf_counter() - startTime)
+        finally:
+            email_sec_chal.Db.generationCheckIntervalSec = originalGenerationCheckIntervalSec
+            email_sec_chal.Db.closeConnections()
+            test.email_sec_chal.Tests.tearDownClass()
+        baseline = baseline or throughput
+        print("db cache     %-28s %8.1f op/s (x%.2f)" % (name, throughput, throughput / baseline))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    backendNames = ["gnupg"]
+    if email_sec_chal.crypto_backend.pgpy is not None:
+        backendNames.append("in_process")
+    for backendName in backendNames:
+        benchmarkCryptoBackend(backendName, iterations)
+    benchmarkDispatcher(iterations)
+    benchmarkDb(iterations)
+    benchmarkCorrespondentCache(iterations)
+
+
+if __name__ == "__main__":
+    main()
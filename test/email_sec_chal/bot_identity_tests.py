@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import os
+import shutil
+import unittest.mock
+
+
+
+class BotIdentityTests(test.email_sec_chal.Tests):
+
+    def setUp(self):
+        email_sec_chal.BotIdentity.initialized = False
+        cacheFilePath = os.path.join(email_sec_chal.dataDir, "bot_identities.json")
+        if os.access(cacheFilePath, os.F_OK):
+            os.remove(cacheFilePath)
+
+
+    def testIdentity(self):
+        officialIdentity = email_sec_chal.BotIdentity.get("official")
+        self.assertEqual({"B509A2EB802708CE80C2C3E54897D47A61DC9FE3"}, set(officialIdentity.fingerprints))
+        self.assertEqual(["4897D47A61DC9FE3", "124506658FB05FAD"], sorted(officialIdentity.keyIds, key=lambda keyId: keyId != "4897D47A61DC9FE3"))
+        self.assertIn("<gbr@voidland.voidland.org>", officialIdentity.uids[0])
+        self.assertTrue(officialIdentity.publicKey.startswith("-----BEGIN PGP PUBLIC KEY BLOCK-----"))
+        self.assertNotIn("PRIVATE KEY", officialIdentity.publicKey)
+
+        impostorIdentity = email_sec_chal.BotIdentity.get("impostor")
+        self.assertEqual({"4EE368B05671332D6F7C105851C494F69E5FFE34"}, set(impostorIdentity.fingerprints))
+        self.assertEqual(impostorIdentity.publicKey, email_sec_chal.Pgp().getImpostorPublicKey())
+
+    def testPersistedIdentity(self):
+        officialPublicKey = email_sec_chal.BotIdentity.get("official").publicKey
+        self.assertTrue(os.access(os.path.join(email_sec_chal.dataDir, "bot_identities.json"), os.F_OK))
+
+        email_sec_chal.BotIdentity.initialized = False
+        with unittest.mock.patch.object(email_sec_chal.BotIdentity, "compute") as compute:
+            self.assertEqual(officialPublicKey, email_sec_chal.BotIdentity.get("official").publicKey)
+            self.assertEqual(0, compute.call_count)
+
+    def testRefreshOnKeyFileChange(self):
+        resourceDir = os.path.join(email_sec_chal.tempDir, "res")
+        os.makedirs(resourceDir, exist_ok=True)
+        for botName in email_sec_chal.BotIdentity.botNames:
+            shutil.copy2(os.path.join(email_sec_chal.resourceDir, botName + "Bot.asc"), resourceDir)
+        saveResourceDir = email_sec_chal.resourceDir
+        email_sec_chal.resourceDir = resourceDir
+        try:
+            email_sec_chal.BotIdentity.staticInit()
+            impostorKeysFilePath = os.path.join(resourceDir, "impostorBot.asc")
+            keysFileStat = os.stat(impostorKeysFilePath)
+            os.utime(impostorKeysFilePath, (keysFileStat.st_atime, keysFileStat.st_mtime + 10))
+
+            email_sec_chal.BotIdentity.initialized = False
+            with unittest.mock.patch.object(email_sec_chal.BotIdentity, "compute", wraps=email_sec_chal.BotIdentity.compute) as compute:
+                email_sec_chal.BotIdentity.staticInit()
+                self.assertEqual(["impostor"], [args[0] for args, _ in compute.call_args_list])
+            self.assertEqual(keysFileStat.st_mtime + 10, email_sec_chal.BotIdentity.get("impostor").keysFileTime)
+        finally:
+            email_sec_chal.resourceDir = saveResourceDir
+            email_sec_chal.BotIdentity.initialized = False
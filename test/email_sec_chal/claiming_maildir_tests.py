@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import email.message
+import mailbox
+import os
+import shutil
+import threading
+import time
+import unittest.mock
+
+
+
+class ClaimingMaildirTests(test.email_sec_chal.Tests):
+
+    maildirPath = None
+
+
+    def setUp(self):
+        ClaimingMaildirTests.maildirPath = os.path.join(email_sec_chal.tempDir, "Maildir")
+        shutil.rmtree(ClaimingMaildirTests.maildirPath, ignore_errors=True)
+        mailbox.Maildir(ClaimingMaildirTests.maildirPath, create=True)
+
+    def createMaildir(self, instanceName="bot1"):
+        return email_sec_chal.ClaimingMaildir(ClaimingMaildirTests.maildirPath, os.path.join(ClaimingMaildirTests.maildirPath, "processing", instanceName))
+
+    def addMessage(self, subject="Alabala", sender="gbr@voidland.org"):
+        msg = email.message.EmailMessage()
+        msg["From"] = sender
+        msg["Subject"] = subject
+        return mailbox.Maildir(ClaimingMaildirTests.maildirPath).add(msg)
+
+    def listProcessingDir(self, instanceName="bot1"):
+        processingDir = os.path.join(ClaimingMaildirTests.maildirPath, "processing", instanceName)
+        return os.listdir(os.path.join(processingDir, "new")) + os.listdir(os.path.join(processingDir, "cur"))
+
+
+    def testClaimAndComplete(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+
+        claimedMessage = maildir.claim(msgKey)
+        self.assertEqual(msgKey, claimedMessage.key)
+        self.assertEqual("Alabala", claimedMessage.headers["Subject"])
+        self.assertIsNone(claimedMessage.message)
+        self.assertEqual("Alabala", claimedMessage.getMessage()["Subject"])
+        self.assertEqual([], list(maildir.iterkeys()))
+        self.assertEqual([os.path.basename(claimedMessage.claimedPath)], self.listProcessingDir())
+
+        maildir.complete(claimedMessage)
+        self.assertEqual([], self.listProcessingDir())
+        self.assertEqual([], list(maildir.iterkeys()))
+
+    def testClaimedOnlyOnce(self):
+        msgKey = self.addMessage()
+        maildir1 = self.createMaildir("bot1")
+        maildir2 = self.createMaildir("bot2")
+        self.assertEqual([msgKey], list(maildir2.iterkeys()))
+
+        self.assertIsNotNone(maildir1.claim(msgKey))
+        self.assertIsNone(maildir2.claim(msgKey))
+        self.assertEqual([], self.listProcessingDir("bot2"))
+
+    def testRequeue(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+
+        maildir.requeue(maildir.claim(msgKey))
+        self.assertEqual([msgKey], list(maildir.iterkeys()))
+        self.assertEqual([], self.listProcessingDir())
+
+    def testRecover(self):
+        msgKeys = [self.addMessage(), self.addMessage()]
+        maildir = self.createMaildir()
+        for msgKey in msgKeys:
+            maildir.claim(msgKey)
+
+        maildir = self.createMaildir()
+        self.assertEqual(2, maildir.recover())
+        self.assertEqual(sorted(msgKeys), sorted(maildir.iterkeys()))
+        self.assertEqual(0, self.createMaildir("bot2").recover())
+
+    def testRecoverRefusedWhileOwnerAlive(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+        maildir.recover()
+        maildir.claim(msgKey)
+
+        otherMaildir = self.createMaildir()
+        with self.assertRaises(email_sec_chal.EmailSecChalException):
+            otherMaildir.recover()
+        self.assertEqual(1, len(self.listProcessingDir()))
+        self.assertEqual(0, self.createMaildir("bot2").recover())
+
+        maildir.close()
+        self.assertEqual(1, otherMaildir.recover())
+        self.assertEqual([msgKey], list(otherMaildir.iterkeys()))
+        otherMaildir.close()
+
+    def testQuarantine(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+
+        record = maildir.quarantine(maildir.claim(msgKey), "Exception: failing", 1000)
+        self.assertEqual(1, record.attempts)
+        self.assertEqual(1060, record.nextRetryTime)
+        self.assertEqual([], list(maildir.iterkeys()))
+        self.assertEqual([], self.listProcessingDir())
+        self.assertEqual([], maildir.claimQuarantined(1059))
+
+        # The record survives a restart.
+        maildir = self.createMaildir("bot2")
+        records = maildir.getQuarantineRecords()
+        self.assertEqual(1, len(records))
+        self.assertEqual("Exception: failing", records[0].error)
+        claimedMessage = maildir.claimQuarantined(1060)[0]
+        self.assertEqual(msgKey, claimedMessage.key)
+        self.assertEqual("Alabala", claimedMessage.headers["Subject"])
+        self.assertEqual([], maildir.claimQuarantined(1060))
+
+        record = maildir.quarantine(claimedMessage, "Exception: failing again", 1100)
+        self.assertEqual(2, record.attempts)
+        self.assertEqual(1220, record.nextRetryTime)
+        claimedMessage = maildir.claimQuarantined(1220)[0]
+        maildir.complete(claimedMessage)
+        self.assertEqual([], maildir.getQuarantineRecords())
+        self.assertEqual([], self.listProcessingDir("bot2"))
+
+    def testRecoverQuarantined(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+        maildir.quarantine(maildir.claim(msgKey), "Exception: failing", 1000)
+        maildir.claimQuarantined(2000)
+
+        maildir = self.createMaildir()
+        self.assertEqual(1, maildir.recover())
+        self.assertEqual([], list(maildir.iterkeys()))
+        self.assertEqual(1, len(maildir.claimQuarantined(2000)))
+
+    def testQuarantineReadOnlyWhenDue(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+        maildir.quarantine(maildir.claim(msgKey), "Exception: failing", 1000)
+        recordsDir = os.path.join(ClaimingMaildirTests.maildirPath, "quarantine", "records")
+        os.utime(recordsDir, (0, 0))
+        self.assertEqual([], maildir.claimQuarantined(1000))
+
+        with unittest.mock.patch.object(email_sec_chal.QuarantineRecord, "load", wraps=email_sec_chal.QuarantineRecord.load) as load:
+            self.assertEqual([], maildir.claimQuarantined(1059))
+            self.assertEqual(0, load.call_count)
+            # Written by another instance.
+            otherMsgKey = self.addMessage()
+            otherMaildir = self.createMaildir("bot2")
+            otherMaildir.quarantine(otherMaildir.claim(otherMsgKey), "Exception: failing", 900)
+            self.assertEqual([otherMsgKey], [claimedMessage.key for claimedMessage in maildir.claimQuarantined(1000)])
+            self.assertEqual(2, load.call_count)
+        os.utime(recordsDir, (0, 0))
+        maildir.claimQuarantined(1000)
+        self.assertEqual([msgKey], [claimedMessage.key for claimedMessage in maildir.claimQuarantined(1060)])
+
+    def testQuarantineGivenUp(self):
+        msgKey = self.addMessage()
+        maildir = self.createMaildir()
+        email_sec_chal.quarantineMaxAttempts = 1
+        try:
+            record = maildir.quarantine(maildir.claim(msgKey), "Exception: failing", 1000)
+        finally:
+            email_sec_chal.quarantineMaxAttempts = 10
+        self.assertIsNone(record.nextRetryTime)
+        self.assertEqual([], os.listdir(os.path.join(ClaimingMaildirTests.maildirPath, "quarantine", "records")))
+        self.assertEqual([msgKey], [record.key for record in maildir.getQuarantineRecords()])
+        with unittest.mock.patch.object(email_sec_chal.QuarantineRecord, "load") as load:
+            self.assertEqual([], maildir.claimQuarantined(float("inf")))
+            self.assertEqual(0, load.call_count)
+
+    def testDedupKey(self):
+        msg = email.message.EmailMessage()
+        msg["Message-ID"] = "<1234@voidland.org>"
+        msg["Subject"] = "Alabala"
+        msg.set_content("Body")
+        noMsgIdKey = self.addMessage()
+        msgKey = mailbox.Maildir(ClaimingMaildirTests.maildirPath).add(msg)
+        crlfMsgKey = mailbox.Maildir(ClaimingMaildirTests.maildirPath).add(msg.as_bytes().replace(b"\n", b"\r\n"))
+        maildir = self.createMaildir()
+
+        self.assertIsNone(maildir.claim(noMsgIdKey).getDedupKey())
+        dedupKey = maildir.claim(msgKey).getDedupKey()
+        self.assertIsNotNone(dedupKey)
+        self.assertEqual(dedupKey, maildir.claim(crlfMsgKey).getDedupKey())
+        self.assertEqual(dedupKey, email_sec_chal.ClaimedMessage("key", msg).getDedupKey())
+        msg.set_content("Other body")
+        self.assertNotEqual(dedupKey, email_sec_chal.ClaimedMessage("key", msg).getDedupKey())
+
+    def createMailBot(self, workerCount):
+        mailBot = email_sec_chal.MailBot()
+        mailBot.getMaildirPath = unittest.mock.MagicMock(return_value=ClaimingMaildirTests.maildirPath)
+        mailBot.mbox = mailBot.getMailbox()
+        mailBot.threadLocal = threading.local()
+        mailBot.triage = unittest.mock.MagicMock()
+        mailBot.rateLimiter = email_sec_chal.RateLimiter()
+        mailBot.dispatcher = email_sec_chal.Dispatcher(workerCount)
+        return mailBot
+
+    def testMailBotClaimsAndRequeues(self):
+        validMsgKey = self.addMessage("valid", "valid@voidland.org")
+        failingMsgKey = self.addMessage("failing", "failing@voidland.org")
+
+        mailBot = self.createMailBot(2)
+        def processMessage(claimedMessage):
+            self.assertEqual([], list(mailBot.mbox.iterkeys()))     # Both are claimed before processing starts.
+            return None if claimedMessage.getMessage()["Subject"] == "valid" else "Exception: failing"
+        mailBot.processMessage = processMessage
+        try:
+            self.assertEqual(2, mailBot.processMailbox())
+            self.assertTrue(mailBot.dispatcher.join(10))
+        finally:
+            mailBot.dispatcher.close()
+
+        self.assertEqual([failingMsgKey], [record.key for record in mailBot.mbox.getQuarantineRecords()])
+        self.assertEqual([], list(mailBot.mbox.iterkeys()))
+        self.assertEqual([], self.listProcessingDir(email_sec_chal.instanceName))
+
+    def testMailBotDoesNotWaitForSlowMessages(self):
+        self.addMessage("slow", "slow@voidland.org")
+        self.addMessage("fast", "fast@voidland.org")
+        mailBot = self.createMailBot(2)
+        release = threading.Event()
+        def processMessage(claimedMessage):
+            if claimedMessage.getMessage()["Subject"] == "slow":
+                release.wait(10)
+            return None
+        mailBot.processMessage = processMessage
+        try:
+            self.assertEqual(2, mailBot.processMailbox())
+            for _ in range(1000):
+                if len(self.listProcessingDir(email_sec_chal.instanceName)) == 1:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(1, len(self.listProcessingDir(email_sec_chal.instanceName)))      # Only the slow one is still in flight.
+
+            self.addMessage("fast", "fast@voidland.org")
+            self.assertEqual(1, mailBot.processMailbox())           # Claimed while the slow one is in flight.
+            release.set()
+            self.assertTrue(mailBot.dispatcher.join(10))
+        finally:
+            release.set()
+            mailBot.dispatcher.close()
+        self.assertEqual([], self.listProcessingDir(email_sec_chal.instanceName))
+        self.assertEqual([], list(mailBot.mbox.iterkeys()))
+        self.assertEqual([], mailBot.mbox.getQuarantineRecords())
+
+    def testMailBotClaimsOnlyWhatMayWait(self):
+        email_sec_chal.maildirMaxPending = 2
+        for i in range(4):
+            self.addMessage("message%d" % i, "gbr@voidland.org")
+        mailBot = self.createMailBot(1)
+        release = threading.Event()
+        mailBot.processMessage = lambda claimedMessage: release.wait(10) and None
+        try:
+            self.assertEqual(2, mailBot.processMailbox())
+            self.assertTrue(mailBot.claimLimited)
+            self.assertEqual(2, len(list(mailBot.mbox.iterkeys())))
+            self.assertTrue(mailBot.dispatcher.waitForPendingCount(2, 10))     # The worker took the first one.
+            self.assertEqual(1, mailBot.processMailbox())
+            self.assertEqual(1, len(list(mailBot.mbox.iterkeys())))
+            release.set()
+            self.assertTrue(mailBot.dispatcher.join(10))
+            self.assertEqual(1, mailBot.processMailbox())
+            self.assertFalse(mailBot.claimLimited)
+            self.assertTrue(mailBot.dispatcher.join(10))
+        finally:
+            release.set()
+            mailBot.dispatcher.close()
+        self.assertEqual([], self.listProcessingDir(email_sec_chal.instanceName))
+        self.assertEqual([], list(mailBot.mbox.iterkeys()))
+
+    def testNextRetryTimeOfNewQuarantineRecords(self):
+        msgKeys = [self.addMessage(), self.addMessage()]
+        maildir = self.createMaildir()
+        self.assertEqual([], maildir.claimQuarantined(1000))
+        self.assertIsNone(maildir.nextRetryTime)
+
+        maildir.quarantine(maildir.claim(msgKeys[0]), "Exception: failing", 1000)
+        self.assertEqual(1060, maildir.nextRetryTime)
+        maildir.defer(maildir.claim(msgKeys[1]), "rate limited", 1030)
+        self.assertEqual(1030, maildir.nextRetryTime)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import asyncio
+import subprocess
+import threading
+import time
+
+
+
+class CryptoExecutorTests(test.email_sec_chal.Tests):
+
+    def setUp(self):
+        email_sec_chal.CryptoExecutor.shutdown()
+        email_sec_chal.cryptoWorkerCount = 4
+        email_sec_chal.cryptoOperationTimeoutSec = 60
+
+    def tearDown(self):
+        email_sec_chal.CryptoExecutor.shutdown()
+        email_sec_chal.cryptoWorkerCount = 0
+        email_sec_chal.cryptoOperationTimeoutSec = 60
+
+
+    def testRun(self):
+        self.assertEqual(5, email_sec_chal.CryptoExecutor.run(lambda a, b: a + b, 2, 3))
+        with self.assertRaises(ZeroDivisionError):
+            email_sec_chal.CryptoExecutor.run(lambda: 1 / 0)
+        self.assertEqual(4, email_sec_chal.CryptoExecutor.workerCount)
+
+    def testDefaultWorkerCount(self):
+        email_sec_chal.cryptoWorkerCount = 0
+        email_sec_chal.CryptoExecutor.staticInit()
+        self.assertGreaterEqual(email_sec_chal.CryptoExecutor.workerCount, 1)
+
+    def testParallelOperations(self):
+        barrier = threading.Barrier(4, timeout = 10)
+        futures = [email_sec_chal.CryptoExecutor.submit(barrier.wait) for _ in range(4)]
+        self.assertEqual({0, 1, 2, 3}, {email_sec_chal.CryptoExecutor.wait(future) for future in futures})
+
+    def testTimeoutKillsProcesses(self):
+        email_sec_chal.cryptoOperationTimeoutSec = 1
+        processes = []
+        def hang():
+            process = subprocess.Popen(["sleep", "30"])
+            processes.append(process)
+            email_sec_chal.CryptoExecutor.registerProcess(process)
+            return process.wait()
+
+        startTime = time.monotonic()
+        with self.assertRaises(email_sec_chal.PgpException):
+            email_sec_chal.CryptoExecutor.run(hang)
+        self.assertEqual(-9, processes[0].wait(timeout = 10))
+        self.assertLess(time.monotonic() - startTime, 10)
+
+        self.assertEqual(5, email_sec_chal.CryptoExecutor.run(lambda: 5))
+
+    def testTimeoutExcludesQueueTime(self):
+        email_sec_chal.cryptoWorkerCount = 1
+        email_sec_chal.cryptoOperationTimeoutSec = 1
+        futures = [email_sec_chal.CryptoExecutor.submit(time.sleep, 0.7) for _ in range(2)]
+        for future in futures:
+            email_sec_chal.CryptoExecutor.wait(future)
+
+        futures = [email_sec_chal.CryptoExecutor.submit(time.sleep, 3), email_sec_chal.CryptoExecutor.submit(lambda: 5)]
+        with self.assertRaises(email_sec_chal.PgpException):
+            email_sec_chal.CryptoExecutor.wait(futures[0])
+        self.assertEqual(5, email_sec_chal.CryptoExecutor.wait(futures[1]))
+
+    def testGpgProcessesAreRegistered(self):
+        gnupgHomeDir = email_sec_chal.Workspace.create("scratch_")
+        registeredProcesses = []
+        def listKeys():
+            keys = email_sec_chal.GnupgCryptoBackend(gnupgHomeDir).listKeys()
+            registeredProcesses.extend(email_sec_chal.CryptoExecutor.threadLocal.operation.processes)
+            return keys
+
+        try:
+            self.assertEqual([], email_sec_chal.CryptoExecutor.run(listKeys))
+        finally:
+            email_sec_chal.Workspace.remove(gnupgHomeDir)
+        self.assertTrue(registeredProcesses)
+        self.assertTrue(all(process.poll() is not None for process in registeredProcesses))
+
+    def testRunAsync(self):
+        self.assertEqual(5, asyncio.run(email_sec_chal.CryptoExecutor.runAsync(lambda a, b: a + b, 2, 3)))
+        # Nested operations run inline on the worker of the outer one.
+        self.assertEqual(7, asyncio.run(email_sec_chal.CryptoExecutor.runAsync(email_sec_chal.CryptoExecutor.run, lambda: 7)))
+
+        email_sec_chal.cryptoOperationTimeoutSec = 1
+        with self.assertRaises(email_sec_chal.PgpException):
+            asyncio.run(email_sec_chal.CryptoExecutor.runAsync(time.sleep, 3))
+
+        email_sec_chal.CryptoExecutor.shutdown()
+        email_sec_chal.cryptoWorkerCount = 1
+        async def runQueued():
+            return await asyncio.gather(*[email_sec_chal.CryptoExecutor.runAsync(time.sleep, 0.7) for _ in range(2)])
+        self.assertEqual([None, None], asyncio.run(runQueued()))
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import test.email_sec_chal
 import email_sec_chal
+import os.path
+import sqlite3
+import threading
 import time
+import unittest.mock
 
 
 
@@ -58,3 +62,328 @@ class DbTests(test.email_sec_chal.Tests):
         db.redHerringSent(DbTests.correspondentEmailAddress)
         redHerringSentTimestamp2 = db.getRedHerringSentTimestamp(DbTests.correspondentEmailAddress)
         self.assertEqual(redHerringSentTimestamp1, redHerringSentTimestamp2)
+
+    def testSeenMessages(self):
+        db = email_sec_chal.Db()
+        email_sec_chal.dedupTtlSec = 604800
+        try:
+            self.assertFalse(db.isMessageSeen("dedupKey1"))
+            db.messageSeen("dedupKey1")
+            self.assertTrue(db.isMessageSeen("dedupKey1"))
+
+            email_sec_chal.dedupMaxEntries = 2
+            try:
+                email_sec_chal.Db.nextSeenMessagesEvictionTime = time.time() + 3600
+                for i in range(4):
+                    db.messageSeen("dedupKey%d" % i)
+                self.assertEqual(4, db.getSeenMessagesCount())
+                db.evictSeenMessages()
+            finally:
+                email_sec_chal.dedupMaxEntries = 100000
+                email_sec_chal.Db.nextSeenMessagesEvictionTime = 0
+            self.assertEqual(2, db.getSeenMessagesCount())
+            self.assertTrue(db.isMessageSeen("dedupKey3"))
+            self.assertFalse(db.isMessageSeen("dedupKey0"))
+        finally:
+            email_sec_chal.dedupTtlSec = 0
+        self.assertFalse(db.isMessageSeen("dedupKey3"))
+        db.evictSeenMessages()
+        self.assertEqual(0, db.getSeenMessagesCount())
+
+    def testCoalescingWindow(self):
+        db = email_sec_chal.Db()
+        self.assertEqual(-1, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+        db.replySent(DbTests.correspondentEmailAddress)
+        self.assertGreaterEqual(db.getLastReplyTimestamp(DbTests.correspondentEmailAddress), 0)
+        self.assertFalse(db.isInCoalescingWindow(DbTests.correspondentEmailAddress))
+
+        email_sec_chal.coalescingWindowSec = 60
+        try:
+            self.assertTrue(db.isInCoalescingWindow(DbTests.correspondentEmailAddress))
+            self.assertFalse(db.isInCoalescingWindow("someone@voidland.org"))
+            db.conn.execute("UPDATE correspondents SET last_reply = last_reply - 60")
+            email_sec_chal.Db.clearCache()
+            self.assertFalse(db.isInCoalescingWindow(DbTests.correspondentEmailAddress))
+        finally:
+            email_sec_chal.coalescingWindowSec = 0
+
+    def testConnectionPerThread(self):
+        conn = email_sec_chal.Db().conn
+        self.assertIs(conn, email_sec_chal.Db().conn)
+        self.assertEqual("wal", conn.execute("PRAGMA journal_mode").fetchone()[0])
+
+        otherConns = []
+        thread = threading.Thread(target=lambda: otherConns.append(email_sec_chal.Db().conn))
+        thread.start()
+        thread.join()
+        self.assertIsNot(conn, otherConns[0])
+
+        email_sec_chal.Db.closeConnections()
+        self.assertIsNot(conn, email_sec_chal.Db().conn)
+
+    def testSetCorrespondentKeys(self):
+        db = email_sec_chal.Db()
+        db.redHerringSent("a@voidland.org")
+        db.replySent("a@voidland.org")
+        lastReplyTimestamp = db.getLastReplyTimestamp("a@voidland.org")
+
+        db.setCorrespondentKeys(["A@voidland.org", "b@voidland.org"], "key")
+        self.assertEqual(2, db.getCorrespondentsCount())
+        for emailAddress in ["a@voidland.org", "b@voidland.org"]:
+            self.assertEqual("key", db.getCorrespondentKey(emailAddress))
+            self.assertEqual(-1, db.getRedHerringSentTimestamp(emailAddress))
+        self.assertEqual(lastReplyTimestamp, db.getLastReplyTimestamp("a@voidland.org"))
+
+        db.redHerringSent("b@voidland.org")
+        redHerringSentTimestamp = db.getRedHerringSentTimestamp("b@voidland.org")
+        db.conn.execute("UPDATE correspondents SET red_herring_sent = red_herring_sent - 60")
+        email_sec_chal.Db.clearCache()
+        db.redHerringSent("b@voidland.org")
+        self.assertEqual(redHerringSentTimestamp - 60, db.getRedHerringSentTimestamp("b@voidland.org"))
+
+        self.assertEqual({"key"}, db.setCorrespondentKeys(["a@voidland.org", "c@voidland.org"], "other key"))
+        self.assertEqual(set(), db.setCorrespondentKey("a@voidland.org", "other key"))
+
+    def testReserveReply(self):
+        db = email_sec_chal.Db()
+        self.assertEqual((None, None), db.reserveReply(DbTests.correspondentEmailAddress, lambda: None))
+        self.assertEqual(-1, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+
+        asImpostor, reservation = db.reserveReply(DbTests.correspondentEmailAddress, lambda: True)
+        self.assertTrue(asImpostor)
+        self.assertGreaterEqual(db.getRedHerringSentTimestamp(DbTests.correspondentEmailAddress), 0)
+        self.assertGreaterEqual(db.getLastReplyTimestamp(DbTests.correspondentEmailAddress), 0)
+        db.cancelReply(DbTests.correspondentEmailAddress, reservation)
+        self.assertEqual(-1, db.getRedHerringSentTimestamp(DbTests.correspondentEmailAddress))
+        self.assertEqual(-1, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+
+        # A reply recorded in the meantime is kept.
+        _, reservation = db.reserveReply(DbTests.correspondentEmailAddress, lambda: False)
+        db.conn.execute("UPDATE correspondents SET last_reply = last_reply + 60")
+        email_sec_chal.Db.clearCache()
+        lastReplyTimestamp = db.getLastReplyTimestamp(DbTests.correspondentEmailAddress)
+        db.cancelReply(DbTests.correspondentEmailAddress, reservation)
+        self.assertEqual(lastReplyTimestamp, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+
+    def testTransactionRolledBack(self):
+        db = email_sec_chal.Db()
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.replySent("a@voidland.org")
+                raise ValueError("failing")
+        self.assertEqual(0, db.getCorrespondentsCount())
+        self.assertFalse(db.conn.in_transaction)
+
+    def testKeysStoredOnce(self):
+        email_sec_chal.Pgp.storeCorrespondentKey(DbTests.correspondentPublicKey)
+        db = email_sec_chal.Db()
+        emailAddresses = [row[0] for row in db.conn.execute("SELECT email_address FROM correspondents")]
+        self.assertEqual(1, db.getKeysCount())
+        key = db.getCorrespondentKey(DbTests.correspondentEmailAddress)
+        self.assertEqual(email_sec_chal.openpgp.minimizeKeys(DbTests.correspondentPublicKey).key, key)
+        keyHash, data, armorType, compressed = db.conn.execute("SELECT hash, data, armor_type, compressed FROM keys").fetchone()
+        self.assertEqual("PUBLIC KEY BLOCK", armorType)
+        self.assertLess(len(data), len(key))
+
+        db.setCorrespondentKeys(["someone@voidland.org"], "not an armored key")
+        self.assertEqual("not an armored key", db.getCorrespondentKey("someone@voidland.org"))
+        self.assertEqual(2, db.getKeysCount())
+        db.setCorrespondentKeys(emailAddresses + ["someone@voidland.org"], key)
+        self.assertEqual(1, db.getKeysCount())
+        self.assertEqual(keyHash, db.conn.execute("SELECT hash FROM keys").fetchone()[0])
+
+    def assertNoOrphanKeys(self, db):
+        self.assertEqual(0, db.conn.execute("SELECT COUNT(*) FROM keys WHERE hash NOT IN (SELECT key_hash FROM correspondents WHERE key_hash IS NOT NULL)").fetchone()[0])
+
+    def testNoOrphanKeysAfterReplacement(self):
+        db = email_sec_chal.Db()
+        db.setCorrespondentKeys(["a@voidland.org", "b@voidland.org"], "key 1")
+        self.assertEqual({"key 1"}, db.setCorrespondentKeys(["a@voidland.org"], "key 2"))
+        self.assertNoOrphanKeys(db)
+        self.assertEqual({"key 1"}, db.setCorrespondentKeys(["b@voidland.org"], "key 2"))
+        self.assertNoOrphanKeys(db)
+        self.assertEqual(1, db.getKeysCount())
+
+        # The cached row is stale, the key really replaced is the one in the DB.
+        db.getCorrespondentKey("a@voidland.org")
+        keyHash = email_sec_chal.Db.storeKey(db.conn.cursor(), "key 3")
+        db.conn.execute("UPDATE correspondents SET key_hash = ? WHERE email_address = 'a@voidland.org'", (keyHash, ))
+        self.assertEqual({"key 3"}, db.setCorrespondentKeys(["a@voidland.org"], "key 4"))
+        self.assertNoOrphanKeys(db)
+
+        self.assertEqual(set(), db.setCorrespondentKeys([], "key 5"))
+        self.assertNoOrphanKeys(db)
+        self.assertEqual(2, db.getKeysCount())
+
+    def testSqliteVersionChecked(self):
+        email_sec_chal.Db.initialized = False
+        with unittest.mock.patch.object(sqlite3, "sqlite_version_info", (3, 34, 1)):
+            with self.assertRaises(email_sec_chal.EmailSecChalException):
+                email_sec_chal.Db.staticInit()
+        email_sec_chal.Db.staticInit()
+
+    def testKeysMigration(self):
+        saveDataDir = email_sec_chal.dataDir
+        email_sec_chal.dataDir = os.path.join(email_sec_chal.tempDir, "migration")
+        email_sec_chal.Db.initialized = False
+        try:
+            os.makedirs(email_sec_chal.dataDir)
+            conn = sqlite3.connect(email_sec_chal.Db.getDbFilePath(), isolation_level=None)
+            conn.execute("CREATE TABLE correspondents (email_address TEXT PRIMARY KEY, key TEXT DEFAULT NULL, red_herring_sent INTEGER DEFAULT -1)")
+            key = email_sec_chal.openpgp.minimizeKeys(DbTests.correspondentPublicKey).key
+            for emailAddress in ["a@voidland.org", "b@voidland.org"]:
+                conn.execute("INSERT INTO correspondents (email_address, key, red_herring_sent) VALUES(?, ?, 1000)", (emailAddress, key))
+            conn.execute("INSERT INTO correspondents (email_address) VALUES('c@voidland.org')")
+            conn.close()
+
+            db = email_sec_chal.Db()
+            self.assertEqual(1, db.getKeysCount())
+            self.assertEqual(key, db.getCorrespondentKey("a@voidland.org"))
+            self.assertEqual(key, db.getCorrespondentKey("b@voidland.org"))
+            self.assertIsNone(db.getCorrespondentKey("c@voidland.org"))
+            self.assertEqual(1000, db.getRedHerringSentTimestamp("a@voidland.org"))
+            self.assertNotIn("key", [row[1] for row in db.conn.execute("PRAGMA table_info(correspondents)")])
+            self.assertEqual(len(email_sec_chal.Db.getMigrations()), db.conn.execute("PRAGMA user_version").fetchone()[0])
+        finally:
+            email_sec_chal.Db.closeConnections()
+            email_sec_chal.dataDir = saveDataDir
+            email_sec_chal.Db.initialized = False
+
+    # A DB from before the versioning, created by the very first schema, goes through all the migrations.
+    def testMigrationFromVersion0(self):
+        saveDataDir = email_sec_chal.dataDir
+        email_sec_chal.dataDir = os.path.join(email_sec_chal.tempDir, "migration0")
+        email_sec_chal.Db.initialized = False
+        try:
+            os.makedirs(email_sec_chal.dataDir)
+            conn = sqlite3.connect(email_sec_chal.Db.getDbFilePath(), isolation_level=None)
+            conn.execute("CREATE TABLE correspondents (email_address TEXT PRIMARY KEY, key TEXT DEFAULT NULL, red_herring_sent INTEGER DEFAULT -1)")
+            armoredKey = email_sec_chal.openpgp.minimizeKeys(DbTests.correspondentPublicKey).key
+            keys = {}
+            for i in range(50):
+                keys["correspondent%d@voidland.org" % i] = [armoredKey, "not an armored key %d" % (i % 5), None][i % 3]
+            for emailAddress, key in keys.items():
+                conn.execute("INSERT INTO correspondents (email_address, key, red_herring_sent) VALUES(?, ?, ?)", (emailAddress, key, len(emailAddress)))
+            conn.close()
+
+            db = email_sec_chal.Db()
+            self.assertEqual(len(email_sec_chal.Db.getMigrations()), db.conn.execute("PRAGMA user_version").fetchone()[0])
+            self.assertEqual(len(keys), db.getCorrespondentsCount())
+            self.assertEqual(len(set(keys.values()) - {None}), db.getKeysCount())
+            for emailAddress, key in keys.items():
+                self.assertEqual(key, db.getCorrespondentKey(emailAddress))
+                self.assertEqual(len(emailAddress), db.getRedHerringSentTimestamp(emailAddress))
+                self.assertEqual(-1, db.getLastReplyTimestamp(emailAddress))
+            self.assertEqual(["email_address", "red_herring_sent", "last_reply", "key_hash"], email_sec_chal.Db.getColumnNames(db.conn.cursor(), "correspondents"))
+            self.assertEqual(0, db.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'correspondents_new'").fetchone()[0])
+        finally:
+            email_sec_chal.Db.closeConnections()
+            email_sec_chal.dataDir = saveDataDir
+            email_sec_chal.Db.initialized = False
+
+    def testCorrespondentCache(self):
+        db = email_sec_chal.Db()
+        self.assertEqual(-1, db.getRedHerringSentTimestamp(DbTests.correspondentEmailAddress))
+        self.assertIn(DbTests.correspondentEmailAddress, email_sec_chal.Db.correspondentCache)
+
+        # Written through by the key upload server thread.
+        thread = threading.Thread(target=lambda: email_sec_chal.Pgp.storeCorrespondentKey(DbTests.correspondentPublicKey))
+        thread.start()
+        thread.join()
+        key = db.getCorrespondentKey(DbTests.correspondentEmailAddress)
+        self.assertIsNotNone(key)
+        db.redHerringSent(DbTests.correspondentEmailAddress)
+        state = email_sec_chal.Db.correspondentCache[DbTests.correspondentEmailAddress]
+        self.assertTrue(state[1] >= 0)
+
+        # Served from the cache from now on.
+        db.conn.execute("DELETE FROM correspondents")
+        self.assertEqual(key, db.getCorrespondentKey(DbTests.correspondentEmailAddress))
+        self.assertEqual(state[1], db.getRedHerringSentTimestamp(DbTests.correspondentEmailAddress))
+        email_sec_chal.Db.clearCache()
+        self.assertIsNone(db.getCorrespondentKey(DbTests.correspondentEmailAddress))
+
+        email_sec_chal.dbCorrespondentCacheSize = 2
+        try:
+            for i in range(5):
+                db.replySent("correspondent%d@voidland.org" % i)
+            self.assertEqual(["correspondent3@voidland.org", "correspondent4@voidland.org"], list(email_sec_chal.Db.correspondentCache))
+        finally:
+            email_sec_chal.dbCorrespondentCacheSize = 10000
+
+    def testCacheClearedByOtherProcess(self):
+        db = email_sec_chal.Db()
+        db.replySent(DbTests.correspondentEmailAddress)
+        lastReplyTimestamp = db.getLastReplyTimestamp(DbTests.correspondentEmailAddress)
+
+        # Another process commits its writes to correspondents together with a new generation.
+        otherConn = email_sec_chal.Db.createDbConnection()
+        try:
+            otherConn.execute("BEGIN IMMEDIATE")
+            otherConn.execute("UPDATE correspondents SET last_reply = last_reply - 60")
+            otherConn.execute("UPDATE cache_generation SET generation = generation + 1")
+            otherConn.execute("COMMIT")
+        finally:
+            otherConn.close()
+        # Outside of transactions, the generation is read at most every generationCheckIntervalSec.
+        email_sec_chal.Db.nextGenerationCheckTime = float("inf")
+        self.assertEqual(lastReplyTimestamp, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+        with db.transaction():
+            self.assertEqual(lastReplyTimestamp - 60, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+        email_sec_chal.Db.clearCorrespondentCache(None)
+        email_sec_chal.Db.nextGenerationCheckTime = 0
+        self.assertEqual(lastReplyTimestamp - 60, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+
+        # The writes of this process keep the cache.
+        db.redHerringSent(DbTests.correspondentEmailAddress)
+        self.assertIn(DbTests.correspondentEmailAddress, email_sec_chal.Db.correspondentCache)
+        db.conn.execute("UPDATE correspondents SET last_reply = -1")
+        self.assertEqual(lastReplyTimestamp - 60, db.getLastReplyTimestamp(DbTests.correspondentEmailAddress))
+
+    def testCacheUpdatedOnlyOnCommit(self):
+        db = email_sec_chal.Db()
+        db.replySent(DbTests.correspondentEmailAddress)
+        oldState = db.getCorrespondentState(DbTests.correspondentEmailAddress)
+
+        readInTransaction = []
+        def decide():
+            readInTransaction.append(email_sec_chal.Db.correspondentCache.get(DbTests.correspondentEmailAddress))
+            return True
+        def decideAndFail():
+            decide()
+            db.redHerringSent(DbTests.correspondentEmailAddress)
+            readInTransaction.append(email_sec_chal.Db.correspondentCache.get(DbTests.correspondentEmailAddress))
+            readInTransaction.append(db.getCorrespondentState(DbTests.correspondentEmailAddress))
+            raise email_sec_chal.EmailSecChalException("Alabala")
+        with self.assertRaises(email_sec_chal.EmailSecChalException):
+            db.reserveReply(DbTests.correspondentEmailAddress, decideAndFail)
+        # The other threads never saw the row written in the transaction, which saw it itself.
+        self.assertEqual([oldState, oldState], readInTransaction[:2])
+        self.assertTrue(readInTransaction[2][1] >= 0)
+        self.assertEqual(oldState, db.getCorrespondentState(DbTests.correspondentEmailAddress))
+
+        asImpostor, (_, newState) = db.reserveReply(DbTests.correspondentEmailAddress, decide)
+        self.assertTrue(asImpostor)
+        self.assertEqual(newState, email_sec_chal.Db.correspondentCache[DbTests.correspondentEmailAddress])
+        db.conn.execute("UPDATE correspondents SET red_herring_sent = -1")
+        self.assertEqual(newState, db.getCorrespondentState(DbTests.correspondentEmailAddress))
+
+    def testMigrations(self):
+        db = email_sec_chal.Db()
+        migrations = email_sec_chal.Db.getMigrations()
+        self.assertEqual(len(migrations), db.conn.execute("PRAGMA user_version").fetchone()[0])
+        schema = db.conn.execute("SELECT sql FROM sqlite_master ORDER BY name").fetchall()
+
+        # Databases from before the versioning may already have any of the changes.
+        db.conn.execute("PRAGMA user_version = 0")
+        email_sec_chal.Db.migrate(db.conn)
+        self.assertEqual(len(migrations), db.conn.execute("PRAGMA user_version").fetchone()[0])
+        self.assertEqual(schema, db.conn.execute("SELECT sql FROM sqlite_master ORDER BY name").fetchall())
+
+        db.conn.execute("PRAGMA user_version = %d" % (len(migrations) + 1))
+        try:
+            with self.assertRaises(email_sec_chal.EmailSecChalException):
+                email_sec_chal.Db.migrate(db.conn)
+            self.assertFalse(db.conn.in_transaction)
+        finally:
+            db.conn.execute("PRAGMA user_version = %d" % len(migrations))
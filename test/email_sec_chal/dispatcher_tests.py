@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import threading
+import time
+
+
+
+class DispatcherTests(test.email_sec_chal.Tests):
+
+    def testResults(self):
+        dispatcher = email_sec_chal.Dispatcher(2)
+        try:
+            self.assertEqual(5, dispatcher.submit("a", lambda a, b: a + b, 2, 3).result(10))
+            with self.assertRaises(ZeroDivisionError):
+                dispatcher.submit("a", lambda: 1 / 0).result(10)
+        finally:
+            dispatcher.close()
+
+    def testSameKeySerialized(self):
+        dispatcher = email_sec_chal.Dispatcher(4)
+        order = []
+        running = []
+        overlaps = []
+        def task(i):
+            running.append(i)
+            if len(running) > 1:
+                overlaps.append(i)
+            time.sleep(0.01)
+            order.append(i)
+            running.remove(i)
+        try:
+            futures = [dispatcher.submit("gbr@voidland.org", task, i) for i in range(20)]
+            for future in futures:
+                future.result(10)
+        finally:
+            dispatcher.close()
+        self.assertEqual(list(range(20)), order)
+        self.assertEqual([], overlaps)
+
+    def testDifferentKeysInParallel(self):
+        dispatcher = email_sec_chal.Dispatcher(4)
+        barrier = threading.Barrier(4, timeout = 10)
+        try:
+            futures = [dispatcher.submit("correspondent%d@voidland.org" % i, barrier.wait) for i in range(4)]
+            self.assertEqual({0, 1, 2, 3}, {future.result(10) for future in futures})
+        finally:
+            dispatcher.close()
+
+    def testBlockedKeyDoesNotBlockOthers(self):
+        dispatcher = email_sec_chal.Dispatcher(2)
+        release = threading.Event()
+        try:
+            blockedFutures = [dispatcher.submit("slow@voidland.org", release.wait, 10) for _ in range(3)]
+            self.assertEqual("fast", dispatcher.submit("fast@voidland.org", lambda: "fast").result(10))
+            release.set()
+            self.assertTrue(all(future.result(10) for future in blockedFutures))
+        finally:
+            release.set()
+            dispatcher.close()
+
+    def testClose(self):
+        dispatcher = email_sec_chal.Dispatcher(1)
+        release = threading.Event()
+        runningFuture = dispatcher.submit("a", release.wait, 10)
+        pendingFuture = dispatcher.submit("a", lambda: None)
+        while not runningFuture.running():
+            time.sleep(0.01)
+        closeThread = threading.Thread(target=dispatcher.close)
+        closeThread.start()
+        while not dispatcher.closed:
+            time.sleep(0.01)
+        release.set()
+        closeThread.join(10)
+        self.assertTrue(runningFuture.result(10))
+        self.assertTrue(pendingFuture.cancelled())
+        with self.assertRaises(email_sec_chal.EmailSecChalException):
+            dispatcher.submit("a", lambda: None)
+
+    def testWaitForPendingCountAndJoin(self):
+        dispatcher = email_sec_chal.Dispatcher(1)
+        release = threading.Event()
+        try:
+            futures = [dispatcher.submit("a", release.wait, 10) for _ in range(3)]
+            self.assertTrue(dispatcher.waitForPendingCount(3, 10))      # The worker takes the first one.
+            self.assertFalse(dispatcher.waitForPendingCount(2, 0.1))
+            self.assertFalse(dispatcher.join(0.1))
+            release.set()
+            self.assertTrue(dispatcher.join(10))
+            self.assertTrue(all(future.done() for future in futures))
+            self.assertEqual(0, dispatcher.getPendingCount())
+        finally:
+            release.set()
+            dispatcher.close()
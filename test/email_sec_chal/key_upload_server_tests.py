@@ -215,7 +215,7 @@ class KeyUploadServerTests(test.email_sec_chal.Tests):
         self.assertEqual("key_upload_success.html", response.headers["Location"])
         
         db = email_sec_chal.Db()
-        self.assertEqual(KeyUploadServerTests.correspondentKey, db.getCorrespondentKey(KeyUploadServerTests.correspondentEmailAddress))
+        self.assertEqual(email_sec_chal.openpgp.minimizeKeys(KeyUploadServerTests.correspondentKey).key, db.getCorrespondentKey(KeyUploadServerTests.correspondentEmailAddress))
 
     def testUploadInvalidContentType(self):
         data={"key": KeyUploadServerTests.correspondentKey}
@@ -5,6 +5,7 @@ import unittest.mock
 import mailbox
 import os.path
 import email
+import threading
 import time
 
 
@@ -23,6 +24,8 @@ class MockMailbox(mailbox.Mailbox):
     
     testMessagesKeysGroups = None
     testMessages = None
+    quarantineRecords = None
+    nextRetryTime = None
     
     locked = False
     lockingCorrect = True
@@ -33,6 +36,7 @@ class MockMailbox(mailbox.Mailbox):
     def __init__(self, testMessagesGroups, pauseBetweenGroupsInSec_=0):
         mailbox.Mailbox.__init__(self, email_sec_chal.tempDir)
         self.initTestMessages(testMessagesGroups)
+        self.quarantineRecords = {}
         self.runs = len(testMessagesGroups)
         self.pauseBetweenGroupsInSec = pauseBetweenGroupsInSec_
         
@@ -69,6 +73,65 @@ class MockMailbox(mailbox.Mailbox):
         
         del self.testMessages[key]
         self.testMessagesKeysGroups[-self.runs].remove(key)
+        
+    def claim(self, key):
+        if not self.locked:
+            self.lockingCorrect = False
+            raise MockMailboxException
+        
+        self.testMessagesKeysGroups[-self.runs].remove(key)
+        return email_sec_chal.ClaimedMessage(key, self.testMessages[key])
+    
+    def complete(self, claimedMessage):
+        if self.locked:
+            self.lockingCorrect = False
+            raise MockMailboxException
+        
+        del self.testMessages[claimedMessage.key]
+    
+    def requeue(self, claimedMessage):
+        if self.locked:
+            self.lockingCorrect = False
+            raise MockMailboxException
+        
+        if self.runs > 0:
+            self.testMessagesKeysGroups[-self.runs].append(claimedMessage.key)
+            
+    def quarantine(self, claimedMessage, error):
+        if self.locked:
+            self.lockingCorrect = False
+            raise MockMailboxException
+        
+        record = claimedMessage.record or email_sec_chal.QuarantineRecord(claimedMessage.key)
+        record.recordFailure(error, time.time())
+        self.quarantineRecords[claimedMessage.key] = record
+        return record
+    
+    def defer(self, claimedMessage, reason, retryTime):
+        if self.locked:
+            self.lockingCorrect = False
+            raise MockMailboxException
+        
+        record = claimedMessage.record or email_sec_chal.QuarantineRecord(claimedMessage.key)
+        record.defer(reason, retryTime)
+        self.quarantineRecords[claimedMessage.key] = record
+        return record
+    
+    def claimQuarantined(self):
+        if not self.locked:
+            self.lockingCorrect = False
+            raise MockMailboxException
+        
+        now = time.time()
+        claimedMessages = []
+        for key, record in list(self.quarantineRecords.items()):
+            if record.isDue(now):
+                del self.quarantineRecords[key]
+                claimedMessages.append(email_sec_chal.ClaimedMessage(key, self.testMessages[key], record_=record))
+        return claimedMessages
+            
+    def recover(self):
+        return 0
 
     def lock(self):
         if self.locked:
@@ -127,6 +190,9 @@ class MailBotForTesting(email_sec_chal.MailBot):
         self.mockReplies = []
         self.mockMbox = MockMailbox(incomingMessagesGroups, pauseBetweenGroupsInSec)
         self.getMailbox = unittest.mock.MagicMock(return_value=self.mockMbox)
+        
+    def createWatcher(self):
+        return email_sec_chal.PollingMaildirWatcher(1, 1)
     
     def createReplyMessage(self, incomingMsg):
         reply = MockOutgoingMessage(incomingMsg)
@@ -202,7 +268,7 @@ class MailBotTests(test.email_sec_chal.Tests):
         self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestMsgId, True)
         self.assertOutgoingMessage(mailBot.mockReplies[1], validRequestMsgId, False)
         self.assertOutgoingMessage(mailBot.mockReplies[2], validRequestMsgId, False)
-        self.assertEqual(0, len(mailBot.failedMessagesKeys))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
         
     def testHappyPath(self):
         self.assertHappyPath("validRequestForOfficialBot")
@@ -220,16 +286,97 @@ class MailBotTests(test.email_sec_chal.Tests):
          
         msgInMockMbox = getOnlyElement(mailBot.mockMbox.testMessages.values())
         msgInMockMboxId = msgInMockMbox["Message-ID"]
-        failedMsg = mailBot.mockMbox.testMessages[getOnlyElement(mailBot.failedMessagesKeys)]
-        failedMsgId = failedMsg["Message-ID"]
+        failedMsgKey = getOnlyElement(mailBot.mockMbox.quarantineRecords.keys())
+        failedMsgId = mailBot.mockMbox.testMessages[failedMsgKey]["Message-ID"]
+        record = mailBot.mockMbox.quarantineRecords[failedMsgKey]
  
         self.assertEqual(1, len(mailBot.mockMbox.testMessages))
         self.assertEqual(validRequestMsgId, msgInMockMboxId)
         self.assertEqual(0, len(mailBot.mockReplies))
-        self.assertEqual(1, len(mailBot.failedMessagesKeys))
         self.assertEqual(validRequestMsgId, failedMsgId)
+        self.assertEqual(1, record.attempts)
+        self.assertEqual("Exception: ", record.error)
+        self.assertGreater(record.nextRetryTime, time.time() + 50)
         self.assertEqual(1, mailBot.createReplyMessage.call_count)
  
+    def testNonAsciiSenderHeader(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        with open(os.path.join(MailBotTests.messagesDir, "validRequestForOfficialBot.eml"), "rb") as f:
+            data = f.read()
+        nonAsciiSenderMsg = email.message_from_bytes(data.replace(b"From: Vladimir Panov", b"From: Vladim\xc3\xadr Panov"))
+        
+        mailBot = MailBotForTesting([[nonAsciiSenderMsg, validRequestMsg], []])
+        self.runMailBot(mailBot)
+        
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(2, len(mailBot.mockReplies))
+        self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestMsg["Message-ID"], True)
+        self.assertOutgoingMessage(mailBot.mockReplies[1], validRequestMsg["Message-ID"], False)
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
+ 
+    def testAdmissionFailure(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        
+        mailBot = MailBotForTesting([[validRequestMsg, validRequestMsg], []])
+        admitMessage = mailBot.admitMessage
+        failures = [TypeError("failing")]
+        def failingAdmitMessage(claimedMessage):
+            if failures:
+                raise failures.pop()
+            return admitMessage(claimedMessage)
+        mailBot.admitMessage = failingAdmitMessage
+        self.runMailBot(mailBot)
+        
+        self.assertEqual(1, len(mailBot.mockReplies))
+        record = getOnlyElement(mailBot.mockMbox.quarantineRecords.values())
+        self.assertEqual("TypeError: failing", record.error)
+ 
+    def testQuarantinedMessageRetried(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        validRequestMsgId = validRequestMsg["Message-ID"]
+         
+        mailBot = MailBotForTesting([[validRequestMsg], []])
+        originalCreateReplyMessage = mailBot.createReplyMessage
+        failures = [Exception()]
+        def createReplyMessage(incomingMsg):
+            if failures:
+                raise failures.pop()
+            return originalCreateReplyMessage(incomingMsg)
+        mailBot.createReplyMessage = createReplyMessage
+        email_sec_chal.quarantineBaseDelaySec = 0
+        try:
+            self.runMailBot(mailBot)
+        finally:
+            email_sec_chal.quarantineBaseDelaySec = 60
+         
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
+        self.assertEqual(1, len(mailBot.mockReplies))
+        self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestMsgId, True)
+ 
+    def testReplyDecidedOnceAcrossProcesses(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        email_sec_chal.silentPeriodSec = 20
+
+        mailBot = MailBotForTesting([[validRequestMsg]])
+        findValidMessagePart = mailBot.findValidMessagePart
+        def findValidMessagePartWhileOtherProcessReplies(incomingMsg, emailAddress, msgId):
+            msgPart = findValidMessagePart(incomingMsg, emailAddress, msgId)
+            otherConn = email_sec_chal.Db.createDbConnection()
+            try:
+                otherConn.execute("BEGIN IMMEDIATE")
+                otherConn.execute("UPDATE correspondents SET red_herring_sent = strftime('%s', 'now'), last_reply = strftime('%s', 'now') WHERE email_address = ?", (emailAddress.lower(), ))
+                otherConn.execute("UPDATE cache_generation SET generation = generation + 1")
+                otherConn.execute("COMMIT")
+            finally:
+                otherConn.close()
+            return msgPart
+        mailBot.findValidMessagePart = findValidMessagePartWhileOtherProcessReplies
+        self.runMailBot(mailBot)
+
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(0, len(mailBot.mockReplies))
+
     def testEncryptedForImpostor(self):
         validRequestForOfficialBotMsg = self.readMessage("validRequestForOfficialBot")
         validRequestForOfficialBotMsgId = validRequestForOfficialBotMsg["Message-ID"]
@@ -244,7 +391,7 @@ class MailBotTests(test.email_sec_chal.Tests):
         self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestForOfficialBotMsgId, True)
         self.assertOutgoingMessage(mailBot.mockReplies[1], validRequestForOfficialBotMsgId, False)
         self.assertOutgoingMessage(mailBot.mockReplies[2], validRequestForImpostorBotMsgId, True)
-        self.assertEqual(0, len(mailBot.failedMessagesKeys))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
  
     def testInvalidRequests(self):
         messages = []
@@ -267,7 +414,7 @@ class MailBotTests(test.email_sec_chal.Tests):
  
         self.assertEqual(0, len(mailBot.mockMbox.testMessages))
         self.assertEqual(0, len(mailBot.mockReplies))
-        self.assertEqual(0, len(mailBot.failedMessagesKeys))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
  
     def assertHappyPathFromMyself(self, msgFileName):
         validRequestMsg = self.readMessage(msgFileName)
@@ -277,7 +424,128 @@ class MailBotTests(test.email_sec_chal.Tests):
  
         self.assertEqual(0, len(mailBot.mockMbox.testMessages))
         self.assertEqual(0, len(mailBot.mockReplies))
-        self.assertEqual(0, len(mailBot.failedMessagesKeys))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
+         
+    def testRejectedAtTriage(self):
+        spoofedMsg = self.readMessage("validRequestFromOfficialBot")
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        
+        mailBot = MailBotForTesting([[spoofedMsg, spoofedMsg, validRequestMsg]])
+        with unittest.mock.patch.object(email_sec_chal.IncomingMessage, "create", wraps=email_sec_chal.IncomingMessage.create) as create:
+            self.runMailBot(mailBot)
+            self.assertEqual(1, create.call_count)
+        
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(1, len(mailBot.mockReplies))
+        self.assertEqual(2, mailBot.triage.getRejectedCount())
+         
+    def testRateLimited(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        
+        mailBot = MailBotForTesting([[validRequestMsg, validRequestMsg, validRequestMsg]])
+        email_sec_chal.rateLimitSenderBurst = 2
+        try:
+            with unittest.mock.patch.object(email_sec_chal.IncomingMessage, "create", wraps=email_sec_chal.IncomingMessage.create) as create:
+                self.runMailBot(mailBot)
+                self.assertEqual(2, create.call_count)
+        finally:
+            email_sec_chal.rateLimitSenderBurst = 0
+        
+        self.assertEqual(2, len(mailBot.mockReplies))
+        record = getOnlyElement(mailBot.mockMbox.quarantineRecords.values())
+        self.assertEqual("rate limited", record.error)
+        self.assertEqual(0, record.attempts)
+        self.assertGreater(record.nextRetryTime, time.time() + 50)
+        self.assertEqual(1, mailBot.rateLimiter.counts["deferred"])
+         
+    def testRateLimitedDropped(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        
+        mailBot = MailBotForTesting([[validRequestMsg, validRequestMsg, validRequestMsg]])
+        email_sec_chal.rateLimitGlobalBurst = 1
+        email_sec_chal.rateLimitAction = "drop"
+        try:
+            self.runMailBot(mailBot)
+        finally:
+            email_sec_chal.rateLimitGlobalBurst = 0
+            email_sec_chal.rateLimitAction = "defer"
+        
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(1, len(mailBot.mockReplies))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
+        self.assertEqual(2, mailBot.rateLimiter.counts["dropped"])
+         
+    def testDuplicatesDropped(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        validRequestMsgId = validRequestMsg["Message-ID"]
+        resentMsg = self.readMessage("validRequestForOfficialBot")
+        del resentMsg["Message-ID"]
+        resentMsg["Message-ID"] = "<resent@voidland.org>"
+        
+        mailBot = MailBotForTesting([[validRequestMsg, validRequestMsg], [validRequestMsg, resentMsg]])
+        email_sec_chal.dedupTtlSec = 604800
+        try:
+            self.runMailBot(mailBot)
+        finally:
+            email_sec_chal.dedupTtlSec = 0
+        
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(2, len(mailBot.mockReplies))
+        self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestMsgId, True)
+        self.assertOutgoingMessage(mailBot.mockReplies[1], "<resent@voidland.org>", False)
+        self.assertEqual(2, mailBot.triage.rejectedCounts["duplicate"])
+        self.assertEqual(2, email_sec_chal.Db().getSeenMessagesCount())
+         
+    def testFailedMessageNotRemembered(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+         
+        mailBot = MailBotForTesting([[validRequestMsg], []])
+        mailBot.createReplyMessage = unittest.mock.MagicMock(side_effect=Exception())
+        email_sec_chal.dedupTtlSec = 604800
+        try:
+            self.runMailBot(mailBot)
+        finally:
+            email_sec_chal.dedupTtlSec = 0
+        
+        self.assertEqual(1, len(mailBot.mockMbox.quarantineRecords))
+        self.assertEqual(0, email_sec_chal.Db().getSeenMessagesCount())
+         
+    def testRecoveredMessageNotDuplicate(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        mailBot = MailBotForTesting([])
+        mailBot.threadLocal = threading.local()
+        mailBot.triage = email_sec_chal.Triage()
+        mailBot.rateLimiter = email_sec_chal.RateLimiter()
+        email_sec_chal.dedupTtlSec = 604800
+        try:
+            self.assertEqual((True, None), mailBot.admitMessage(email_sec_chal.ClaimedMessage(1, validRequestMsg)))
+            claimedMessage = email_sec_chal.ClaimedMessage(2, validRequestMsg)
+            self.assertEqual((False, None), mailBot.admitMessage(claimedMessage))
+
+            # The bot crashed before the first one was processed, it is put back and processed again.
+            mailBot.triage = email_sec_chal.Triage()
+            self.assertEqual((True, None), mailBot.admitMessage(claimedMessage))
+            mailBot.messageProcessed(claimedMessage)
+            self.assertEqual(1, email_sec_chal.Db().getSeenMessagesCount())
+            self.assertEqual((False, None), mailBot.admitMessage(email_sec_chal.ClaimedMessage(3, validRequestMsg)))
+        finally:
+            email_sec_chal.dedupTtlSec = 0
+
+    def testCoalescing(self):
+        validRequestMsg = self.readMessage("validRequestForOfficialBot")
+        validRequestMsgId = validRequestMsg["Message-ID"]
+        
+        mailBot = MailBotForTesting([[validRequestMsg, validRequestMsg], [validRequestMsg]])
+        email_sec_chal.coalescingWindowSec = 300
+        try:
+            self.runMailBot(mailBot)
+        finally:
+            email_sec_chal.coalescingWindowSec = 0
+        
+        self.assertEqual(0, len(mailBot.mockMbox.testMessages))
+        self.assertEqual(1, len(mailBot.mockReplies))
+        self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestMsgId, True)
+        self.assertEqual({"coalesced": 1}, dict(mailBot.triage.rejectedCounts))
          
     def testHappyPathFromOfficialBot(self):
         self.assertHappyPathFromMyself("validRequestFromOfficialBot")
@@ -293,7 +561,7 @@ class MailBotTests(test.email_sec_chal.Tests):
  
         self.assertEqual(0, len(mailBot.mockMbox.testMessages))
         self.assertEqual(0, len(mailBot.mockReplies))
-        self.assertEqual(0, len(mailBot.failedMessagesKeys))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
          
     def testMessageWithMissingContentType(self):
         self.assertBrokenMessage("missing_content_type")
@@ -315,4 +583,4 @@ class MailBotTests(test.email_sec_chal.Tests):
         self.assertOutgoingMessage(mailBot.mockReplies[0], validRequestMsgId, True)
         self.assertOutgoingMessage(mailBot.mockReplies[1], validRequestMsgId, False)
         self.assertOutgoingMessage(mailBot.mockReplies[2], validRequestMsgId, False)
-        self.assertEqual(0, len(mailBot.failedMessagesKeys))
+        self.assertEqual(0, len(mailBot.mockMbox.quarantineRecords))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import email.message
+import itertools
+import smtplib
+import threading
+import unittest.mock
+
+
+
+class MailListenerTests(test.email_sec_chal.Tests):
+
+    mailBot = None
+    listener = None
+    listenerThread = None
+    processedMessages = None
+
+
+    def startListener(self, lmtp=True, maxPending=16, error=None):
+        MailListenerTests.processedMessages = []
+        mailBot = email_sec_chal.MailBot()
+        mailBot.threadLocal = threading.local()
+        mailBot.triage = unittest.mock.MagicMock()
+        mailBot.triage.accept.return_value = True
+        mailBot.rateLimiter = email_sec_chal.RateLimiter()
+        mailBot.deliveredCounter = itertools.count()
+        mailBot.dispatcher = email_sec_chal.Dispatcher(2)
+        def processMessage(claimedMessage):
+            MailListenerTests.processedMessages.append(claimedMessage.getMessage())
+            return error
+        mailBot.processMessage = processMessage
+        MailListenerTests.mailBot = mailBot
+        MailListenerTests.listener = email_sec_chal.MailListener(mailBot, ("127.0.0.1", 0), lmtp, maxPending)
+        MailListenerTests.listenerThread = threading.Thread(target=MailListenerTests.listener.serve_forever, daemon=True)
+        MailListenerTests.listenerThread.start()
+        return MailListenerTests.listener.server_address[1]
+
+    def tearDown(self):
+        if MailListenerTests.listener is not None:
+            MailListenerTests.listener.shutdown()
+            MailListenerTests.listener.server_close()
+            MailListenerTests.mailBot.dispatcher.close()
+            MailListenerTests.listener = None
+
+    def createMessage(self):
+        msg = email.message.EmailMessage()
+        msg["From"] = "gbr@voidland.org"
+        msg["To"] = "gbr@voidland.voidland.org"
+        msg["Subject"] = "Alabala"
+        msg.set_content("First line\n.Line starting with a dot\n")
+        return msg
+
+
+    def testLmtpDelivery(self):
+        port = self.startListener()
+        with smtplib.LMTP("127.0.0.1", port) as client:
+            self.assertEqual({}, client.send_message(self.createMessage()))
+
+        self.assertEqual(1, len(MailListenerTests.processedMessages))
+        processedMessage = MailListenerTests.processedMessages[0]
+        self.assertEqual("Alabala", processedMessage["Subject"])
+        self.assertIn("\n.Line starting with a dot", processedMessage.get_payload())
+
+    def testOverLongLine(self):
+        port = self.startListener()
+        # The line is read in two chunks, the second one starts with a dot that is not stuffed.
+        line = b"." + b"x" * (email_sec_chal.MailListenerRequestHandler.maxLineLength - 2) + b".tail"
+        data = b"From: gbr@voidland.org\r\nTo: gbr@voidland.voidland.org\r\nSubject: Alabala\r\n\r\n" + line + b"\r\n"
+        with smtplib.LMTP("127.0.0.1", port) as client:
+            self.assertEqual({}, client.sendmail("gbr@voidland.org", ["gbr@voidland.voidland.org"], data))
+
+        self.assertEqual(1, len(MailListenerTests.processedMessages))
+        processedMessage = MailListenerTests.processedMessages[0]
+        self.assertEqual(line.decode("ascii"), processedMessage.get_payload().rstrip())
+
+    def testSmtpDelivery(self):
+        port = self.startListener(False)
+        with smtplib.SMTP("127.0.0.1", port) as client:
+            self.assertEqual({}, client.send_message(self.createMessage()))
+        self.assertEqual(1, len(MailListenerTests.processedMessages))
+
+        with smtplib.SMTP("127.0.0.1", port) as client:
+            self.assertEqual(500, client.docmd("LHLO", "localhost")[0])
+
+    def testProcessingFailure(self):
+        port = self.startListener(error="Exception: failing")
+        with smtplib.LMTP("127.0.0.1", port) as client:
+            with self.assertRaises(smtplib.SMTPDataError) as cm:
+                client.send_message(self.createMessage())
+        self.assertEqual(451, cm.exception.smtp_code)
+        self.assertEqual(1, len(MailListenerTests.processedMessages))
+
+    def testRejectedAtTriage(self):
+        port = self.startListener()
+        MailListenerTests.mailBot.triage.accept.return_value = False
+        with smtplib.LMTP("127.0.0.1", port) as client:
+            self.assertEqual({}, client.send_message(self.createMessage()))
+        self.assertEqual([], MailListenerTests.processedMessages)
+
+    def testRateLimited(self):
+        port = self.startListener()
+        email_sec_chal.rateLimitSenderBurst = 1
+        try:
+            with smtplib.LMTP("127.0.0.1", port) as client:
+                self.assertEqual({}, client.send_message(self.createMessage()))
+                with self.assertRaises(smtplib.SMTPDataError) as cm:
+                    client.send_message(self.createMessage())
+        finally:
+            email_sec_chal.rateLimitSenderBurst = 0
+        self.assertEqual(451, cm.exception.smtp_code)
+        self.assertEqual(1, len(MailListenerTests.processedMessages))
+
+    def testBackpressure(self):
+        port = self.startListener(maxPending=0)
+        with smtplib.LMTP("127.0.0.1", port) as client:
+            with self.assertRaises(smtplib.SMTPSenderRefused) as cm:
+                client.send_message(self.createMessage())
+        self.assertEqual(451, cm.exception.smtp_code)
+        self.assertEqual([], MailListenerTests.processedMessages)
+
+    def testCreateMailListener(self):
+        email_sec_chal.mailListener = "pop3"
+        try:
+            with self.assertRaises(email_sec_chal.EmailSecChalException):
+                email_sec_chal.createMailListener(None)
+        finally:
+            email_sec_chal.mailListener = "none"
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import email.message
+import mailbox
+import os
+import threading
+import time
+
+
+
+class MaildirWatcherTests(test.email_sec_chal.Tests):
+
+    maildirPath = None
+
+
+    def setUp(self):
+        MaildirWatcherTests.maildirPath = os.path.join(email_sec_chal.tempDir, "Maildir")
+        mailbox.Maildir(MaildirWatcherTests.maildirPath, create=True)
+        email_sec_chal.maildirWatcher = "auto"
+
+    def tearDown(self):
+        email_sec_chal.maildirWatcher = "auto"
+
+    def deliverLater(self, delaySec):
+        def deliver():
+            time.sleep(delaySec)
+            msg = email.message.EmailMessage()
+            msg["Subject"] = "Alabala"
+            mailbox.Maildir(MaildirWatcherTests.maildirPath).add(msg)
+        deliveryThread = threading.Thread(target=deliver)
+        deliveryThread.start()
+        return deliveryThread
+
+
+    def testInotifyWakesOnDelivery(self):
+        watcher = email_sec_chal.InotifyMaildirWatcher(MaildirWatcherTests.maildirPath, 30)
+        try:
+            deliveryThread = self.deliverLater(0.2)
+            startTime = time.monotonic()
+            self.assertTrue(watcher.wait())
+            self.assertLess(time.monotonic() - startTime, 5)
+            deliveryThread.join()
+        finally:
+            watcher.close()
+
+    def testInotifyRescanInterval(self):
+        watcher = email_sec_chal.InotifyMaildirWatcher(MaildirWatcherTests.maildirPath, 0.1)
+        try:
+            self.assertFalse(watcher.wait())
+        finally:
+            watcher.close()
+
+    def testWaitUntilDeadline(self):
+        for watcher in [email_sec_chal.InotifyMaildirWatcher(MaildirWatcherTests.maildirPath, 30), email_sec_chal.PollingMaildirWatcher(30, 30)]:
+            try:
+                startTime = time.monotonic()
+                watcher.wait(time.time() + 0.2)
+                self.assertLess(time.monotonic() - startTime, 5)
+                watcher.wait(time.time() - 60)      # Already due.
+            finally:
+                watcher.close()
+
+    def testCreateWatcher(self):
+        watcher = email_sec_chal.createMaildirWatcher(MaildirWatcherTests.maildirPath)
+        watcher.close()
+        self.assertIsInstance(watcher, email_sec_chal.InotifyMaildirWatcher)
+
+        email_sec_chal.maildirWatcher = "polling"
+        self.assertIsInstance(email_sec_chal.createMaildirWatcher(MaildirWatcherTests.maildirPath), email_sec_chal.PollingMaildirWatcher)
+
+        email_sec_chal.maildirWatcher = "unknown"
+        with self.assertRaises(email_sec_chal.EmailSecChalException):
+            email_sec_chal.createMaildirWatcher(MaildirWatcherTests.maildirPath)
+
+    def testFallbackToPolling(self):
+        nonExistingPath = os.path.join(email_sec_chal.tempDir, "NoMaildir")
+        self.assertIsInstance(email_sec_chal.createMaildirWatcher(nonExistingPath), email_sec_chal.PollingMaildirWatcher)
+
+        email_sec_chal.maildirWatcher = "inotify"
+        with self.assertRaises(OSError):
+            email_sec_chal.createMaildirWatcher(nonExistingPath)
+
+    def testAdaptivePolling(self):
+        watcher = email_sec_chal.PollingMaildirWatcher(1, 5)
+        self.assertEqual(1, watcher.intervalSec)
+        for expectedIntervalSec in [2, 4, 5, 5]:
+            watcher.processed(0)
+            self.assertEqual(expectedIntervalSec, watcher.intervalSec)
+        watcher.processed(3)
+        self.assertEqual(1, watcher.intervalSec)
@@ -13,19 +13,99 @@ class ConfigurationTests(test.email_sec_chal.Tests):
         email_sec_chal.resourceDir = None
         email_sec_chal.dataDir = None
         email_sec_chal.tempDir = None
+        email_sec_chal.memoryTempDir = None
+        email_sec_chal.tempDirQuotaMb = -1
         email_sec_chal.triggerWords = set()
         email_sec_chal.logLevel = logging.NOTSET
         email_sec_chal.keyUploadServerPort = -1
         email_sec_chal.smtpServerHost = None
         email_sec_chal.silentPeriodSec = -1
+        email_sec_chal.maildirWatcher = None
+        email_sec_chal.maildirPollMinIntervalSec = -1
+        email_sec_chal.maildirPollMaxIntervalSec = -1
+        email_sec_chal.dispatcherWorkerCount = -1
+        email_sec_chal.maildirMaxPending = -1
+        email_sec_chal.instanceName = None
+        email_sec_chal.quarantineBaseDelaySec = -1
+        email_sec_chal.quarantineMaxDelaySec = -1
+        email_sec_chal.quarantineMaxAttempts = -1
+        email_sec_chal.mailListener = None
+        email_sec_chal.mailListenerHost = None
+        email_sec_chal.mailListenerPort = -1
+        email_sec_chal.mailListenerMaxPending = -1
+        email_sec_chal.runtime = None
+        email_sec_chal.asyncMaxInFlight = -1
+        email_sec_chal.rateLimitSenderBurst = -1
+        email_sec_chal.rateLimitSenderPerHour = -1
+        email_sec_chal.rateLimitGlobalBurst = -1
+        email_sec_chal.rateLimitGlobalPerHour = -1
+        email_sec_chal.rateLimitAction = None
+        email_sec_chal.rateLimitPersisted = None
+        email_sec_chal.dedupTtlSec = -1
+        email_sec_chal.dedupMaxEntries = -1
+        email_sec_chal.coalescingWindowSec = -1
+        email_sec_chal.dbJournalMode = None
+        email_sec_chal.dbSynchronous = None
+        email_sec_chal.dbCacheSizeKb = -1
+        email_sec_chal.dbCompressKeys = None
+        email_sec_chal.dbCorrespondentCacheSize = -1
+        email_sec_chal.keyringPoolSize = -1
+        email_sec_chal.keyringPoolWarmUp = False
+        email_sec_chal.cryptoBackend = None
+        email_sec_chal.correspondentKeyringCacheSize = -1
+        email_sec_chal.correspondentKeyringCacheIdleSec = -1
+        email_sec_chal.botIdentityCachePersisted = True
+        email_sec_chal.cryptoWorkerCount = -1
+        email_sec_chal.cryptoOperationTimeoutSec = -1
+        email_sec_chal.maxKeySizeKb = -1
         
         email_sec_chal.loadConfiguration()
         
         self.assertEqual("/data/email_sec_chal/res", email_sec_chal.resourceDir)
         self.assertEqual("/data/email_sec_chal", email_sec_chal.dataDir)
         self.assertEqual("/tmp/email_sec_chal", email_sec_chal.tempDir)
+        self.assertEqual("/dev/shm/email_sec_chal", email_sec_chal.memoryTempDir)
+        self.assertEqual(256, email_sec_chal.tempDirQuotaMb)
         self.assertEqual(set(["GC65Z29", "OC13031"]), email_sec_chal.triggerWords)
         self.assertEqual(logging.INFO, email_sec_chal.logLevel)
         self.assertEqual(8088, email_sec_chal.keyUploadServerPort)
         self.assertEqual("localhost", email_sec_chal.smtpServerHost)
         self.assertEqual(300, email_sec_chal.silentPeriodSec)
+        self.assertEqual("polling", email_sec_chal.maildirWatcher)
+        self.assertEqual(0.5, email_sec_chal.maildirPollMinIntervalSec)
+        self.assertEqual(10, email_sec_chal.maildirPollMaxIntervalSec)
+        self.assertEqual(12, email_sec_chal.dispatcherWorkerCount)
+        self.assertEqual(24, email_sec_chal.maildirMaxPending)
+        self.assertEqual("bot1", email_sec_chal.instanceName)
+        self.assertEqual(30, email_sec_chal.quarantineBaseDelaySec)
+        self.assertEqual(3600, email_sec_chal.quarantineMaxDelaySec)
+        self.assertEqual(5, email_sec_chal.quarantineMaxAttempts)
+        self.assertEqual("lmtp", email_sec_chal.mailListener)
+        self.assertEqual("127.0.0.1", email_sec_chal.mailListenerHost)
+        self.assertEqual(2424, email_sec_chal.mailListenerPort)
+        self.assertEqual(16, email_sec_chal.mailListenerMaxPending)
+        self.assertEqual("asyncio", email_sec_chal.runtime)
+        self.assertEqual(128, email_sec_chal.asyncMaxInFlight)
+        self.assertEqual(3, email_sec_chal.rateLimitSenderBurst)
+        self.assertEqual(30, email_sec_chal.rateLimitSenderPerHour)
+        self.assertEqual(50, email_sec_chal.rateLimitGlobalBurst)
+        self.assertEqual(1800, email_sec_chal.rateLimitGlobalPerHour)
+        self.assertEqual("drop", email_sec_chal.rateLimitAction)
+        self.assertTrue(email_sec_chal.rateLimitPersisted)
+        self.assertEqual(86400, email_sec_chal.dedupTtlSec)
+        self.assertEqual(5000, email_sec_chal.dedupMaxEntries)
+        self.assertEqual(45, email_sec_chal.coalescingWindowSec)
+        self.assertEqual("DELETE", email_sec_chal.dbJournalMode)
+        self.assertEqual("FULL", email_sec_chal.dbSynchronous)
+        self.assertEqual(4096, email_sec_chal.dbCacheSizeKb)
+        self.assertEqual(False, email_sec_chal.dbCompressKeys)
+        self.assertEqual(500, email_sec_chal.dbCorrespondentCacheSize)
+        self.assertEqual(8, email_sec_chal.keyringPoolSize)
+        self.assertTrue(email_sec_chal.keyringPoolWarmUp)
+        self.assertEqual("gnupg", email_sec_chal.cryptoBackend)
+        self.assertEqual(32, email_sec_chal.correspondentKeyringCacheSize)
+        self.assertEqual(900, email_sec_chal.correspondentKeyringCacheIdleSec)
+        self.assertFalse(email_sec_chal.botIdentityCachePersisted)
+        self.assertEqual(6, email_sec_chal.cryptoWorkerCount)
+        self.assertEqual(45, email_sec_chal.cryptoOperationTimeoutSec)
+        self.assertEqual(128, email_sec_chal.maxKeySizeKb)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import os.path
+import email
+
+
+
+class OpenPgpTests(test.email_sec_chal.Tests):
+
+    messagesDir = None
+
+
+    @classmethod
+    def setUpClass(cls):
+        test.email_sec_chal.Tests.setUpClass()
+
+        moduleDir = os.path.dirname(os.path.abspath(__file__))
+        OpenPgpTests.messagesDir = os.path.join(moduleDir, "messages")
+
+    def readMessage(self, msgFileName):
+        with open(os.path.join(OpenPgpTests.messagesDir, msgFileName + ".eml"), "rb") as f:
+            return email.message_from_binary_file(f)
+
+
+    def testPublicKey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "9011E1A9")
+        packetSummary = email_sec_chal.openpgp.inspect(correspondentKey)
+
+        self.assertTrue(packetSummary.hasKey())
+        self.assertFalse(packetSummary.secretKey)
+        self.assertEqual(set(["7FB049F79011E1A9", "280FE3B131A3B07C"]), packetSummary.keyIds)
+        self.assertEqual(["Vladimir Panov <gbr@voidland.org>"], packetSummary.userIds)
+        self.assertFalse(packetSummary.signed)
+        self.assertFalse(packetSummary.encrypted)
+
+    def testSecretKey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPrivateKey("gbr@voidland.org", "345933AF")
+        packetSummary = email_sec_chal.openpgp.inspect(correspondentKey)
+
+        self.assertTrue(packetSummary.hasKey())
+        self.assertTrue(packetSummary.secretKey)
+
+    def testEncryptedMessage(self):
+        msg = self.readMessage("validRequestForBothBots")
+        packetSummary = email_sec_chal.openpgp.inspect(msg.get_payload(1).get_payload())
+
+        self.assertTrue(packetSummary.encrypted)
+        self.assertEqual(set(["EF0988181E3301EE", "280FE3B131A3B07C", "124506658FB05FAD"]), packetSummary.recipientKeyIds)
+        self.assertFalse(packetSummary.hasKey())
+
+    def testDetachedSignature(self):
+        msg = self.readMessage(os.path.join("Enigmail", "PGP_MIME", "unencrypted_signed_plain"))
+        packetSummary = email_sec_chal.openpgp.inspect(msg.get_payload(1).get_payload())
+
+        self.assertTrue(packetSummary.signed)
+        self.assertFalse(packetSummary.onePassSigned)
+        self.assertFalse(packetSummary.encrypted)
+        self.assertEqual(set(["7FB049F79011E1A9"]), packetSummary.issuerKeyIds)
+
+    def testCleartextSignature(self):
+        msg = self.readMessage(os.path.join("Enigmail", "PGP_Inline", "unencrypted_signedWrong_plain"))
+        signedMessage = msg.get_payload(decode=True).decode("utf-8")
+        packetSummary = email_sec_chal.openpgp.inspect(signedMessage)
+
+        self.assertTrue(packetSummary.signed)
+        self.assertEqual(set(["C97A6EF5345933AF"]), packetSummary.issuerKeyIds)
+        self.assertEqual("Alabala Алабала\n", email_sec_chal.openpgp.getCleartext(signedMessage))
+
+    def testInvalidData(self):
+        for invalidData in ["", "garbage", b"\x00\x01\x02", "-----BEGIN PGP MESSAGE-----\n\n!!!!\n-----END PGP MESSAGE-----\n"]:
+            with self.assertRaises(email_sec_chal.PgpException):
+                email_sec_chal.openpgp.inspect(invalidData)
+
+    def testChecksumMismatch(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "9011E1A9")
+        checksumPos = correspondentKey.rindex("\n=") + 2
+        corruptedChecksum = "AAAA" if correspondentKey[checksumPos:checksumPos+4] != "AAAA" else "BBBB"
+        corruptedKey = correspondentKey[:checksumPos] + corruptedChecksum + correspondentKey[checksumPos+4:]
+
+        with self.assertRaises(email_sec_chal.PgpException):
+            email_sec_chal.openpgp.dearmor(corruptedKey)
+
+        # Not verified when only the packet headers are read.
+        self.assertEqual(email_sec_chal.openpgp.dearmor(correspondentKey), email_sec_chal.openpgp.dearmor(corruptedKey, False))
+        self.assertEqual(email_sec_chal.openpgp.inspect(correspondentKey).keyIds, email_sec_chal.openpgp.inspect(corruptedKey).keyIds)
+
+    def testMinimizeCleanKey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "9011E1A9")
+        minimizedKey = email_sec_chal.openpgp.minimizeKeys(correspondentKey)
+
+        self.assertEqual(list(email_sec_chal.openpgp.iterPackets(email_sec_chal.openpgp.dearmor(correspondentKey))), list(email_sec_chal.openpgp.iterPackets(email_sec_chal.openpgp.dearmor(minimizedKey.key))))
+        self.assertEqual(minimizedKey.originalSize, minimizedKey.minimizedSize)
+        self.assertEqual(0, minimizedKey.removedSignatures)
+
+    def testMinimizeFloodedKey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "9011E1A9")
+        floodedKey = test.email_sec_chal.Tests.createFloodedKey(correspondentKey, 5000)
+        minimizedKey = email_sec_chal.openpgp.minimizeKeys(floodedKey)
+
+        self.assertEqual(5000, minimizedKey.removedSignatures)
+        self.assertGreater(minimizedKey.originalSize, 100000)
+        self.assertEqual(email_sec_chal.openpgp.minimizeKeys(correspondentKey).key, minimizedKey.key)
+        self.assertEqual(set(["7FB049F79011E1A9", "280FE3B131A3B07C"]), email_sec_chal.openpgp.inspect(minimizedKey.key).keyIds)
+
+    def testMinimizeKeyWithForgedSelfSignature(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "9011E1A9")
+        # A positive certification claiming the primary key as issuer, created later than the genuine one.
+        forgedSignature = bytes([4, 0x13, 1, 8, 0, 6, 5, 2, 0x7F, 0xFF, 0xFF, 0xFF, 0, 10, 9, 16]) + bytes.fromhex("7FB049F79011E1A9") + bytes([0xAB, 0xCD, 0, 8, 0xFF])
+        forgedKey = b""
+        genuineSignatures = []
+        for tag, body in email_sec_chal.openpgp.iterPackets(email_sec_chal.openpgp.dearmor(correspondentKey)):
+            forgedKey += email_sec_chal.openpgp.encodePacket(tag, body)
+            if tag == email_sec_chal.openpgp.PACKET_TAG_SIGNATURE:
+                genuineSignatures.append(body)
+            if tag == email_sec_chal.openpgp.PACKET_TAG_USER_ID:
+                forgedKey += email_sec_chal.openpgp.encodePacket(email_sec_chal.openpgp.PACKET_TAG_SIGNATURE, forgedSignature)
+        minimizedKey = email_sec_chal.openpgp.minimizeKeys(email_sec_chal.openpgp.armor(forgedKey, "PUBLIC KEY BLOCK"))
+
+        signatures = [body for tag, body in email_sec_chal.openpgp.iterPackets(email_sec_chal.openpgp.dearmor(minimizedKey.key)) if tag == email_sec_chal.openpgp.PACKET_TAG_SIGNATURE]
+        self.assertEqual(0, minimizedKey.removedSignatures)
+        self.assertTrue(all(signature in signatures for signature in genuineSignatures))
+        self.assertIn(forgedSignature, signatures)
+
+    def testMinimizeKeyWithExpiredSubkey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey("dimpata@gmail.com", "0556B1B2")
+        minimizedKey = email_sec_chal.openpgp.minimizeKeys(correspondentKey)
+
+        self.assertEqual(1, minimizedKey.removedSubkeys)
+        self.assertEqual(set(["514D3A510556B1B2"]), email_sec_chal.openpgp.inspect(minimizedKey.key).keyIds)
+        minimizedKey = email_sec_chal.openpgp.minimizeKeys(correspondentKey, now = 0)
+        self.assertEqual(0, minimizedKey.removedSubkeys)
+        self.assertEqual(2, len(email_sec_chal.openpgp.inspect(minimizedKey.key).keyIds))
+
+    def testMinimizeRejectedKeys(self):
+        with self.assertRaises(email_sec_chal.PgpException):
+            email_sec_chal.openpgp.minimizeKeys(test.email_sec_chal.Tests.readPrivateKey("gbr@voidland.org", "345933AF"))
+        with self.assertRaises(email_sec_chal.PgpException):
+            email_sec_chal.openpgp.minimizeKeys(test.email_sec_chal.Tests.readPublicKey("gbr@voidland.org", "9011E1A9"), maxSize = 1024)
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 import test.email_sec_chal
 import email_sec_chal
+import os
+import email
+import time
+import unittest.mock
 
 
 
@@ -37,3 +41,194 @@ class PgpTests(test.email_sec_chal.Tests):
         email_sec_chal.Pgp.storeCorrespondentKey(correspondentKey)
         with email_sec_chal.Pgp("dimpata@gmail.com") as pgp:
             self.assertEqual(["95E12FD2351D3CC7EFBAE77B514D3A510556B1B2"], pgp.correspondentFingerprints)
+
+    def testKeyringPoolReuse(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyId)
+        email_sec_chal.Pgp.storeCorrespondentKey(correspondentKey)
+        email_sec_chal.Pgp.keyringPool.preparedCacheSize = 0
+        try:
+            with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+                officialGnupgHomeDir = pgp.officialGnupgHomeDir
+                impostorGnupgHomeDir = pgp.impostorGnupgHomeDir
+                self.assertEqual(["44EDCA862A2D87BDB1D9C36B7FB049F79011E1A9"], pgp.correspondentFingerprints)
+                
+            with email_sec_chal.Pgp() as pgp:
+                self.assertEqual(officialGnupgHomeDir, pgp.officialGnupgHomeDir)
+                self.assertEqual(impostorGnupgHomeDir, pgp.impostorGnupgHomeDir)
+                self.assertEqual(set(pgp.officialFingerprints), set(key["fingerprint"] for key in pgp.officialBackend.listKeys()))
+                self.assertEqual(set(pgp.impostorFingerprints), set(key["fingerprint"] for key in pgp.impostorBackend.listKeys()))
+        finally:
+            email_sec_chal.Pgp.keyringPool.preparedCacheSize = email_sec_chal.correspondentKeyringCacheSize
+
+    def testClosingDuringTimedOutOperation(self):
+        email_sec_chal.CryptoExecutor.shutdown()
+        email_sec_chal.cryptoOperationTimeoutSec = 1
+        def decrypt(encryptedData):
+            time.sleep(2)
+            return email_sec_chal.CryptoResult()
+
+        try:
+            pgp = email_sec_chal.Pgp()
+            pgp.officialBackend = unittest.mock.MagicMock()
+            pgp.officialBackend.decrypt.side_effect = decrypt
+            pgp.getRecipientBots = lambda encryptedData: ["official"]
+            idleCount = email_sec_chal.Pgp.keyringPool.getIdleCount("official")
+            future = email_sec_chal.CryptoExecutor.submit(pgp.decrypt, b"data")
+            with self.assertRaises(email_sec_chal.PgpException):
+                email_sec_chal.CryptoExecutor.wait(future)
+            pgp.close()
+            self.assertEqual(idleCount, email_sec_chal.Pgp.keyringPool.getIdleCount("official"))
+            self.assertIsNotNone(pgp.officialKeyring)
+
+            self.assertIsNone(future.exception(timeout = 10))
+            self.assertIsNone(pgp.officialKeyring)
+            self.assertEqual(idleCount + 1, email_sec_chal.Pgp.keyringPool.getIdleCount("official"))
+            with self.assertRaises(email_sec_chal.PgpException):
+                pgp.decrypt(b"data")
+        finally:
+            email_sec_chal.CryptoExecutor.shutdown()
+            email_sec_chal.cryptoOperationTimeoutSec = 60
+
+    def testKeyringPoolSize(self):
+        email_sec_chal.Pgp.staticInit()
+        keyringPool = email_sec_chal.KeyringPool(1, {"official": email_sec_chal.Pgp.officialBotKeys})
+        keyring1 = keyringPool.acquire("official")
+        keyring2 = keyringPool.acquire("official")
+        self.assertNotEqual(keyring1.gnupgHomeDir, keyring2.gnupgHomeDir)
+        
+        keyringPool.release(keyring1)
+        keyringPool.release(keyring2)
+        self.assertEqual(1, keyringPool.getIdleCount("official"))
+        self.assertFalse(os.access(keyring2.gnupgHomeDir, os.F_OK))
+        
+        keyringPool.close()
+        self.assertEqual(0, keyringPool.getIdleCount("official"))
+        self.assertFalse(os.access(keyring1.gnupgHomeDir, os.F_OK))
+
+    def testKeyringPoolImportFailure(self):
+        email_sec_chal.Pgp.staticInit()
+        keyringPool = email_sec_chal.KeyringPool(1, {"official": email_sec_chal.Pgp.officialBotKeys})
+        liveCount = email_sec_chal.Workspace.getLiveCount()
+        with unittest.mock.patch.object(email_sec_chal.BotKeyring, "importCorrespondentKey", side_effect=email_sec_chal.PgpException("failing")):
+            with self.assertRaises(email_sec_chal.PgpException):
+                keyringPool.acquire("official", "key")
+        self.assertEqual(liveCount, email_sec_chal.Workspace.getLiveCount())
+        self.assertEqual(0, keyringPool.getIdleCount("official"))
+
+    def testKeyringNotReusedAfterBotKeyImport(self):
+        email_sec_chal.Pgp.staticInit()
+        keyringPool = email_sec_chal.KeyringPool(1, {"official": email_sec_chal.Pgp.officialBotKeys})
+        keyring = keyringPool.acquire("official", email_sec_chal.Pgp.officialBotKeys)
+        self.assertTrue(set(keyring.fingerprints) & set(keyring.correspondentFingerprints))
+
+        keyringPool.release(keyring)
+        self.assertEqual(0, keyringPool.getIdleCount("official"))
+        self.assertFalse(os.access(keyring.gnupgHomeDir, os.F_OK))
+        keyringPool.close()
+
+    def testCorrespondentKeyringCache(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyId)
+        correspondentKeyAlt = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyAltId)
+        email_sec_chal.Pgp.storeCorrespondentKey(correspondentKey)
+        
+        with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+            officialGnupgHomeDir = pgp.officialGnupgHomeDir
+        self.assertEqual(2, email_sec_chal.Pgp.keyringPool.getPreparedCount())
+        
+        with unittest.mock.patch.object(email_sec_chal.BotKeyring, "importCorrespondentKey") as importCorrespondentKey:
+            with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+                self.assertEqual(officialGnupgHomeDir, pgp.officialGnupgHomeDir)
+                self.assertEqual(["44EDCA862A2D87BDB1D9C36B7FB049F79011E1A9"], pgp.correspondentFingerprints)
+            self.assertEqual(0, importCorrespondentKey.call_count)
+        
+        email_sec_chal.Pgp.storeCorrespondentKey(correspondentKeyAlt)
+        self.assertEqual(0, email_sec_chal.Pgp.keyringPool.getPreparedCount())
+        with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+            self.assertEqual(["8D73455FF0373B363B719A35C97A6EF5345933AF"], pgp.correspondentFingerprints)
+            self.assertEqual(set(pgp.officialFingerprints + pgp.correspondentFingerprints), set(key["fingerprint"] for key in pgp.officialBackend.listKeys()))
+
+    def testCorrespondentKeyringCacheEviction(self):
+        email_sec_chal.Pgp.staticInit()
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyId)
+        correspondentKeyAlt = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyAltId)
+        keyringPool = email_sec_chal.KeyringPool(1, {"official": email_sec_chal.Pgp.officialBotKeys}, 1, 60)
+        try:
+            with unittest.mock.patch("time.monotonic", return_value=1000):
+                keyringPool.release(keyringPool.acquire("official", correspondentKey))
+                keyringPool.release(keyringPool.acquire("official", correspondentKeyAlt))
+            self.assertEqual(1, keyringPool.getPreparedCount())
+            self.assertEqual(1, keyringPool.getIdleCount("official"))
+            
+            with unittest.mock.patch("time.monotonic", return_value=1061):
+                keyring = keyringPool.acquire("official")
+            self.assertEqual(0, keyringPool.getPreparedCount())
+            self.assertEqual([], keyring.correspondentFingerprints)
+            self.assertEqual(set(keyring.fingerprints), set(key["fingerprint"] for key in keyring.backend.listKeys()))
+            keyringPool.release(keyring)
+        finally:
+            keyringPool.close()
+
+    def readEncryptedPayload(self, msgFileName):
+        moduleDir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(moduleDir, "messages", msgFileName + ".eml"), "rb") as f:
+            msg = email.message_from_binary_file(f)
+        return msg.get_payload(1).get_payload().encode()
+
+    def testRecipientBots(self):
+        with email_sec_chal.Pgp() as pgp:
+            self.assertEqual(["official"], pgp.getRecipientBots(self.readEncryptedPayload("validRequestForOfficialBot")))
+            self.assertEqual(["impostor"], pgp.getRecipientBots(self.readEncryptedPayload("validRequestForImpostorBot")))
+            self.assertEqual(["impostor", "official"], pgp.getRecipientBots(self.readEncryptedPayload("validRequestForBothBots")))
+            self.assertEqual(["impostor", "official"], pgp.getRecipientBots(b"garbage"))
+
+    def testDecryptionKeySelection(self):
+        with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+            with unittest.mock.patch.object(pgp.impostorBackend, "decrypt") as impostorDecrypt:
+                decryptedResult, forImpostor = pgp.decrypt(self.readEncryptedPayload("validRequestForOfficialBot"))
+                self.assertTrue(decryptedResult)
+                self.assertFalse(forImpostor)
+                self.assertEqual(0, impostorDecrypt.call_count)
+            
+            with unittest.mock.patch.object(pgp.impostorBackend, "decrypt") as impostorDecrypt, \
+                unittest.mock.patch.object(pgp.officialBackend, "decrypt") as officialDecrypt:
+                decryptedResult, forImpostor = pgp.decrypt(self.readEncryptedPayload(os.path.join("Enigmail", "PGP_MIME", "encryptedWithWrongKey")))
+                self.assertIsNone(decryptedResult)
+                self.assertFalse(forImpostor)
+                self.assertEqual(0, impostorDecrypt.call_count)
+                self.assertEqual(0, officialDecrypt.call_count)
+
+    def testUnknownSignerNotVerified(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyId)
+        email_sec_chal.Pgp.storeCorrespondentKey(correspondentKey)
+        moduleDir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(moduleDir, "messages", "Enigmail", "PGP_Inline", "unencrypted_signedWrong_plain.eml"), "rb") as f:
+            signedMessage = email.message_from_binary_file(f).get_payload(decode=True)
+        
+        with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+            with unittest.mock.patch.object(pgp.officialBackend, "decrypt") as officialDecrypt:
+                verifiedResult = pgp.verifyInline(signedMessage)
+                self.assertFalse(verifiedResult.valid)
+                self.assertEqual("Alabala Алабала\n", str(verifiedResult.data, "utf-8"))
+                self.assertEqual(0, officialDecrypt.call_count)
+
+    def testStoreFloodedCorrespondentKey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyId)
+        floodedKey = test.email_sec_chal.Tests.createFloodedKey(correspondentKey, 5000)
+
+        self.assertEqual([PgpTests.correspondentEmailAddress], email_sec_chal.Pgp.storeCorrespondentKey(floodedKey))
+        storedKey = email_sec_chal.Db().getCorrespondentKey(PgpTests.correspondentEmailAddress)
+        self.assertLess(len(storedKey), len(correspondentKey) * 2)
+        with email_sec_chal.Pgp(PgpTests.correspondentEmailAddress) as pgp:
+            self.assertEqual(storedKey, pgp.correspondentKey)
+            self.assertEqual(["44EDCA862A2D87BDB1D9C36B7FB049F79011E1A9"], pgp.correspondentFingerprints)
+
+    def testStoreOversizedCorrespondentKey(self):
+        correspondentKey = test.email_sec_chal.Tests.readPublicKey(PgpTests.correspondentEmailAddress, PgpTests.correspondentKeyId)
+        db = email_sec_chal.Db()
+        initialCorrespondentsCount = db.getCorrespondentsCount()
+        email_sec_chal.maxKeySizeKb = 1
+        try:
+            self.assertEqual([], email_sec_chal.Pgp.storeCorrespondentKey(correspondentKey))
+        finally:
+            email_sec_chal.maxKeySizeKb = 64
+        self.assertEqual(initialCorrespondentsCount, db.getCorrespondentsCount())
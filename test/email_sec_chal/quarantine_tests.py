@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import os
+
+
+
+class QuarantineTests(test.email_sec_chal.Tests):
+
+    def testRetryDelay(self):
+        self.assertEqual([60, 120, 240, 480], [email_sec_chal.QuarantineRecord.getRetryDelaySec(attempts) for attempts in range(1, 5)])
+        self.assertEqual(86400, email_sec_chal.QuarantineRecord.getRetryDelaySec(20))
+
+    def testRecordFailure(self):
+        record = email_sec_chal.QuarantineRecord("1234.M5P6.host", "new/1234.M5P6.host")
+        record.recordFailure("Exception: first", 1000)
+        record.recordFailure("Exception: second", 1100)
+        self.assertEqual(2, record.attempts)
+        self.assertEqual("Exception: second", record.error)
+        self.assertEqual(1000, record.firstFailureTime)
+        self.assertEqual(1100, record.lastFailureTime)
+        self.assertEqual(1220, record.nextRetryTime)
+        self.assertFalse(record.isDue(1219))
+        self.assertTrue(record.isDue(1220))
+
+    def testGiveUpAfterMaxAttempts(self):
+        record = email_sec_chal.QuarantineRecord("1234.M5P6.host")
+        for attempt in range(email_sec_chal.quarantineMaxAttempts):
+            record.recordFailure("Exception: failing", 1000)
+        self.assertIsNone(record.nextRetryTime)
+        self.assertFalse(record.isDue(float("inf")))
+
+    def testSaveAndLoad(self):
+        recordPath = os.path.join(email_sec_chal.tempDir, "record.json")
+        record = email_sec_chal.QuarantineRecord("1234.M5P6.host", "cur/1234.M5P6.host:2,S")
+        record.recordFailure("Exception: failing", 1000)
+        record.save(recordPath)
+        try:
+            loadedRecord = email_sec_chal.QuarantineRecord.load(recordPath)
+        finally:
+            os.remove(recordPath)
+        self.assertEqual(vars(record), vars(loadedRecord))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+
+
+
+class RateLimiterTests(test.email_sec_chal.Tests):
+
+    def setUp(self):
+        test.email_sec_chal.Tests.setUp(self)
+        test.email_sec_chal.Tests.clearDb()
+        email_sec_chal.rateLimitSenderBurst = 2
+        email_sec_chal.rateLimitSenderPerHour = 3600
+        email_sec_chal.rateLimitGlobalBurst = 3
+        email_sec_chal.rateLimitGlobalPerHour = 7200
+
+    def tearDown(self):
+        email_sec_chal.rateLimitSenderBurst = 0
+        email_sec_chal.rateLimitSenderPerHour = 60
+        email_sec_chal.rateLimitGlobalBurst = 0
+        email_sec_chal.rateLimitGlobalPerHour = 3600
+        email_sec_chal.rateLimitPersisted = False
+        test.email_sec_chal.Tests.tearDown(self)
+
+
+    def testTokenBucket(self):
+        bucket = email_sec_chal.TokenBucket(2, 0.5, 2, 1000)
+        bucket.tokens -= 2
+        self.assertEqual(1002, bucket.getAvailableTime())
+        bucket.refill(1001)
+        self.assertEqual(0.5, bucket.tokens)
+        bucket.refill(1100)
+        self.assertTrue(bucket.isFull())
+        self.assertEqual(2, bucket.tokens)
+
+    def testPerSenderLimit(self):
+        rateLimiter = email_sec_chal.RateLimiter()
+        db = email_sec_chal.Db()
+        self.assertIsNone(rateLimiter.admit("gbr@voidland.org", db, 1000))
+        self.assertIsNone(rateLimiter.admit("GBR@voidland.org", db, 1000))
+        self.assertEqual(1001, rateLimiter.admit("gbr@voidland.org", db, 1000))
+        self.assertIsNone(rateLimiter.admit("gbr@voidland.org", db, 1001))
+        self.assertEqual({"accepted": 3, "deferred": 1}, dict(rateLimiter.counts))
+
+    def testGlobalLimit(self):
+        rateLimiter = email_sec_chal.RateLimiter()
+        db = email_sec_chal.Db()
+        for sender in ["a@voidland.org", "b@voidland.org", "c@voidland.org"]:
+            self.assertIsNone(rateLimiter.admit(sender, db, 1000))
+        self.assertEqual(1000.5, rateLimiter.admit("d@voidland.org", db, 1000))
+
+        email_sec_chal.rateLimitGlobalBurst = 0
+        self.assertIsNone(rateLimiter.admit("d@voidland.org", db, 1000))
+
+    def testPersisted(self):
+        email_sec_chal.rateLimitPersisted = True
+        db = email_sec_chal.Db()
+        rateLimiter = email_sec_chal.RateLimiter()
+        rateLimiter.admit("gbr@voidland.org", db, 1000)
+        rateLimiter.admit("gbr@voidland.org", db, 1000)
+
+        # A new limiter, as after a restart.
+        rateLimiter = email_sec_chal.RateLimiter()
+        self.assertEqual(1001, rateLimiter.admit("gbr@voidland.org", db, 1000))
+        self.assertEqual((0, 1000), db.getRateLimitBucket("gbr@voidland.org"))
+        self.assertEqual((1, 1000), db.getRateLimitBucket(email_sec_chal.RateLimiter.globalBucketName))
+
+        email_sec_chal.rateLimitPersisted = False
+        rateLimiter = email_sec_chal.RateLimiter()
+        self.assertIsNone(rateLimiter.admit("gbr@voidland.org", db, 1000))
+
+    def testPruneBuckets(self):
+        rateLimiter = email_sec_chal.RateLimiter()
+        db = email_sec_chal.Db()
+        email_sec_chal.rateLimitGlobalBurst = 0
+        email_sec_chal.RateLimiter.maxBucketCount = 2
+        try:
+            for sender in ["a@voidland.org", "b@voidland.org"]:
+                rateLimiter.admit(sender, db, 1000)
+            rateLimiter.admit("c@voidland.org", db, 2000)
+        finally:
+            email_sec_chal.RateLimiter.maxBucketCount = 10000
+        self.assertEqual(["c@voidland.org"], list(rateLimiter.buckets))
@@ -37,25 +37,68 @@ class Tests(unittest.TestCase):
         email_sec_chal.resourceDir = resourceDir 
         email_sec_chal.dataDir = Tests.tempDir
         email_sec_chal.tempDir = Tests.tempDir
+        email_sec_chal.memoryTempDir = None
+        email_sec_chal.tempDirQuotaMb = 0
         
         email_sec_chal.Db.initialized = False
         email_sec_chal.Db.conn = None
         
+        email_sec_chal.Workspace.initialized = False
+        
         email_sec_chal.Pgp.initialized = False
         email_sec_chal.Pgp.officialBotKeys = None
         email_sec_chal.Pgp.impostorBotKeys = None
         email_sec_chal.Pgp.botFrom = None
         email_sec_chal.Pgp.botEmailAddress = None
         email_sec_chal.Pgp.officialBotKeysFilePath = None
+        email_sec_chal.Pgp.keyringPool = None
+        email_sec_chal.BotIdentity.initialized = False
+        email_sec_chal.BotIdentity.identities = {}
+        email_sec_chal.botIdentityCachePersisted = True
+        email_sec_chal.CryptoExecutor.shutdown()
+        email_sec_chal.cryptoWorkerCount = 0
+        email_sec_chal.cryptoOperationTimeoutSec = 60
+        email_sec_chal.maxKeySizeKb = 64
+        email_sec_chal.maildirWatcher = "auto"
+        email_sec_chal.maildirPollMinIntervalSec = 1.0
+        email_sec_chal.maildirPollMaxIntervalSec = 30.0
+        email_sec_chal.dispatcherWorkerCount = 0
+        email_sec_chal.maildirMaxPending = 256
+        email_sec_chal.quarantineBaseDelaySec = 60
+        email_sec_chal.quarantineMaxDelaySec = 86400
+        email_sec_chal.quarantineMaxAttempts = 10
+        email_sec_chal.mailListener = "none"
+        email_sec_chal.mailListenerHost = "localhost"
+        email_sec_chal.mailListenerPort = 24
+        email_sec_chal.mailListenerMaxPending = 64
+        email_sec_chal.runtime = "threads"
+        email_sec_chal.asyncMaxInFlight = 256
+        email_sec_chal.rateLimitSenderBurst = 0
+        email_sec_chal.rateLimitSenderPerHour = 60
+        email_sec_chal.rateLimitGlobalBurst = 0
+        email_sec_chal.rateLimitGlobalPerHour = 3600
+        email_sec_chal.rateLimitAction = "defer"
+        email_sec_chal.rateLimitPersisted = False
+        email_sec_chal.dedupTtlSec = 0
+        email_sec_chal.dedupMaxEntries = 100000
+        email_sec_chal.coalescingWindowSec = 0
+        email_sec_chal.dbJournalMode = "WAL"
+        email_sec_chal.dbSynchronous = "NORMAL"
+        email_sec_chal.dbCacheSizeKb = 8192
+        email_sec_chal.dbCompressKeys = True
+        email_sec_chal.dbCorrespondentCacheSize = 10000
+        email_sec_chal.cryptoBackend = os.environ.get("EMAIL_SEC_CHAL_CRYPTO_BACKEND", "gnupg")
         
 
     @classmethod
     def tearDownClass(cls):
         email_sec_chal.resourceDir = Tests.saveResourceDir 
+        email_sec_chal.Db.closeConnections()
         email_sec_chal.dataDir = Tests.saveDataDir
         email_sec_chal.tempDir = Tests.saveTempDir  
         email_sec_chal.Db.initialized = False
         email_sec_chal.Pgp.initialized = False
+        email_sec_chal.Workspace.initialized = False
         
         shutil.rmtree(Tests.tempDir, ignore_errors=True)
         
@@ -77,8 +120,22 @@ class Tests(unittest.TestCase):
     def readPrivateKey(correspondentEmailAddress, correspondentKeyId):
         return Tests.readKey(correspondentEmailAddress, correspondentKeyId, private=True)
     
+    @staticmethod
+    def createFloodedKey(key, signatureCount):
+        fakeSignature = bytes([4, 0x10, 1, 8, 0, 6, 5, 2, 0, 0, 0, 1, 0, 10, 9, 16]) + bytes(range(8)) + bytes([0xAB, 0xCD, 0, 8, 0xFF])
+        floodedKey = b""
+        for tag, body in email_sec_chal.openpgp.iterPackets(email_sec_chal.openpgp.dearmor(key)):
+            floodedKey += email_sec_chal.openpgp.encodePacket(tag, body)
+            if tag == email_sec_chal.openpgp.PACKET_TAG_USER_ID:
+                floodedKey += email_sec_chal.openpgp.encodePacket(email_sec_chal.openpgp.PACKET_TAG_SIGNATURE, fakeSignature) * signatureCount
+        return email_sec_chal.openpgp.armor(floodedKey, "PUBLIC KEY BLOCK")
+    
     @staticmethod
     def clearDb():
         db = email_sec_chal.Db()
         cursor = db.conn.cursor()
         cursor.execute("DELETE FROM correspondents")
+        cursor.execute("DELETE FROM keys")
+        cursor.execute("DELETE FROM rate_limit_buckets")
+        cursor.execute("DELETE FROM seen_messages")
+        email_sec_chal.Db.clearCache()
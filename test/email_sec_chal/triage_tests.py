@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import email
+import email.parser
+import io
+import os.path
+import unittest.mock
+
+
+
+class TriageTests(test.email_sec_chal.Tests):
+
+    correspondentEmailAddress = "gbr@voidland.org"
+
+
+    def setUp(self):
+        test.email_sec_chal.Tests.clearDb()
+        email_sec_chal.Pgp.staticInit()
+        email_sec_chal.silentPeriodSec = 0
+
+    def readHeaders(self, msgFileName):
+        moduleDir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(moduleDir, "messages", msgFileName + ".eml"), "rb") as f:
+            return email.parser.BytesHeaderParser().parse(f)
+
+
+    def testAccepted(self):
+        triage = email_sec_chal.Triage()
+        self.assertTrue(triage.accept(self.readHeaders("validRequestForOfficialBot"), email_sec_chal.Db()))
+        self.assertTrue(triage.accept(self.readHeaders("validRequestForOfficialBot_non_lowercase_sender_address"), email_sec_chal.Db()))
+        self.assertEqual(0, triage.getRejectedCount())
+
+    def testRejected(self):
+        triage = email_sec_chal.Triage()
+        db = email_sec_chal.Db()
+        self.assertEqual("no sender", triage.getRejectionReason(self.readHeaders("missing_from_header"), db))
+        self.assertEqual("spoofed sender", triage.getRejectionReason(self.readHeaders("validRequestFromOfficialBot"), db))
+
+        headers = self.readHeaders("validRequestForOfficialBot")
+        del headers["To"]
+        headers["To"] = "someone@voidland.org"
+        self.assertEqual("bot not a recipient", triage.getRejectionReason(headers, db))
+        headers["Cc"] = email_sec_chal.Pgp.botEmailAddress.upper()
+        self.assertIsNone(triage.getRejectionReason(headers, db))
+
+    def testSilentPeriod(self):
+        triage = email_sec_chal.Triage()
+        db = email_sec_chal.Db()
+        headers = self.readHeaders("validRequestForOfficialBot")
+        db.redHerringSent(TriageTests.correspondentEmailAddress)
+        self.assertTrue(triage.accept(headers, db))
+
+        email_sec_chal.silentPeriodSec = 300
+        self.assertFalse(triage.accept(headers, db))
+        self.assertFalse(triage.accept(self.readHeaders("validRequestFromImpostorBot"), db))
+        self.assertEqual(2, triage.getRejectedCount())
+        self.assertEqual({"silent period": 1, "spoofed sender": 1}, dict(triage.rejectedCounts))
+
+    def testDuplicate(self):
+        triage = email_sec_chal.Triage()
+        db = email_sec_chal.Db()
+        headers = self.readHeaders("validRequestForOfficialBot")
+        self.assertTrue(triage.accept(headers, db, "dedupKey"))
+        self.assertFalse(triage.accept(headers, db, "dedupKey"))     # In flight.
+        triage.release("dedupKey")
+        self.assertTrue(triage.accept(headers, db, "dedupKey"))
+        triage.release("dedupKey")
+        email_sec_chal.dedupTtlSec = 604800
+        try:
+            db.messageSeen("dedupKey")
+            self.assertFalse(triage.accept(headers, db, "dedupKey"))
+        finally:
+            email_sec_chal.dedupTtlSec = 0
+        self.assertTrue(triage.accept(headers, db, "otherDedupKey"))
+        self.assertTrue(triage.accept(headers, db))
+        self.assertEqual({"duplicate": 2}, dict(triage.rejectedCounts))
+
+    def testUndecodableHeaders(self):
+        triage = email_sec_chal.Triage()
+        moduleDir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(moduleDir, "messages", "validRequestForOfficialBot.eml"), "rb") as f:
+            data = f.read()
+        data = data.replace(b"From: Vladimir Panov", b"From: Vladim\xc3\xadr Panov").replace(b"Message-ID: <", b"Message-ID: <\xff")
+        headers = email.parser.BytesHeaderParser().parse(io.BytesIO(data))
+        self.assertTrue(triage.accept(headers, email_sec_chal.Db()))
+        claimedMessage = email_sec_chal.ClaimedMessage("key", email.message_from_bytes(data))
+        self.assertIsNotNone(claimedMessage.getDedupKey())
+
+        db = unittest.mock.MagicMock()
+        db.getRedHerringSentTimestamp.side_effect = TypeError("failing")
+        self.assertFalse(triage.accept(headers, db))
+        self.assertEqual({"invalid headers": 1}, dict(triage.rejectedCounts))
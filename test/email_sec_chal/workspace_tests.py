@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import test.email_sec_chal
+import email_sec_chal
+import fcntl
+import os
+
+
+
+class WorkspaceTests(test.email_sec_chal.Tests):
+
+    def setUp(self):
+        email_sec_chal.Workspace.initialized = False
+        email_sec_chal.memoryTempDir = None
+        email_sec_chal.tempDirQuotaMb = 0
+
+
+    def testSweepStaleWorkspaces(self):
+        ownersDir = os.path.join(email_sec_chal.tempDir, "workspaces")
+        for owner in ["dead-1", "alive-2"]:
+            os.makedirs(os.path.join(ownersDir, owner, "pool_official_abc"))
+            with open(os.path.join(ownersDir, owner + ".lock"), "w"):
+                pass
+        os.makedirs(os.path.join(email_sec_chal.tempDir, "unrelated"))
+
+        # Another instance holds its lock.
+        with open(os.path.join(ownersDir, "alive-2.lock"), "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            email_sec_chal.Workspace.staticInit()
+        self.assertFalse(os.access(os.path.join(ownersDir, "dead-1"), os.F_OK))
+        self.assertFalse(os.access(os.path.join(ownersDir, "dead-1.lock"), os.F_OK))
+        self.assertTrue(os.access(os.path.join(ownersDir, "alive-2", "pool_official_abc"), os.F_OK))
+        self.assertTrue(os.access(os.path.join(email_sec_chal.tempDir, "unrelated"), os.F_OK))
+        self.assertEqual(ownersDir, os.path.dirname(email_sec_chal.Workspace.rootDir))
+
+        # Now it is gone.
+        email_sec_chal.Workspace.sweep()
+        self.assertFalse(os.access(os.path.join(ownersDir, "alive-2"), os.F_OK))
+
+    def testSweepLegacyWorkspaces(self):
+        ownersDir = os.path.join(email_sec_chal.tempDir, "workspaces")
+        os.makedirs(ownersDir, exist_ok=True)
+        legacyDirNames = ["gbr@voidland.org_official_abc", "gbr@voidland.org_impostor_abc", "scratch_abc"]
+        for dirName in legacyDirNames + ["official"]:
+            os.makedirs(os.path.join(email_sec_chal.tempDir, dirName), exist_ok=True)
+
+        # Another instance holds its lock, it may still use them.
+        with open(os.path.join(ownersDir, "alive-2.lock"), "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            email_sec_chal.Workspace.staticInit()
+        for dirName in legacyDirNames:
+            self.assertTrue(os.access(os.path.join(email_sec_chal.tempDir, dirName), os.F_OK))
+
+        # Now it is gone.
+        email_sec_chal.Workspace.sweep()
+        for dirName in legacyDirNames:
+            self.assertFalse(os.access(os.path.join(email_sec_chal.tempDir, dirName), os.F_OK))
+        self.assertTrue(os.access(os.path.join(email_sec_chal.tempDir, "official"), os.F_OK))
+
+    def testLiveCount(self):
+        email_sec_chal.Workspace.staticInit()
+        workspace1 = email_sec_chal.Workspace.create("pool_official_")
+        workspace2 = email_sec_chal.Workspace.create("pool_impostor_")
+        self.assertEqual(2, email_sec_chal.Workspace.getLiveCount())
+
+        self.assertEqual(0, email_sec_chal.Workspace.sweep())
+        email_sec_chal.Workspace.remove(workspace1)
+        self.assertEqual(1, email_sec_chal.Workspace.getLiveCount())
+        self.assertFalse(os.access(workspace1, os.F_OK))
+        email_sec_chal.Workspace.remove(workspace2)
+        self.assertEqual(0, email_sec_chal.Workspace.getLiveCount())
+
+    def testQuota(self):
+        email_sec_chal.tempDirQuotaMb = 1
+        email_sec_chal.Workspace.staticInit()
+        workspace = email_sec_chal.Workspace.create("scratch_")
+        with open(os.path.join(workspace, "data"), "wb") as f:
+            f.write(b"\0" * (1024 * 1024))
+
+        # The usage is only recomputed once in a while.
+        email_sec_chal.Workspace.remove(email_sec_chal.Workspace.create("scratch_"))
+        email_sec_chal.Workspace.nextUsageUpdateTime = 0
+        with self.assertRaises(email_sec_chal.EmailSecChalException):
+            email_sec_chal.Workspace.create("scratch_")
+        email_sec_chal.Workspace.remove(workspace)
+        email_sec_chal.Workspace.nextUsageUpdateTime = 0
+        email_sec_chal.Workspace.remove(email_sec_chal.Workspace.create("scratch_"))
+
+    def testMemoryTempDir(self):
+        email_sec_chal.memoryTempDir = os.path.join(email_sec_chal.tempDir, "shm")
+        email_sec_chal.Workspace.staticInit()
+        workspace = email_sec_chal.Workspace.create("scratch_")
+        self.assertTrue(email_sec_chal.isPathPrefix(workspace, email_sec_chal.memoryTempDir))
+        email_sec_chal.Workspace.remove(workspace)
+
+    def testUnusableMemoryTempDir(self):
+        with open(os.path.join(email_sec_chal.tempDir, "notADir"), "w"):
+            pass
+        email_sec_chal.memoryTempDir = os.path.join(email_sec_chal.tempDir, "notADir", "shm")
+        email_sec_chal.Workspace.staticInit()
+        self.assertEqual(email_sec_chal.tempDir, email_sec_chal.Workspace.baseDir)